@@ -0,0 +1,331 @@
+import argparse
+import datetime
+import glob
+import json
+import logging
+import os
+import sys
+import time
+
+import natsort
+import netCDF4
+import numcodecs
+import numpy as np
+from numcodecs import LZ4, Blosc, Shuffle, Zlib, Zstd
+
+# codec used for variables which are not in a profile
+DEFAULT_VARIABLE = 'default'
+
+
+def candidate_codecs(itemsize: int = 4) -> list:
+    """
+    The codecs and levels to benchmark
+
+    Zlib with and without a byte shuffle is what netCDF4/HDF5 can write, the others are only available to Zarr.
+
+    Args:
+        itemsize: Bytes per value, used by the shuffle filters
+
+    Returns:
+        list of dicts with the name, filters, and compressor of each codec
+    """
+    codecs = []
+    for level in (1, 3, 5, 9):
+        codecs.append({'name': f'zlib-{level}', 'filters': [], 'compressor': Zlib(level=level), 'netcdf': True})
+        codecs.append({'name': f'zlib-{level}-shuffle', 'filters': [Shuffle(elementsize=itemsize)],
+                       'compressor': Zlib(level=level), 'netcdf': True})
+    for level in (1, 3, 9, 19):
+        codecs.append({'name': f'zstd-{level}', 'filters': [], 'compressor': Zstd(level=level), 'netcdf': False})
+    codecs.append({'name': 'lz4', 'filters': [], 'compressor': LZ4(), 'netcdf': False})
+    shuffles = {'noshuffle': Blosc.NOSHUFFLE, 'shuffle': Blosc.SHUFFLE, 'bitshuffle': Blosc.BITSHUFFLE}
+    for cname in ('zstd', 'lz4', 'lz4hc', 'blosclz', 'zlib'):
+        for level in (1, 5, 9):
+            for shuffle_name, shuffle in shuffles.items():
+                codecs.append({'name': f'blosc-{cname}-{level}-{shuffle_name}', 'filters': [],
+                               'compressor': Blosc(cname=cname, clevel=level, shuffle=shuffle), 'netcdf': False})
+    return codecs
+
+
+def parse_chunk_shape(shape: str) -> tuple:
+    """Parse a chunk shape given as TIMExRIVID, e.g. 24x10000"""
+    return tuple(int(x) for x in shape.lower().split('x'))
+
+
+def sample_blocks(qout_files: list, variable: str, chunk_shape: tuple, n_samples: int = 8, seed: int = 0) -> list:
+    """
+    Read blocks with the shape of a chunk from random files and positions
+
+    Args:
+        qout_files: Paths to Qout files of a VPU
+        variable: Name of the variable to read
+        chunk_shape: Shape of a chunk. 1D variables use the last dimension only
+        n_samples: Number of blocks to read
+        seed: Seed of the random positions
+
+    Returns:
+        list of contiguous np.ndarray blocks
+    """
+    rng = np.random.default_rng(seed)
+    blocks = []
+    for _ in range(n_samples):
+        with netCDF4.Dataset(qout_files[rng.integers(len(qout_files))]) as ds:
+            var = ds[variable]
+            var.set_auto_maskandscale(False)
+            shape = chunk_shape[-var.ndim:]
+            index = tuple(
+                slice(start, start + min(size, length))
+                for size, length in zip(shape, var.shape)
+                for start in [int(rng.integers(max(length - size, 0) + 1))]
+            )
+            blocks.append(np.ascontiguousarray(var[index]))
+    return blocks
+
+
+def benchmark_codec(codec: dict, blocks: list, repeats: int = 3) -> dict:
+    """
+    Measure the compression ratio and the encode and decode throughput of a codec on sample blocks
+
+    Args:
+        codec: A codec from candidate_codecs
+        blocks: Sample blocks from sample_blocks
+        repeats: Number of times to time encoding and decoding. The fastest time is used
+
+    Returns:
+        dict with the ratio of raw to encoded bytes and the encode and decode throughput in MB/s of raw data
+    """
+    raw_bytes = sum(b.nbytes for b in blocks)
+
+    def encode(block: np.ndarray) -> bytes:
+        for f in codec['filters']:
+            block = f.encode(block)
+        return codec['compressor'].encode(block)
+
+    def decode(data: bytes, block: np.ndarray) -> np.ndarray:
+        data = codec['compressor'].decode(data)
+        for f in reversed(codec['filters']):
+            data = f.decode(data)
+        return np.frombuffer(data, dtype=block.dtype)
+
+    encode_time = decode_time = float('inf')
+    encoded = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        encoded = [encode(b) for b in blocks]
+        encode_time = min(encode_time, time.perf_counter() - start)
+        start = time.perf_counter()
+        decoded = [decode(e, b) for e, b in zip(encoded, blocks)]
+        decode_time = min(decode_time, time.perf_counter() - start)
+        assert all(np.array_equal(d, b.ravel(), equal_nan=True) for d, b in zip(decoded, blocks)), \
+            f'{codec["name"]} did not round trip'
+    return {
+        'ratio': raw_bytes / max(sum(len(e) for e in encoded), 1),
+        'encode_mbps': raw_bytes / 1e6 / max(encode_time, 1e-9),
+        'decode_mbps': raw_bytes / 1e6 / max(decode_time, 1e-9),
+    }
+
+
+def select_codec(results: list, min_encode_mbps: float, min_decode_mbps: float, netcdf: bool = False) -> dict:
+    """
+    Pick the codec with the highest compression ratio among those fast enough to encode and decode
+
+    Args:
+        results: Benchmark results for 1 variable and chunk shape
+        min_encode_mbps: Minimum encode throughput in MB/s
+        min_decode_mbps: Minimum decode throughput in MB/s
+        netcdf: Only consider codecs netCDF4 can write
+
+    Returns:
+        dict of the selected result. If no codec is fast enough, the one with the fastest decoding
+    """
+    results = [r for r in results if r['netcdf'] or not netcdf]
+    fast = [r for r in results if r['encode_mbps'] >= min_encode_mbps and r['decode_mbps'] >= min_decode_mbps]
+    if fast:
+        return max(fast, key=lambda r: r['ratio'])
+    return max(results, key=lambda r: r['decode_mbps'])
+
+
+def _netcdf_config(result: dict) -> dict:
+    return {'zlib': True, 'complevel': result['compressor']['level'], 'shuffle': bool(result['filters'])}
+
+
+def _zarr_config(result: dict) -> dict:
+    return {'compressor': result['compressor'], 'filters': result['filters']}
+
+
+def read_codec_profile(path: str or None) -> dict or None:
+    """Read a codec profile written by benchmark_codecs.py, or return None if path is None"""
+    if path is None:
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def netcdf_encoding(profile: dict or None, variables: list, default: dict) -> dict:
+    """
+    netCDF4 encoding for each variable from a codec profile
+
+    Args:
+        profile: A codec profile from read_codec_profile, or None to use the default for every variable
+        variables: Names of the variables to encode
+        default: The encoding of variables which are not in the profile
+
+    Returns:
+        dict of the encoding for each variable for xarray.Dataset.to_netcdf
+    """
+    selected = (profile or {}).get('netcdf', {})
+    return {var: dict(selected.get(var, selected.get(DEFAULT_VARIABLE, default))) for var in variables}
+
+
+def zarr_encoding(profile: dict or None, variables: list, default: dict) -> dict:
+    """
+    Zarr encoding for each variable from a codec profile
+
+    Args:
+        profile: A codec profile from read_codec_profile, or None to use the default for every variable
+        variables: Names of the variables to encode
+        default: The encoding of variables which are not in the profile, e.g. {'compressor': Blosc()}
+
+    Returns:
+        dict of the encoding for each variable for xarray.Dataset.to_zarr
+    """
+    selected = (profile or {}).get('zarr', {})
+    encoding = {}
+    for var in variables:
+        config = selected.get(var, selected.get(DEFAULT_VARIABLE))
+        if config is None:
+            encoding[var] = dict(default)
+            continue
+        encoding[var] = {
+            'compressor': numcodecs.get_codec(dict(config['compressor'])),
+            'filters': [numcodecs.get_codec(dict(f)) for f in config['filters']] or None,
+        }
+    return encoding
+
+
+def benchmark_vpu(qout_files: list,
+                  variables: list,
+                  chunk_shapes: list,
+                  n_samples: int = 8,
+                  repeats: int = 3,
+                  min_encode_mbps: float = 50,
+                  min_decode_mbps: float = 300,
+                  select_shape: tuple = None, ) -> dict:
+    """
+    Benchmark every candidate codec for each variable and chunk shape and choose a codec for each variable
+
+    Args:
+        qout_files: Paths to Qout files of a VPU
+        variables: Names of the variables to benchmark
+        chunk_shapes: Chunk shapes as (time, rivid) tuples
+        n_samples: Number of blocks read for each variable and chunk shape
+        repeats: Number of times each codec is timed
+        min_encode_mbps: Minimum encode throughput of a selected codec in MB/s
+        min_decode_mbps: Minimum decode throughput of a selected codec in MB/s
+        select_shape: The chunk shape used to select codecs. Defaults to the first chunk shape
+
+    Returns:
+        dict codec profile with every result and the selected netcdf and zarr encodings for each variable
+    """
+    select_shape = tuple(select_shape or chunk_shapes[0])
+    results = []
+    for variable in variables:
+        for chunk_shape in chunk_shapes:
+            blocks = sample_blocks(qout_files, variable, chunk_shape, n_samples)
+            logging.info(f'Benchmarking {variable} in {"x".join(map(str, chunk_shape))} chunks')
+            for codec in candidate_codecs(blocks[0].dtype.itemsize):
+                results.append({
+                    'variable': variable,
+                    'chunk_shape': list(chunk_shape),
+                    'codec': codec['name'],
+                    'netcdf': codec['netcdf'],
+                    'compressor': codec['compressor'].get_config(),
+                    'filters': [f.get_config() for f in codec['filters']],
+                    **benchmark_codec(codec, blocks, repeats),
+                })
+
+    profile = {
+        'created': datetime.datetime.utcnow().isoformat(),
+        'files': qout_files,
+        'min_encode_mbps': min_encode_mbps,
+        'min_decode_mbps': min_decode_mbps,
+        'select_chunk_shape': list(select_shape),
+        'results': results,
+        'netcdf': {},
+        'zarr': {},
+    }
+    for variable in variables:
+        candidates = [r for r in results if r['variable'] == variable and tuple(r['chunk_shape']) == select_shape]
+        profile['netcdf'][variable] = _netcdf_config(
+            select_codec(candidates, min_encode_mbps, min_decode_mbps, netcdf=True))
+        profile['zarr'][variable] = _zarr_config(select_codec(candidates, min_encode_mbps, min_decode_mbps))
+    # variables missing from the profile, e.g. coordinates of other files, use the choice for the first variable
+    profile['netcdf'][DEFAULT_VARIABLE] = profile['netcdf'][variables[0]]
+    profile['zarr'][DEFAULT_VARIABLE] = profile['zarr'][variables[0]]
+    return profile
+
+
+def print_report(profile: dict, top: int = 10) -> None:
+    for variable in profile['netcdf']:
+        if variable == DEFAULT_VARIABLE:
+            continue
+        print(f'\n{variable}: netcdf {profile["netcdf"][variable]} zarr {profile["zarr"][variable]["compressor"]}')
+        shapes = sorted({tuple(r['chunk_shape']) for r in profile['results'] if r['variable'] == variable})
+        for shape in shapes:
+            rows = [r for r in profile['results'] if r['variable'] == variable and tuple(r['chunk_shape']) == shape]
+            print(f'  chunk {"x".join(map(str, shape))}')
+            print(f'    {"codec":<32} {"ratio":>7} {"enc MB/s":>10} {"dec MB/s":>10}')
+            for r in sorted(rows, key=lambda r: r['ratio'], reverse=True)[:top]:
+                print(f'    {r["codec"]:<32} {r["ratio"]:>7.2f} {r["encode_mbps"]:>10.0f} {r["decode_mbps"]:>10.0f}')
+
+
+if __name__ == '__main__':
+    """
+    Benchmark compression codecs on samples of the Qout files of a VPU and write a codec profile for the archive
+    writers: compress_decadal_discharge.py, retro_to_vpu_zarr.py and retro_to_combo_zarr.py --codecprofile
+
+    Arguments:
+    --vpudir: Directory of Qout files for a VPU
+    --profile: Path to save the json codec profile
+    --variables: Variables to benchmark
+    --chunkshapes: Chunk shapes to benchmark as TIMExRIVID
+    --samples: Number of blocks sampled for each variable and chunk shape
+    --repeats: Number of times each codec is timed
+    --minencode: Minimum encode throughput in MB/s of a selected codec
+    --mindecode: Minimum decode throughput in MB/s of a selected codec
+
+    Usage:
+    python benchmark_codecs.py --vpudir /mnt/outputs/714 --profile codecs.json --chunkshapes 2920x1000 24x100000
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vpudir', type=str, required=True,
+                        help='Directory of Qout files for a VPU')
+    parser.add_argument('--profile', type=str, required=True,
+                        help='Path to save the json codec profile')
+    parser.add_argument('--variables', type=str, nargs='+', required=False, default=['Qout'],
+                        help='Variables to benchmark')
+    parser.add_argument('--chunkshapes', type=str, nargs='+', required=False, default=['2920x1000', '24x100000'],
+                        help='Chunk shapes to benchmark as TIMExRIVID. The first is used to select codecs')
+    parser.add_argument('--samples', type=int, required=False, default=8,
+                        help='Number of blocks sampled for each variable and chunk shape')
+    parser.add_argument('--repeats', type=int, required=False, default=3,
+                        help='Number of times each codec is timed')
+    parser.add_argument('--minencode', type=float, required=False, default=50,
+                        help='Minimum encode throughput in MB/s of a selected codec')
+    parser.add_argument('--mindecode', type=float, required=False, default=300,
+                        help='Minimum decode throughput in MB/s of a selected codec')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        stream=sys.stdout)
+
+    files = natsort.natsorted(glob.glob(os.path.join(args.vpudir, 'Qout*.nc*')))
+    if not files:
+        logging.error(f'No Qout files found in {args.vpudir}')
+        sys.exit(1)
+    codec_profile = benchmark_vpu(files, args.variables, [parse_chunk_shape(s) for s in args.chunkshapes],
+                                  args.samples, args.repeats, args.minencode, args.mindecode)
+    print_report(codec_profile)
+    with open(args.profile, 'w') as f:
+        json.dump(codec_profile, f, indent=1)
+    logging.info(f'Wrote {args.profile}')
@@ -1,11 +1,18 @@
+import argparse
 import glob
+import json
 import os
+import re
+import shutil
+from multiprocessing import Pool
 
+import dask
 import numpy as np
 import pandas as pd
 import xarray as xr
 import logging
 import sys
+from scipy.special import gamma, gammaincinv, gammaln, ndtri
 
 logging.basicConfig(
     level=logging.INFO,
@@ -13,6 +20,9 @@ logging.basicConfig(
     stream=sys.stdout,
 )
 
+RETURN_PERIODS = (2, 5, 10, 25, 50, 100)
+DISTRIBUTIONS = ('gumbel', 'gev', 'lp3')
+
 
 def gumbel1(rp: int, xbar: np.array or float, std: np.array or float):
     """
@@ -29,71 +39,423 @@ def gumbel1(rp: int, xbar: np.array or float, std: np.array or float):
     return np.round(-np.log(-np.log(1 - (1 / rp))) * std * .7797 + xbar - (.45 * std), 3)
 
 
-for vpu_dir in [d for d in sorted(glob.glob('/Volumes/EB406_T7_2/geoglows2/outputs/*')) if os.path.isdir(d)]:
-    vpu_number = os.path.basename(vpu_dir)
+def rivids_per_block(n_times: int, itemsize: int, memory_budget: int) -> int:
+    """
+    Number of rivids to read at once so that a (time, rivid) block of Qout fits in the memory budget
+
+    The budget is halved because dask holds the per-file pieces and the concatenated block at the same time.
+
+    Args:
+        n_times: Length of the time dimension
+        itemsize: Number of bytes per Qout value
+        memory_budget: Approximate number of bytes to hold in memory at once
+
+    Returns:
+        The number of rivids per block, at least 1
+    """
+    return max(1, int(memory_budget // (2 * n_times * itemsize)))
+
+
+def annual_maxima_blocks(ds: xr.Dataset, block_size: int, skip_starts: set = frozenset()):
+    """
+    Stream Qout in native (time, rivid) blocks and reduce each block to the maximum flow in each year
+
+    Args:
+        ds: Dataset with a Qout variable on the time and rivid dimensions
+        block_size: Number of rivids to read at once
+        skip_starts: Block start indices which were already computed and should not be read
+
+    Yields:
+        Tuples of (block start, years, rivids, annual maxima) where annual maxima has the shape (years, rivids)
+    """
+    years = pd.to_datetime(ds['time'].values).year.values
+    # reduceat needs each year to be a contiguous run of rows
+    order = np.argsort(years, kind='stable') if np.any(np.diff(years) < 0) else None
+    if order is not None:
+        years = years[order]
+    unique_years, year_starts = np.unique(years, return_index=True)
+
+    rivids = ds['rivid'].values
+    qout = ds['Qout'].transpose('time', 'rivid')
+    for start in range(0, rivids.size, block_size):
+        if start in skip_starts:
+            continue
+        block = qout.isel(rivid=slice(start, start + block_size)).values
+        if order is not None:
+            block = block[order]
+        # fmax ignores nans unless every value in the year is nan
+        yield start, unique_years, rivids[start:start + block_size], np.fmax.reduceat(block, year_starts, axis=0)
+
+
+def sample_lmoments(annual_maxima: np.ndarray) -> tuple:
+    """
+    Calculate the first three sample L-moments of every river at once from unbiased probability weighted moments
+
+    Args:
+        annual_maxima: Array of annual maximum flows with shape (years, rivids). Missing years are nan.
+
+    Returns:
+        Tuple of arrays (l1, l2, t3) with shape (rivids,): the mean, L-scale and L-skewness
+    """
+    annual_maxima = np.asarray(annual_maxima, dtype=np.float64)
+    n = np.sum(~np.isnan(annual_maxima), axis=0).astype(np.float64)
+    # nans sort to the end of each column so rank j of the valid values is the row index
+    x = np.sort(annual_maxima, axis=0)
+    x[np.isnan(x)] = 0
+    j = np.arange(x.shape[0], dtype=np.float64)[:, np.newaxis]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        b0 = x.sum(axis=0) / n
+        b1 = (x * j).sum(axis=0) / (n * (n - 1))
+        b2 = (x * j * (j - 1)).sum(axis=0) / (n * (n - 1) * (n - 2))
+        l2 = 2 * b1 - b0
+        t3 = (6 * b2 - 6 * b1 + b0) / l2
+    return b0, l2, t3
+
+
+def gumbel_lmoments(rp: int, l1: np.ndarray, l2: np.ndarray) -> np.ndarray:
+    """
+    Flow for a return period from a Gumbel distribution fitted with L-moments
+
+    Args:
+        rp: Return period
+        l1: First L-moment (mean)
+        l2: Second L-moment (L-scale)
+
+    Returns:
+        The value of the distribution for the given return period
+    """
+    alpha = l2 / np.log(2)
+    xi = l1 - np.euler_gamma * alpha
+    return xi - alpha * np.log(-np.log(1 - (1 / rp)))
+
+
+def gev_lmoments(rp: int, l1: np.ndarray, l2: np.ndarray, t3: np.ndarray) -> np.ndarray:
+    """
+    Flow for a return period from a Generalized Extreme Value distribution fitted with L-moments
+
+    Uses the rational approximation of the shape parameter from Hosking (1985). Rivers with a shape parameter of
+    nearly 0 use the Gumbel distribution which is the limiting case.
+
+    Args:
+        rp: Return period
+        l1: First L-moment (mean)
+        l2: Second L-moment (L-scale)
+        t3: L-skewness
+
+    Returns:
+        The value of the distribution for the given return period
+    """
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        c = 2 / (3 + t3) - np.log(2) / np.log(3)
+        k = 7.8590 * c + 2.9554 * c ** 2
+        alpha = l2 * k / ((1 - 2 ** -k) * gamma(1 + k))
+        xi = l1 - alpha * (1 - gamma(1 + k)) / k
+        flow = xi + alpha / k * (1 - (-np.log(1 - (1 / rp))) ** k)
+    return np.where(np.abs(k) < 1e-6, gumbel_lmoments(rp, l1, l2), flow)
+
+
+def lp3_lmoments(rp: int, l1: np.ndarray, l2: np.ndarray, t3: np.ndarray) -> np.ndarray:
+    """
+    Flow for a return period from a Log-Pearson Type III distribution fitted with L-moments of log10(flow)
+
+    Uses the rational approximations of the shape parameter from Hosking and Wallis (1997). Rivers with nearly 0 skew
+    use the normal distribution which is the limiting case.
+
+    Args:
+        rp: Return period
+        l1: First L-moment (mean) of log10 of the annual maxima
+        l2: Second L-moment (L-scale) of log10 of the annual maxima
+        t3: L-skewness of log10 of the annual maxima
+
+    Returns:
+        The value of the distribution for the given return period
+    """
+    p = 1 - (1 / rp)
+    abs_t3 = np.abs(t3)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        z = 3 * np.pi * t3 ** 2
+        shape_small_t3 = (1 + 0.2906 * z) / (z + 0.1882 * z ** 2 + 0.0442 * z ** 3)
+        z = 1 - abs_t3
+        shape_large_t3 = (0.36067 * z - 0.59567 * z ** 2 + 0.25361 * z ** 3) / \
+                         (1 - 2.78861 * z + 2.56096 * z ** 2 - 0.77045 * z ** 3)
+        shape = np.where(abs_t3 < 1 / 3, shape_small_t3, shape_large_t3)
+        skew = 2 * np.sign(t3) / np.sqrt(shape)
+        sigma = l2 * np.sqrt(np.pi) * np.sqrt(shape) * np.exp(gammaln(shape) - gammaln(shape + 0.5))
+
+        # pearson type III is a gamma distribution shifted by xi and scaled by beta, mirrored if the skew is negative
+        beta = sigma * np.abs(skew) / 2
+        xi = l1 - 2 * sigma / skew
+        log_flow = np.where(
+            skew > 0,
+            xi + beta * gammaincinv(shape, p),
+            xi - beta * gammaincinv(shape, 1 - p),
+        )
+        log_flow = np.where(np.abs(skew) < 1e-4, l1 + l2 * np.sqrt(np.pi) * ndtri(p), log_flow)
+        return 10 ** log_flow
+
+
+def fit_distributions(annual_maxima: np.ndarray) -> np.ndarray:
+    """
+    Fit each of DISTRIBUTIONS to the annual maxima of every river with L-moments in a single vectorized pass
+
+    Args:
+        annual_maxima: Array of annual maximum flows with shape (years, rivids)
+
+    Returns:
+        Array of flows with shape (distributions, return periods, rivids)
+    """
+    l1, l2, t3 = sample_lmoments(annual_maxima)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # log-pearson III is fit to the log of the flows which is undefined for zero flow
+        log_maxima = np.log10(np.where(annual_maxima > 0, annual_maxima, np.nan))
+    log_l1, log_l2, log_t3 = sample_lmoments(log_maxima)
+
+    return np.round(np.stack([
+        np.stack([gumbel_lmoments(rp, l1, l2) for rp in RETURN_PERIODS]),
+        np.stack([gev_lmoments(rp, l1, l2, t3) for rp in RETURN_PERIODS]),
+        np.stack([lp3_lmoments(rp, log_l1, log_l2, log_t3) for rp in RETURN_PERIODS]),
+    ]), 3)
+
+
+def return_periods_dataset(rivids: np.ndarray, annual_maxima: np.ndarray) -> xr.Dataset:
+    """
+    Fit distributions to the annual maxima of each river and build the return periods dataset
+
+    Args:
+        rivids: Array of river ids
+        annual_maxima: Array of annual maximum flows with shape (years, rivids)
+
+    Returns:
+        xr.Dataset with the maximum simulated flow and the flow for each return period
+    """
+    qout_mean = np.nanmean(annual_maxima, axis=0)
+    qout_std = np.nanstd(annual_maxima, axis=0)
+    return xr.Dataset(
+        coords={
+            'rivid': rivids,
+            'return_period': list(RETURN_PERIODS),
+            'distribution': list(DISTRIBUTIONS),
+        },
+        data_vars={
+            'qout_max': ('rivid', np.nanmax(annual_maxima, axis=0)),
+            **{f'rp{rp}': ('rivid', gumbel1(rp, qout_mean, qout_std).astype(float)) for rp in RETURN_PERIODS},
+            'rp_flow': (
+                ('distribution', 'return_period', 'rivid'),
+                fit_distributions(annual_maxima),
+                {'description': 'Return period flows from distributions fitted to the annual maxima with L-moments'},
+            ),
+        },
+        attrs={
+            'description': 'Calculated using annual maximum flows. The rp variables use the Gumbel Type 1 '
+                           'distribution fitted with the method of moments. rp_flow compares the Gumbel, GEV and '
+                           'Log-Pearson Type III distributions fitted with L-moments.',
+            'author': 'Riley Hales, PhD',
+        },
+    )
+
+
+def write_partial(path: str, **arrays: np.ndarray) -> None:
+    """
+    Atomically save arrays to a .npz file so that an interrupted write never leaves a readable partial result
+
+    Args:
+        path: Path to the .npz file
+        **arrays: Arrays to save by name
+
+    Returns:
+        None
+    """
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+    return
+
+
+def qout_file_end_year(qout_file: str) -> int or None:
+    """
+    Read the last year simulated in a Qout file from a file name like Qout_{vpu}_{YYYYMMDD}_{YYYYMMDD}.nc
+
+    Args:
+        qout_file: Path to a Qout file
+
+    Returns:
+        The end year or None if the file name does not contain dates
+    """
+    dates = re.search(r'_(\d{8})_(\d{8})', os.path.basename(qout_file))
+    return int(dates.group(2)[:4]) if dates else None
+
+
+def read_annual_maxima(qout_files: list, partial_dir: str, memory_budget: int) -> xr.DataArray:
+    """
+    Read the annual maximum flow of every river from a list of Qout files
+
+    The annual maxima of each block of rivids are saved to partial_dir as they are computed. If reading is
+    interrupted, calling this function again with the same files only reads the blocks which have not been saved yet.
+
+    Args:
+        qout_files: Paths to the Qout files for a single VPU
+        partial_dir: Directory to save the annual maxima of each block of rivids
+        memory_budget: Approximate number of bytes of Qout to hold in memory at once
+
+    Returns:
+        xr.DataArray of annual maximum flows with dimensions (year, rivid)
+    """
+    os.makedirs(partial_dir, exist_ok=True)
+    qout_file_names = sorted(os.path.basename(f) for f in qout_files)
+
+    with xr.open_mfdataset(sorted(qout_files), concat_dim='time', combine='nested') as ds:
+        # the block size is fixed by the first attempt so the saved blocks line up when resuming
+        blocks_file = os.path.join(partial_dir, 'blocks.json')
+        blocks_info = None
+        if os.path.exists(blocks_file):
+            with open(blocks_file) as f:
+                blocks_info = json.load(f)
+            if blocks_info.get('qout_files') != qout_file_names:
+                logging.info(f'Discarding partial results for a different set of Qout files in {partial_dir}')
+                shutil.rmtree(partial_dir)
+                os.makedirs(partial_dir)
+                blocks_info = None
+        if blocks_info is None:
+            blocks_info = {
+                'block_size': rivids_per_block(ds['time'].size, ds['Qout'].dtype.itemsize, memory_budget),
+                'n_rivids': ds['rivid'].size,
+                'qout_files': qout_file_names,
+            }
+            with open(f'{blocks_file}.tmp', 'w') as f:
+                json.dump(blocks_info, f)
+            os.replace(f'{blocks_file}.tmp', blocks_file)
+        block_size = blocks_info['block_size']
+
+        block_starts = range(0, ds['rivid'].size, block_size)
+        finished = {s for s in block_starts if os.path.exists(os.path.join(partial_dir, f'annmax_{s:09d}.npz'))}
+        logging.info(f'{len(finished)} of {len(block_starts)} blocks of {block_size} rivids done in {partial_dir}')
+
+        for start, years, rivids, maxima in annual_maxima_blocks(ds, block_size, finished):
+            write_partial(os.path.join(partial_dir, f'annmax_{start:09d}.npz'),
+                          years=years, rivids=rivids, annual_maxima=maxima)
+            logging.info(f'Finished block starting at rivid index {start}')
+
+    blocks = []
+    for start in block_starts:
+        with np.load(os.path.join(partial_dir, f'annmax_{start:09d}.npz')) as block:
+            blocks.append((block['years'], block['rivids'], block['annual_maxima']))
+    return xr.DataArray(
+        np.concatenate([maxima for _, _, maxima in blocks], axis=1),
+        dims=('year', 'rivid'),
+        coords={
+            'year': blocks[0][0],
+            'rivid': np.concatenate([rivids for _, rivids, _ in blocks]),
+        },
+    )
 
-    if os.path.exists(f'/Volumes/EB406_T7_2/geoglows2/return_periods/{vpu_number}/returnperiods_{vpu_number}.nc'):
-        logging.info(f'Skipping VPU {vpu_number}')
-        continue
 
+def calculate_vpu_return_periods(vpu_dir: str, save_dir: str, memory_budget: int, update: bool = False) -> str:
+    """
+    Calculate the return periods for every river in a VPU from its Qout files
+
+    The annual maxima are saved to annualmax_{vpu}.nc next to the return periods. When updating, only the Qout files
+    which simulate the last stored year or later are read and merged into the stored annual maxima. The last stored
+    year is read again because it may have been incomplete.
+
+    Args:
+        vpu_dir: Directory containing the Qout files for a single VPU
+        save_dir: Directory where returnperiods_{vpu}.nc and annualmax_{vpu}.nc will be saved
+        memory_budget: Approximate number of bytes of Qout to hold in memory at once
+        update: Update an existing annual maxima file instead of reading all Qout files
+
+    Returns:
+        str: The VPU number
+    """
+    vpu_number = os.path.basename(vpu_dir)
     logging.info(f'Processing VPU {vpu_number}')
-    df = pd.DataFrame(columns=['rivid', 'qout_max', 'rp2', 'rp5', 'rp10', 'rp25', 'rp50', 'rp100'])
-
-    with xr.open_mfdataset(os.path.join(vpu_dir, 'Qout*.nc*'), concat_dim='time', combine='nested') as ds:
-        # get the size of the rivid dimension and read the Qout variable in 5 chunks
-        num_chunks = 15
-        chunk_size = int(np.ceil(len(ds.rivid) / num_chunks))
-        for chunk in range(num_chunks):
-            rivids = ds.rivid.isel(rivid=slice(chunk * chunk_size, (chunk + 1) * chunk_size)).values
-            qout = (
-                ds
-                .Qout
-                .isel(rivid=slice(chunk * chunk_size, (chunk + 1) * chunk_size))
-                .to_dataframe()
-                .reset_index()
-                .pivot(index='time', columns='rivid', values='Qout')
-            )
-            qout = qout.groupby(qout.index.year).max()
-
-            qout_mean = np.nanmean(qout, axis=0)
-            qout_std = np.nanstd(qout, axis=0)
-
-            df = pd.concat([
-                df,
-                pd.DataFrame({
-                    'rivid': rivids,
-                    'qout_max': np.nanmax(qout, axis=0),
-                    'rp2': gumbel1(2, qout_mean, qout_std),
-                    'rp5': gumbel1(5, qout_mean, qout_std),
-                    'rp10': gumbel1(10, qout_mean, qout_std),
-                    'rp25': gumbel1(25, qout_mean, qout_std),
-                    'rp50': gumbel1(50, qout_mean, qout_std),
-                    'rp100': gumbel1(100, qout_mean, qout_std),
-                })
-            ], axis=0)
-
-    logging.info('Writing NetCDF')
-    os.makedirs(f'/Volumes/EB406_T7_2/geoglows2/return_periods/{vpu_number}', exist_ok=True)
-    # save to netcdf
+    annual_maxima_file = os.path.join(save_dir, f'annualmax_{vpu_number}.nc')
+    qout_files = glob.glob(os.path.join(vpu_dir, 'Qout*.nc*'))
+
+    annual_maxima = None
+    if update and os.path.exists(annual_maxima_file):
+        with xr.open_dataset(annual_maxima_file) as ds:
+            annual_maxima = ds['annual_max'].load()
+        last_year = int(annual_maxima['year'].max())
+        qout_files = [f for f in qout_files if (qout_file_end_year(f) or last_year) >= last_year]
+        logging.info(f'VPU {vpu_number}: updating annual maxima after {last_year} from {len(qout_files)} files')
+
+    if len(qout_files):
+        new_maxima = read_annual_maxima(qout_files, os.path.join(save_dir, 'partial'), memory_budget)
+        if annual_maxima is None:
+            annual_maxima = new_maxima
+        else:
+            # max is idempotent so years found in both are merged without double counting
+            annual_maxima = np.fmax(*xr.align(annual_maxima, new_maxima, join='outer'))
+
+    logging.info(f'VPU {vpu_number}: writing NetCDF')
+    os.makedirs(save_dir, exist_ok=True)
     (
-        xr
-        .Dataset(
-            coords={
-                'rivid': df.rivid.values,
-            },
-            data_vars={
-                'qout_max': ('rivid', df.qout_max.values),
-                'rp2': ('rivid', df.rp2.values.astype(float)),
-                'rp5': ('rivid', df.rp5.values.astype(float)),
-                'rp10': ('rivid', df.rp10.values.astype(float)),
-                'rp25': ('rivid', df.rp25.values.astype(float)),
-                'rp50': ('rivid', df.rp50.values.astype(float)),
-                'rp100': ('rivid', df.rp100.values.astype(float)),
-            },
-            attrs={
-                'description': 'Calculated using annual maximum flows and the Gumbel Type 1 distribution',
-                'author': 'Riley Hales, PhD',
-            },
-        )
-        .to_netcdf(os.path.join(f'/Volumes/EB406_T7_2/geoglows2/return_periods/{vpu_number}/returnperiods_{vpu_number}.nc'))
+        annual_maxima
+        .transpose('year', 'rivid')
+        .to_dataset(name='annual_max')
+        .assign_attrs({
+            'description': 'Maximum simulated flow in each calendar year',
+            'author': 'Riley Hales, PhD',
+        })
+        .to_netcdf(f'{annual_maxima_file}.tmp')
     )
+    os.replace(f'{annual_maxima_file}.tmp', annual_maxima_file)
+
+    output_file = os.path.join(save_dir, f'returnperiods_{vpu_number}.nc')
+    return_periods_dataset(annual_maxima['rivid'].values, annual_maxima.transpose('year', 'rivid').values) \
+        .to_netcdf(f'{output_file}.tmp')
+    os.replace(f'{output_file}.tmp', output_file)
+    shutil.rmtree(os.path.join(save_dir, 'partial'), ignore_errors=True)
+    return vpu_number
+
+
+def _calculate_vpu_return_periods(args: tuple) -> str:
+    # each worker reads its blocks serially so that the memory cap holds across the pool
+    with dask.config.set(scheduler='synchronous'):
+        return calculate_vpu_return_periods(*args)
+
+
+if __name__ == '__main__':
+    """
+    Calculate return periods for each VPU directory of Qout files
+
+    Usage:
+    python calculate_return_periods.py
+            --outputsdir /path/to/geoglows2/outputs
+            --returnperiodsdir /path/to/geoglows2/return_periods
+            --workers 8
+            --memory 64
+            --update
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--outputsdir', type=str, required=True,
+                        help='Path to the parent directory containing subdirectories of Qout files for each VPU', )
+    parser.add_argument('--returnperiodsdir', type=str, required=True,
+                        help='Path to save return periods with subdirectories for each VPU', )
+    parser.add_argument('--workers', type=int, required=False, default=1,
+                        help='Number of VPUs to process at the same time', )
+    parser.add_argument('--memory', type=float, required=False, default=4,
+                        help='Total GB of Qout held in memory at once, shared equally by the workers', )
+    parser.add_argument('--update', action='store_true', default=False,
+                        help='Add new years to the saved annual maxima and recalculate the return periods of every '
+                             'VPU instead of skipping VPUs that already have return periods', )
+
+    args = parser.parse_args()
+    memory_budget = int(args.memory * 1024 ** 3 / args.workers)
+
+    jobs = []
+    for vpu_dir in [d for d in sorted(glob.glob(os.path.join(args.outputsdir, '*'))) if os.path.isdir(d)]:
+        vpu_number = os.path.basename(vpu_dir)
+        save_dir = os.path.join(args.returnperiodsdir, vpu_number)
+
+        if not args.update and os.path.exists(os.path.join(save_dir, f'returnperiods_{vpu_number}.nc')):
+            logging.info(f'Skipping VPU {vpu_number}')
+            continue
+        jobs.append((vpu_dir, save_dir, memory_budget, args.update))
+
+    logging.info(f'Processing {len(jobs)} VPUs with {args.workers} workers')
+    with Pool(args.workers) as p:
+        for vpu_number in p.imap_unordered(_calculate_vpu_return_periods, jobs):
+            logging.info(f'Finished VPU {vpu_number}')
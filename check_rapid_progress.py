@@ -1,6 +1,169 @@
 import glob
 import os
 import argparse
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import netCDF4
+
+# the netcdf-c/hdf5 libraries are not thread safe so files which cannot be read directly are opened one at a time
+netcdf_lock = threading.Lock()
+
+
+def _read_classic_time_length(path: str) -> int or None:
+    """
+    Read the length of the time dimension from the header of a netCDF classic (CDF-1, CDF-2 or CDF-5) file
+
+    Args:
+        path: Path to the netCDF file
+
+    Returns:
+        The length of the time dimension, or None if the file is not a classic netCDF or has no time dimension
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+        if len(magic) < 4 or magic[:3] != b'CDF' or magic[3] not in (1, 2, 5):
+            return None
+        # CDF-5 uses 64 bit integers for sizes, the others 32 bit
+        int_format = '>q' if magic[3] == 5 else '>i'
+        int_size = struct.calcsize(int_format)
+
+        def read_int() -> int:
+            return struct.unpack(int_format, f.read(int_size))[0]
+
+        num_records = read_int()
+        tag = struct.unpack('>i', f.read(4))[0]
+        n_dims = read_int()
+        if tag != 0x0A:
+            return None
+        for _ in range(n_dims):
+            name_length = read_int()
+            name = f.read(name_length).decode()
+            f.read(-name_length % 4)
+            dim_length = read_int()
+            if name == 'time':
+                # a length of 0 marks the record dimension. -1 records means the file is still being streamed
+                if dim_length:
+                    return dim_length
+                return num_records if num_records >= 0 else None
+    return None
+
+
+def time_dimension_length(path: str) -> int:
+    """
+    Read the length of the time dimension of a netCDF file without reading any variables
+
+    Args:
+        path: Path to the netCDF file
+
+    Returns:
+        The length of the time dimension or 0 if the file cannot be read, e.g. because it is still being created
+    """
+    try:
+        length = _read_classic_time_length(path)
+        if length is not None:
+            return length
+        with netcdf_lock, netCDF4.Dataset(path) as ds:
+            return len(ds.dimensions['time'])
+    except Exception:
+        return 0
+
+
+def inflow_metadata(inflow_dir: str) -> dict:
+    """
+    Read the number of time steps in the inflow files of a VPU and the length of each time step
+
+    Args:
+        inflow_dir: Path to the directory of inflow files for a single VPU
+
+    Returns:
+        dict with the total number of time steps and the time step in seconds (None if it cannot be read)
+    """
+    inflow_files = sorted(glob.glob(os.path.join(inflow_dir, '*.nc')))
+    time_step = None
+    if inflow_files:
+        try:
+            with netcdf_lock, netCDF4.Dataset(inflow_files[0]) as ds:
+                time_step = float(ds['time_bnds'][0, 1] - ds['time_bnds'][0, 0])
+        except Exception:
+            pass
+    return {
+        'steps': sum(time_dimension_length(f) for f in inflow_files),
+        'time_step': time_step,
+    }
+
+
+def vpu_progress(outputdir: str, inflows: dict) -> dict:
+    """
+    Count the time steps written to the Qout files of a VPU
+
+    Args:
+        outputdir: Path to the directory of Qout files for a single VPU
+        inflows: The inflow_metadata of the same VPU
+
+    Returns:
+        dict with the VPU id, completed and total time steps, and the time step in seconds
+    """
+    return {
+        'watershed_id': os.path.basename(outputdir),
+        'done': sum(time_dimension_length(f) for f in glob.glob(os.path.join(outputdir, 'Qout*.nc'))),
+        'total': inflows['steps'],
+        'time_step': inflows['time_step'],
+    }
+
+
+def format_duration(seconds: float or None) -> str:
+    if seconds is None:
+        return 'unknown'
+    hours, remainder = divmod(int(seconds), 3600)
+    return f'{hours}h{remainder // 60:02d}m'
+
+
+def report(progress: list, first: dict = None, elapsed: float = None) -> None:
+    """
+    Print the progress of each VPU and the overall progress. In watch mode also print the simulated time per wall
+    second of each VPU since the first check and an estimated time remaining
+
+    Args:
+        progress: List of vpu_progress results
+        first: vpu_progress results from the first check in watch mode by watershed id
+        elapsed: Wall seconds since the first check in watch mode
+
+    Returns:
+        None
+    """
+    outputs_complete = 0
+    total_rate = 0
+    remaining_simulation = 0
+    for vpu in progress:
+        pct_complete = (vpu['done'] / vpu['total']) * 100 if vpu['total'] else 0
+        time_step = vpu['time_step'] or 1
+        message = f'{vpu["watershed_id"]}: {round(pct_complete, 1)}% ({vpu["done"]}/{vpu["total"]} steps)'
+
+        if pct_complete >= 100:
+            outputs_complete += 1
+            message = f'{vpu["watershed_id"]}: COMPLETE {round(pct_complete, 1)}%'
+        else:
+            remaining_simulation += (vpu['total'] - vpu['done']) * time_step
+
+        if first and elapsed and pct_complete < 100:
+            # simulated seconds per wall second since the first check
+            rate = (vpu['done'] - first.get(vpu['watershed_id'], vpu)['done']) * time_step / elapsed
+            total_rate += rate
+            eta = (vpu['total'] - vpu['done']) * time_step / rate if rate > 0 else None
+            unit = 'sim-s/s' if vpu['time_step'] else 'steps/s'
+            message += f' {round(rate, 1)} {unit} ETA {format_duration(eta)}'
+        print(message)
+
+    num_output_dirs = len(progress)
+    print(f'{outputs_complete} / {num_output_dirs} complete: '
+          f'{round((outputs_complete / max(num_output_dirs, 1)) * 100, 1)}%')
+    if first and elapsed:
+        # assumes the VPUs keep running with the same total throughput
+        eta = remaining_simulation / total_rate if total_rate > 0 else None
+        print(f'Global ETA: {format_duration(eta)}')
 
 
 if __name__ == '__main__':
@@ -11,6 +174,12 @@ if __name__ == '__main__':
     parser.add_argument('--outflowsdir', type=str, required=False,
                         default='/mnt/outputs',
                         help='Path to directory containing subdirectories of outflow files', )
+    parser.add_argument('--threads', type=int, required=False,
+                        default=32,
+                        help='Number of files to read at the same time', )
+    parser.add_argument('--watch', type=float, required=False,
+                        default=None,
+                        help='Check again every WATCH seconds and report throughput and estimated time remaining', )
 
     args = parser.parse_args()
     inflows_dir = args.inflowsdir
@@ -18,27 +187,25 @@ if __name__ == '__main__':
 
     outputdirs = sorted([d for d in glob.glob(os.path.join(outflows_dir, '*')) if os.path.isdir(d)])
 
-    num_output_dirs = len(outputdirs)
-    outputs_complete = 0
-
-    for outputdir in outputdirs:
-        # identify the watershed being checked
-        watershed_id = os.path.basename(outputdir)
+    with ThreadPoolExecutor(args.threads) as executor:
+        # the inflows do not change while RAPID runs so they are only read once
+        inflows = list(executor.map(
+            lambda d: inflow_metadata(os.path.join(inflows_dir, os.path.basename(d))), outputdirs
+        ))
 
-        # look for files in the output directory
-        qout_file = glob.glob(os.path.join(outputdir, 'Qout*.nc'))
-        qout_size = sum([os.path.getsize(x) for x in qout_file])
-
-        inflow_files = glob.glob(os.path.join(inflows_dir, watershed_id, '*.nc'))
-        inflow_size = sum([os.path.getsize(x) for x in inflow_files])
-        # calculate percent completed
-        pct_complete = (qout_size / inflow_size) * 100
-
-        if pct_complete >= 100:
-            outputs_complete += 1
-            print(f'{watershed_id}: COMPLETE {round(pct_complete, 1)}%')
-        else:
-            print(f'{watershed_id}: {round(pct_complete, 1)}%')
+        first_check = None
+        first_progress = None
+        while True:
+            progress = list(executor.map(vpu_progress, outputdirs, inflows))
+            now = time.time()
+            if first_check is None:
+                first_check = now
+                first_progress = {vpu['watershed_id']: vpu for vpu in progress}
 
-    print(f'{outputs_complete} / {num_output_dirs} complete: {round((outputs_complete / num_output_dirs) * 100, 1)}%')
+            if args.watch:
+                print(f'\n{time.strftime("%Y-%m-%d %X")}')
+            report(progress, first_progress if args.watch else None, now - first_check)
 
+            if not args.watch or all(vpu['done'] >= vpu['total'] for vpu in progress):
+                break
+            time.sleep(args.watch)
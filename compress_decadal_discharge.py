@@ -1,3 +1,4 @@
+import argparse
 import glob
 import logging
 import os
@@ -5,11 +6,8 @@ import sys
 
 import xarray as xr
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s %(message)s',
-    stream=sys.stdout,
-)
+from benchmark_codecs import netcdf_encoding, read_codec_profile
+from quantize import QUANTIZE_METHODS, log_report, quantization_report, quantize
 
 compression_options = {
     'zlib': True,
@@ -17,19 +15,39 @@ compression_options = {
     'shuffle': True,
 }
 
-for vpu_dir in sorted([d for d in glob.glob('/Volumes/EB406_T7_2/geoglows2/v2_retrospective_outputs/614*') if os.path.isdir(d)]):
+global_attributes = {
+    'author': 'Riley Hales, PhD',
+    'title': f'GEOGloWS v2 Retrospective Discharge',
+    'institution': 'Group on Earth Observations Global Water Sustainability Program',
+    'source': 'GEOGloWS Hydrologic Model v2',
+    'history': 'Created 2023-10-18',
+    'references': 'https://geoglows.ecmwf.int/',
+}
+
+
+def compress_vpu_decades(vpu_dir: str,
+                         codec_profile: dict = None,
+                         quantize_method: str = 'none',
+                         keepbits: int = 12,
+                         quantize_variables: list = ('Qout',),
+                         report_file: str = None, ) -> None:
+    """
+    Combine the yearly Qout files of a VPU into 1 compressed netCDF4 file per decade and remove the yearly files
+
+    Args:
+        vpu_dir: Directory of Qout files for a VPU
+        codec_profile: A codec profile from benchmark_codecs.py. If None, every variable uses zlib 9 with shuffle
+        quantize_method: none, bitround, int16 or int32. See quantize.py
+        keepbits: Mantissa bits kept by bitround
+        quantize_variables: Names of the variables to quantize
+        report_file: Path to append the quantization error of each file to as json lines
+
+    Returns:
+        None
+    """
     vpu_number = os.path.basename(vpu_dir)
     logging.info(f'Processing VPU {vpu_number}')
 
-    global_attributes = {
-        'author': 'Riley Hales, PhD',
-        'title': f'GEOGloWS v2 Retrospective Discharge',
-        'institution': 'Group on Earth Observations Global Water Sustainability Program',
-        'source': 'GEOGloWS Hydrologic Model v2',
-        'history': 'Created 2023-10-18',
-        'references': 'https://geoglows.ecmwf.int/',
-    }
-
     for decade in range(1940, 2020, 10):
         logging.info(f'Processing decade {decade}')
         start_date = str(decade) + '0101'
@@ -42,24 +60,79 @@ for vpu_dir in sorted([d for d in glob.glob('/Volumes/EB406_T7_2/geoglows2/v2_re
 
         # open the dataset and save it to a netcdf 4 format file with high compression
         qout_files = glob.glob(os.path.join(vpu_dir, f'Qout_*_{str(decade)[:3]}*.nc'))
+        if not qout_files:
+            continue
         with xr.open_mfdataset(qout_files) as ds:
             ds.attrs = global_attributes
-            (
-                ds
+            encoding = netcdf_encoding(
+                codec_profile,
+                [v for v in ('Qout', 'rivid', 'lat', 'lon', 'time', 'Qout_err') if v in ds.variables],
+                compression_options,
+            )
+            quantized, quantize_encoding = quantize(ds, quantize_variables, quantize_method, keepbits)
+            for var, params in quantize_encoding.items():
+                encoding.setdefault(var, {}).update(params)
+            write = (
+                quantized
                 .to_netcdf(
                     out_file_path,
                     format='NETCDF4',
-                    encoding={
-                        'Qout': compression_options,
-                        'rivid': compression_options,
-                        'lat': compression_options,
-                        'lon': compression_options,
-                        'time': compression_options,
-                        'Qout_err': compression_options,
-                    },
+                    encoding=encoding,
+                    compute=False,
                 )
             )
+            if quantize_method == 'none':
+                write.compute()
+            else:
+                log_report(quantization_report(ds, quantized, quantize_variables, write), out_file_path, report_file)
 
             # remove the original files
             for f in qout_files:
                 os.remove(f)
+    return
+
+
+if __name__ == '__main__':
+    """
+    Combine yearly retrospective Qout files into 1 compressed netCDF4 file per decade for each VPU
+
+    Arguments:
+    --outputsdir: Directory containing subdirectories of Qout files for each VPU
+    --vpus: Glob pattern of the VPU directories to process
+    --codecprofile: Codec profile from benchmark_codecs.py. Defaults to zlib 9 with shuffle for every variable
+    --quantize: none, bitround, int16, or int32
+    --keepbits: Mantissa bits kept by --quantize bitround
+    --quantizevars: Variables to quantize
+    --quantizereport: Path to append the quantization error of each file to as json lines
+
+    Usage:
+    python compress_decadal_discharge.py --outputsdir /mnt/outputs --codecprofile codecs.json
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--outputsdir', type=str, required=False,
+                        default='/Volumes/EB406_T7_2/geoglows2/v2_retrospective_outputs',
+                        help='Directory containing subdirectories of Qout files for each VPU')
+    parser.add_argument('--vpus', type=str, required=False, default='*',
+                        help='Glob pattern of the VPU directories to process')
+    parser.add_argument('--codecprofile', type=str, required=False, default=None,
+                        help='Codec profile from benchmark_codecs.py')
+    parser.add_argument('--quantize', type=str, required=False, default='none', choices=QUANTIZE_METHODS,
+                        help='Round to significant bits or pack as integers before compressing')
+    parser.add_argument('--keepbits', type=int, required=False, default=12,
+                        help='Mantissa bits kept by --quantize bitround')
+    parser.add_argument('--quantizevars', type=str, nargs='+', required=False, default=['Qout'],
+                        help='Variables to quantize')
+    parser.add_argument('--quantizereport', type=str, required=False, default=None,
+                        help='Path to append the quantization error of each file to as json lines')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(message)s',
+        stream=sys.stdout,
+    )
+
+    profile = read_codec_profile(args.codecprofile)
+    for vpu_directory in sorted([d for d in glob.glob(os.path.join(args.outputsdir, args.vpus)) if os.path.isdir(d)]):
+        compress_vpu_decades(vpu_directory, profile, args.quantize, args.keepbits, args.quantizevars,
+                             args.quantizereport)
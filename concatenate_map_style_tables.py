@@ -1,21 +1,135 @@
 import argparse
 import logging
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import glob
 import os
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as pa_ds
+import pyarrow.ipc as pa_ipc
+import pyarrow.parquet as pq
+
+
+def write_pandas(parquet_files: list, savedir: str) -> None:
+    """
+    Write 1 CSV per time step by reading every VPU table into a single pandas DataFrame
+
+    Args:
+        parquet_files: Paths to the map_style_table parquet files of each VPU
+        savedir: Directory for saving the CSV for each time step
+
+    Returns:
+        None
+    """
+    logging.info('Concatenating parquet map_style_tables from each VPU')
+    global_map_style_df = pd.concat([pd.read_parquet(x) for x in parquet_files])
+
+    # replace nans with 0
+    logging.info('Preparing concatenated DF')
+    global_map_style_df.fillna(0, inplace=True)
+    global_map_style_df.set_index('timestamp', inplace=True)
+
+    # for each unique date in the timestamp column, create a new dataframe and write it to csv
+    for idx, date in enumerate(global_map_style_df.index.unique()):
+        file_save_path = os.path.join(savedir, f'mapstyletable_{date.strftime("%Y-%m-%d-%H")}.csv')
+        logging.info(f'Writing map_style_table for {date}')
+        logging.debug(f'Saving to {file_save_path}')
+        (
+            global_map_style_df
+            .loc[date]
+            .to_csv(
+                file_save_path,
+                index=False
+            )
+        )
+    return
+
+
+def float_strings(column: pa.Array) -> pa.Array:
+    """Format floats like pandas to_csv, which writes integral values as 12.0 where arrow writes 12"""
+    strings = pc.cast(column, pa.string())
+    integral = pc.match_substring_regex(strings, r'^-?\d+$')
+    return pc.if_else(integral, pc.binary_join_element_wise(strings, '.0', ''), strings)
+
+
+def write_arrow(parquet_files: list, savedir: str, file_format: str = 'csv', workers: int = os.cpu_count()) -> None:
+    """
+    Write 1 file per time step by streaming the rows of each timestamp from the VPU tables as an arrow dataset
+
+    Only the timestamp column is read in full. The rows of each time step are then read with a filter on the dataset
+    and streamed in record batches through a single writer for that file, so no more than 1 time step per worker is
+    held in memory. The files are written in a thread pool since arrow releases the GIL while reading and writing.
+
+    Args:
+        parquet_files: Paths to the map_style_table parquet files of each VPU
+        savedir: Directory for saving the file for each time step
+        file_format: One of csv, parquet, or feather
+        workers: Number of files to write at the same time
+
+    Returns:
+        None
+    """
+    logging.info('Reading timestamps of the parquet map_style_tables from each VPU')
+    dataset = pa_ds.dataset(parquet_files, format='parquet')
+    timestamps = pc.unique(dataset.to_table(columns=['timestamp'])['timestamp'].combine_chunks()).sort()
+    columns = [name for name in dataset.schema.names if name != 'timestamp']
+
+    def prepare(batch: pa.RecordBatch) -> pa.RecordBatch:
+        # replace nulls and nans with 0 like the pandas engine
+        arrays = []
+        for name in columns:
+            array = pc.fill_null(batch[name], 0)
+            if pa.types.is_floating(array.type):
+                array = pc.if_else(pc.is_nan(array), 0, array)
+                array = float_strings(array) if file_format == 'csv' else array
+            arrays.append(array)
+        return pa.RecordBatch.from_arrays(arrays, names=columns)
+
+    schema = prepare(pa.RecordBatch.from_pylist([], schema=dataset.schema)).schema
+
+    def open_writer(sink: pa.NativeFile):
+        if file_format == 'parquet':
+            return pq.ParquetWriter(sink, schema)
+        if file_format == 'feather':
+            # feather v2 is the arrow ipc file format, compressed with lz4 like feather.write_feather
+            return pa_ipc.new_file(sink, schema, options=pa_ipc.IpcWriteOptions(compression='lz4'))
+        # an unquoted header like pandas writes. arrow quotes header names unless told otherwise
+        sink.write((','.join(columns) + '\n').encode())
+        return pa_csv.CSVWriter(sink, schema,
+                                write_options=pa_csv.WriteOptions(include_header=False, quoting_style='none'))
+
+    def write_time_step(timestamp: pa.Scalar) -> None:
+        date = pd.Timestamp(timestamp.as_py())
+        file_save_path = os.path.join(savedir, f'mapstyletable_{date.strftime("%Y-%m-%d-%H")}.{file_format}')
+        logging.info(f'Writing map_style_table for {date}')
+        logging.debug(f'Saving to {file_save_path}')
+        batches = dataset.to_batches(columns=columns, filter=pc.field('timestamp') == timestamp)
+        with pa.OSFile(file_save_path, 'wb') as sink, open_writer(sink) as writer:
+            for batch in batches:
+                writer.write_batch(prepare(batch))
+
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(write_time_step, timestamps))
+    return
+
 
 if __name__ == '__main__':
     """
     Combines the map_style_tables from each VPU into 1 CSV file per time step with rows from all VPUs
-    
+
     Arguments:
     --date: Date string of forecast in YYYYMMDD format
     --outputsdir: Path to the parent directory containing subdirectories for each VPU
     --savedir: Directory for saving map_style_tables (should be called map_style_tables)
-    
+    --engine: arrow (default) streams each time step from the tables in parallel, pandas uses a single DataFrame
+    --format: csv (default), parquet or feather. The pandas engine only writes csv
+    --workers: Number of files written at the same time by the arrow engine
+
     Usage:
     python concatenate_map_style_tables.py
             --date 20230927
@@ -29,11 +143,17 @@ if __name__ == '__main__':
                         help='Path to the parent directory containing subdirectories for each VPU')
     parser.add_argument('--savedir', type=str, required=True,
                         help='Directory for saving map_style_tables with subdirectories for each forecast date')
+    parser.add_argument('--engine', type=str, required=False, default='arrow', choices=['arrow', 'pandas'],
+                        help='Read the tables as an arrow dataset or as a single pandas DataFrame')
+    parser.add_argument('--format', type=str, required=False, default='csv', choices=['csv', 'parquet', 'feather'],
+                        help='File format for each time step. The pandas engine only writes csv')
+    parser.add_argument('--workers', type=int, required=False, default=os.cpu_count(),
+                        help='Number of files written at the same time by the arrow engine')
 
     args = parser.parse_args()
     date_string = args.date
     outputsdir = args.outputsdir
-    savedir = args.output
+    savedir = args.savedir
 
     logging.basicConfig(level=logging.DEBUG,
                         format='%(asctime)s %(levelname)s %(message)s',
@@ -43,30 +163,16 @@ if __name__ == '__main__':
     logging.debug(f'Arg --outputsdir: {outputsdir}')
     logging.debug(f'Arg --savedir: {savedir}')
 
-    # select all outputs/VPUNUMBER/DATE/map_style_table*.parquet files
-    logging.info('Concatenating parquet map_style_tables from each VPU')
-    global_map_style_df = pd.concat([
-        pd.read_parquet(x) for x in glob.glob(os.path.join(outputsdir, '*', date_string, 'map_style_table*.parquet'))
-    ])
+    if args.engine == 'pandas' and args.format != 'csv':
+        parser.error('The pandas engine only writes csv')
 
-    # replace nans with 0
-    logging.info('Preparing concatenated DF')
-    global_map_style_df.fillna(0, inplace=True)
-    global_map_style_df.set_index('timestamp', inplace=True)
+    # select all outputs/VPUNUMBER/DATE/map_style_table*.parquet files
+    parquet_files = glob.glob(os.path.join(outputsdir, '*', date_string, 'map_style_table*.parquet'))
 
-    # for each unique date in the timestamp column, create a new dataframe and write it to csv
     savedir = os.path.join(str(savedir), date_string)
     os.makedirs(savedir, exist_ok=True)
 
-    for idx, date in enumerate(global_map_style_df.index.unique()):
-        file_save_path = os.path.join(savedir, f'mapstyletable_{date.strftime("%Y-%m-%d-%H")}.csv')
-        logging.info(f'Writing map_style_table for {date}')
-        logging.debug(f'Saving to {file_save_path}')
-        (
-            global_map_style_df
-            .loc[date]
-            .to_csv(
-                file_save_path,
-                index=False
-            )
-        )
+    if args.engine == 'pandas':
+        write_pandas(parquet_files, savedir)
+    else:
+        write_arrow(parquet_files, savedir, args.format, args.workers)
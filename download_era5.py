@@ -1,15 +1,43 @@
 # conda install -c conda-forge cdsapi
 
-import cdsapi
+import argparse
 import calendar
+import datetime
+import hashlib
+import importlib
+import json
+import logging
+import os
+import random
+import struct
+import sys
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-c = cdsapi.Client()
+NETCDF_MAGIC = (b'CDF\x01', b'CDF\x02', b'CDF\x05', b'\x89HDF\r\n\x1a\n')
+ZIP_MAGIC = b'PK\x03\x04'
+# bytes per value of each classic netCDF nc_type
+NC_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 4, 6: 8, 7: 1, 8: 2, 9: 4, 10: 8, 11: 8}
 
-for year in range(1950, 2023):
-    for month in range(1, 13):
-        c.retrieve(
-            'reanalysis-era5-land',
-            {
+
+def era5_land_tasks(first_year: int = 1950, last_year: int = 2022, savedir: str = '.') -> list:
+    """
+    Monthly requests for hourly ERA5-Land runoff as zipped netCDF
+
+    Args:
+        first_year: First year to download
+        last_year: Last year to download, inclusive
+        savedir: Directory to save the downloads
+
+    Returns:
+        list of dicts with the dataset name, request, and target path of each download
+    """
+    return [
+        {
+            'dataset': 'reanalysis-era5-land',
+            'request': {
                 'format': 'netcdf.zip',
                 'variable': 'runoff',
                 'year': year,
@@ -17,20 +45,377 @@ for year in range(1950, 2023):
                 'day': [str(x).zfill(2) for x in range(1, calendar.monthrange(year, month)[1] + 1)],
                 'time': [f'{x:02d}:00' for x in range(0, 24)],
             },
-            target=f'{year}_{str(month).zfill(2)}_era5land_hourly.netcdf.zip'
-        )
+            'target': os.path.join(savedir, f'{year}_{str(month).zfill(2)}_era5land_hourly.netcdf.zip'),
+        }
+        for year in range(first_year, last_year + 1) for month in range(1, 13)
+    ]
 
-for year in range(1940, 2024):
-    c.retrieve(
-        'reanalysis-era5-single-levels',
+
+def era5_tasks(first_year: int = 1940, last_year: int = 2023, savedir: str = '.') -> list:
+    """
+    Yearly requests for hourly ERA5 runoff as netCDF
+
+    Args:
+        first_year: First year to download
+        last_year: Last year to download, inclusive
+        savedir: Directory to save the downloads
+
+    Returns:
+        list of dicts with the dataset name, request, and target path of each download
+    """
+    return [
         {
-            'product_type': 'reanalysis',
-            'format': 'netcdf',
-            'variable': 'runoff',
-            'year': year,
-            'month': [str(x).zfill(2) for x in range(1, 13)],
-            'day': [str(x).zfill(2) for x in range(1, 32)],
-            'time': [f'{x:02d}:00' for x in range(0, 24)],
-        },
-        target=f'{year}_era5_hourly.nc'
+            'dataset': 'reanalysis-era5-single-levels',
+            'request': {
+                'product_type': 'reanalysis',
+                'format': 'netcdf',
+                'variable': 'runoff',
+                'year': year,
+                'month': [str(x).zfill(2) for x in range(1, 13)],
+                'day': [str(x).zfill(2) for x in range(1, 32)],
+                'time': [f'{x:02d}:00' for x in range(0, 24)],
+            },
+            'target': os.path.join(savedir, f'{year}_era5_hourly.nc'),
+        }
+        for year in range(first_year, last_year + 1)
+    ]
+
+
+def file_checksum(path: str, block_size: int = 2 ** 20) -> str:
+    """sha256 hex digest of a file, read in blocks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _classic_netcdf_length(f) -> int:
+    """
+    Minimum length of a classic, 64-bit offset, or CDF-5 netCDF file from the variable extents in its header
+
+    Args:
+        f: The file opened in binary mode
+
+    Returns:
+        int: bytes the file needs to hold every variable, or -1 if the header says the file was not finished
+    """
+    f.seek(3)
+    version = f.read(1)[0]
+    # CDF-5 uses 64 bit counts and sizes, 64-bit offset and CDF-5 use 64 bit variable offsets
+    count = '>Q' if version == 5 else '>I'
+    offset = '>I' if version == 1 else '>Q'
+
+    def read(fmt: str) -> int:
+        return struct.unpack(fmt, f.read(struct.calcsize(fmt)))[0]
+
+    def skip_name() -> None:
+        length = read(count)
+        f.seek(-length % 4 + length, 1)
+
+    def skip_attributes() -> None:
+        read('>I')
+        for _ in range(read(count)):
+            skip_name()
+            nc_type = read('>I')
+            length = read(count) * NC_TYPE_SIZES[nc_type]
+            f.seek(-length % 4 + length, 1)
+
+    numrecs = read(count)
+    if numrecs == struct.unpack(count, b'\xff' * struct.calcsize(count))[0]:
+        return -1
+    read('>I')
+    dims = []
+    for _ in range(read(count)):
+        skip_name()
+        dims.append(read(count))
+    skip_attributes()
+    read('>I')
+    variables = []
+    for _ in range(read(count)):
+        skip_name()
+        dimids = [read(count) for _ in range(read(count))]
+        skip_attributes()
+        nc_type = read('>I')
+        vsize = read(count)
+        begin = read(offset)
+        is_record = bool(dimids) and dims[dimids[0]] == 0
+        values = 1
+        for dimid in dimids[1 if is_record else 0:]:
+            values *= dims[dimid]
+        variables.append((is_record, begin, vsize, values * NC_TYPE_SIZES[nc_type]))
+
+    records = [v for v in variables if v[0]]
+    # a single record variable is not padded between records
+    record_size = records[0][3] if len(records) == 1 else sum(v[2] for v in records)
+    return max(
+        [begin + size for is_record, begin, _, size in variables if not is_record] +
+        [begin + max(numrecs - 1, 0) * record_size + size * (numrecs > 0) for is_record, begin, _, size in records] +
+        [0, ]
+    )
+
+
+def _hdf5_length(f) -> int:
+    """
+    Length of a netCDF4/HDF5 file from the end of file address in its superblock
+
+    Args:
+        f: The file opened in binary mode
+
+    Returns:
+        int: bytes in the complete file
+    """
+    f.seek(8)
+    version = f.read(1)[0]
+    if version in (0, 1):
+        f.seek(13)
+        size_of_offsets = f.read(1)[0]
+        f.seek(24 if version == 0 else 28)
+    else:
+        size_of_offsets = f.read(1)[0]
+        f.seek(12)
+    fmt = {4: 'I', 8: 'Q'}[size_of_offsets]
+    base, _, end_of_file = struct.unpack(f'<{fmt * 3}', f.read(3 * size_of_offsets))
+    return base + end_of_file
+
+
+def verify_target(path: str, size: int = None, sha256: str = None) -> bool:
+    """
+    Check that a downloaded file is a complete zip or netCDF file
+
+    Zip files are checked with the CRC of every member. NetCDF files, which usually still open when truncated, are
+    checked against the length their header says they need. When the size and checksum recorded at download are given,
+    those must match as well.
+
+    Args:
+        path: Path to the downloaded file
+        size: Size of the file when it was downloaded
+        sha256: sha256 hex digest of the file when it was downloaded
+
+    Returns:
+        True if the file looks complete
+    """
+    try:
+        file_size = os.path.getsize(path)
+        if size is not None and file_size != size:
+            return False
+        with open(path, 'rb') as f:
+            magic = f.read(8)
+            if magic.startswith(ZIP_MAGIC):
+                with zipfile.ZipFile(path) as z:
+                    complete = bool(z.namelist()) and z.testzip() is None
+            elif path.endswith('.zip') or not any(magic.startswith(m) for m in NETCDF_MAGIC):
+                return False
+            elif magic.startswith(b'CDF'):
+                complete = 0 <= _classic_netcdf_length(f) <= file_size
+            else:
+                complete = _hdf5_length(f) <= file_size
+        return complete and (sha256 is None or file_checksum(path) == sha256)
+    except (OSError, zipfile.BadZipFile, struct.error, KeyError, IndexError):
+        return False
+
+
+def reset_converted(state_file: str) -> None:
+    """Mark every converted target as only downloaded, e.g. when the store they were converted into is replaced"""
+    state = read_state(state_file)
+    for entry in state.values():
+        if entry.get('status') == 'converted':
+            entry['status'] = 'complete'
+    if state:
+        with open(f'{state_file}.tmp', 'w') as f:
+            json.dump(state, f, indent=1)
+        os.replace(f'{state_file}.tmp', state_file)
+
+
+def load_client_factory(spec: str = None):
+    """
+    Find the class or function which creates a client with a cdsapi style retrieve(dataset, request, target) method
+
+    Args:
+        spec: module:name of the factory, e.g. mymodule:Client. None uses cdsapi.Client
+
+    Returns:
+        The factory
+    """
+    if spec is None:
+        # imported here so the manager can run with another client when cdsapi is not installed
+        import cdsapi
+        return cdsapi.Client
+    module, name = spec.split(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def read_state(state_file: str) -> dict:
+    if state_file and os.path.exists(state_file):
+        with open(state_file) as f:
+            return json.load(f)
+    return {}
+
+
+def download_all(tasks: list,
+                 client_factory,
+                 state_file: str,
+                 workers: int = 4,
+                 retries: int = 5,
+                 backoff: float = 60,
+                 on_complete=None, ) -> dict:
+    """
+    Download every task with a number of requests in flight at the same time
+
+    Each download is written to a .part file and renamed to the target once it is verified, so a target only exists
+    if it is complete. Failed requests are retried after exponentially increasing waits. The state of each target,
+    with its size and sha256 checksum, is saved to a json file after every change so an interrupted run continues
+    where it stopped. Targets which already exist are verified against the state instead of downloaded again. Targets
+    are marked converted once on_complete succeeds and on_complete is not called for them again.
+
+    Args:
+        tasks: List of dicts with the dataset, request, and target of each download
+        client_factory: Called with no arguments to create a client in each worker thread
+        state_file: Path to the json file of the state of each target
+        workers: Number of requests in flight at the same time
+        retries: Number of times a request is retried after it fails
+        backoff: Seconds to wait before the first retry. Each retry waits twice as long as the one before
+        on_complete: Called with the task in the worker thread after its target is verified, including targets that
+            were already downloaded but not yet converted
+
+    Returns:
+        dict of the state of each target
+    """
+    state = read_state(state_file)
+    state_lock = threading.Lock()
+    local = threading.local()
+
+    def update_state(target: str, **values) -> None:
+        with state_lock:
+            state.setdefault(target, {}).update(values, updated=datetime.datetime.utcnow().isoformat())
+            if state_file:
+                with open(f'{state_file}.tmp', 'w') as f:
+                    json.dump(state, f, indent=1)
+                os.replace(f'{state_file}.tmp', state_file)
+
+    def download(task: dict) -> dict:
+        target = task['target']
+        if os.path.exists(target):
+            entry = state.get(target, {})
+            if verify_target(target, entry.get('size'), entry.get('sha256')):
+                if entry.get('status') not in ('complete', 'converted') or 'sha256' not in entry:
+                    # e.g. downloaded before the state file was kept, checked by its header only
+                    update_state(target, status='complete', size=os.path.getsize(target),
+                                 sha256=file_checksum(target))
+                if entry.get('status') == 'converted':
+                    logging.info(f'Skipping converted {target}')
+                    return task
+                logging.info(f'Skipping existing {target}')
+                if on_complete is not None:
+                    on_complete(task)
+                    update_state(target, status='converted')
+                return task
+            logging.warning(f'Removing incomplete {target}')
+            os.remove(target)
+
+        if not hasattr(local, 'client'):
+            local.client = client_factory()
+        part = f'{target}.part'
+        for attempt in range(retries + 1):
+            try:
+                update_state(target, status='downloading', attempts=attempt + 1)
+                logging.info(f'Requesting {target} (attempt {attempt + 1})')
+                local.client.retrieve(task['dataset'], task['request'], part)
+                if not verify_target(part):
+                    raise ValueError(f'{part} is not a complete zip or netCDF file')
+                checksum = file_checksum(part)
+                os.replace(part, target)
+                update_state(target, status='complete', size=os.path.getsize(target), sha256=checksum, error=None)
+                logging.info(f'Downloaded {target}')
+                break
+            except Exception as e:
+                update_state(target, status='failed', error=str(e))
+                if os.path.exists(part):
+                    os.remove(part)
+                if attempt == retries:
+                    raise
+                # jitter keeps the workers from retrying at the same moment
+                wait = backoff * 2 ** attempt * random.uniform(0.8, 1.2)
+                logging.warning(f'Failed to download {target}: {e}. Retrying in {round(wait)} seconds')
+                time.sleep(wait)
+
+        # outside of the retry loop so a failure processing the file does not download it again
+        if on_complete is not None:
+            on_complete(task)
+            update_state(target, status='converted')
+        return task
+
+    with ThreadPoolExecutor(workers) as executor:
+        futures = {executor.submit(download, task): task for task in tasks}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f'Giving up on {futures[future]["target"]}: {e}')
+    return state
+
+
+if __name__ == '__main__':
+    """
+    Download hourly ERA5 and ERA5-Land runoff from the Copernicus Climate Data Store
+
+    Arguments:
+    --savedir: Directory to save the downloads
+    --dataset: era5, era5-land, or both
+    --startyear: First year to download. Defaults to 1940 for ERA5 and 1950 for ERA5-Land
+    --endyear: Last year to download. Defaults to 2023 for ERA5 and 2022 for ERA5-Land
+    --workers: Number of requests in flight at the same time
+    --retries: Number of times a failed request is retried
+    --backoff: Seconds to wait before the first retry, doubled for each retry after it
+    --statefile: Path to the json file recording the state of each download. Defaults to download_state.json in savedir
+    --client: module:name of a client factory to use instead of cdsapi.Client
+
+    Usage:
+    python download_era5.py --savedir /mnt/era5 --dataset era5 --workers 8
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--savedir', type=str, required=False, default='.',
+                        help='Directory to save the downloads')
+    parser.add_argument('--dataset', type=str, required=False, default='both', choices=['era5', 'era5-land', 'both'],
+                        help='Which ERA5 dataset to download')
+    parser.add_argument('--startyear', type=int, required=False, default=None,
+                        help='First year to download')
+    parser.add_argument('--endyear', type=int, required=False, default=None,
+                        help='Last year to download')
+    parser.add_argument('--workers', type=int, required=False, default=4,
+                        help='Number of requests in flight at the same time')
+    parser.add_argument('--retries', type=int, required=False, default=5,
+                        help='Number of times a failed request is retried')
+    parser.add_argument('--backoff', type=float, required=False, default=60,
+                        help='Seconds to wait before the first retry, doubled for each retry after it')
+    parser.add_argument('--statefile', type=str, required=False, default=None,
+                        help='Path to the json file recording the state of each download')
+    parser.add_argument('--client', type=str, required=False, default=None,
+                        help='module:name of a client factory to use instead of cdsapi.Client')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        stream=sys.stdout)
+
+    os.makedirs(args.savedir, exist_ok=True)
+    years = {k: v for k, v in (('first_year', args.startyear), ('last_year', args.endyear)) if v is not None}
+    download_tasks = []
+    if args.dataset in ('era5-land', 'both'):
+        download_tasks += era5_land_tasks(**years, savedir=args.savedir)
+    if args.dataset in ('era5', 'both'):
+        download_tasks += era5_tasks(**years, savedir=args.savedir)
+
+    final_state = download_all(
+        download_tasks,
+        client_factory=load_client_factory(args.client),
+        state_file=args.statefile or os.path.join(args.savedir, 'download_state.json'),
+        workers=args.workers,
+        retries=args.retries,
+        backoff=args.backoff,
     )
+    failed = [t['target'] for t in download_tasks
+              if final_state.get(t['target'], {}).get('status') not in ('complete', 'converted')]
+    logging.info(f'{len(download_tasks) - len(failed)} / {len(download_tasks)} downloads complete')
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,274 @@
+import argparse
+import glob
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import dask
+import dask.array
+import natsort
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+from numcodecs import Blosc
+
+import download_era5
+
+# one day of hourly time steps per chunk so that each monthly or yearly download fills whole chunks
+TIME_CHUNK = 24
+RUNOFF_VARIABLE = 'ro'
+
+store_lock = threading.Lock()
+
+
+def collapse_expver(ds: xr.Dataset) -> xr.Dataset:
+    """
+    Combine the ERA5 (expver=1) and ERA5T (expver=5) values of recent ERA5 downloads into a single time series
+
+    Each time step only has values for one expver so the expvers are merged with combine_first in order. Downloads in
+    the newer CDS format have an expver coordinate along the time dimension instead, which is dropped.
+
+    Args:
+        ds: The ERA5 dataset
+
+    Returns:
+        xr.Dataset without an expver dimension
+    """
+    if 'expver' in ds.dims:
+        collapsed = ds.isel(expver=0, drop=True)
+        for i in range(1, ds.sizes['expver']):
+            collapsed = collapsed.combine_first(ds.isel(expver=i, drop=True))
+        return collapsed
+    if 'expver' in ds.variables:
+        return ds.drop_vars('expver')
+    return ds
+
+
+def normalize_era5(ds: xr.Dataset) -> xr.Dataset:
+    """
+    Make ERA5 downloads from the old and new CDS consistent: a time dimension, no expver, and only the runoff
+    """
+    if 'valid_time' in ds.dims:
+        ds = ds.rename({'valid_time': 'time'})
+    ds = collapse_expver(ds)
+    return ds[[RUNOFF_VARIABLE]].drop_vars([c for c in ds.coords if c not in ('time', 'latitude', 'longitude')])
+
+
+def open_download(path: str, tmpdir: str = None):
+    """
+    Iterate over the netCDF datasets in a download, which is either a netCDF file or a zip of netCDF files
+
+    Zip members are streamed to a temporary file one at a time since the netCDF libraries need a file on disk. The
+    temporary file is deleted after the dataset is used.
+
+    Args:
+        path: Path to the downloaded file
+        tmpdir: Directory for temporary files
+
+    Yields:
+        xr.Dataset of each netCDF file
+    """
+    if not zipfile.is_zipfile(path):
+        with xr.open_dataset(path) as ds:
+            yield ds
+        return
+    with zipfile.ZipFile(path) as z:
+        for member in natsort.natsorted(m for m in z.namelist() if m.endswith('.nc')):
+            with tempfile.NamedTemporaryFile(suffix='.nc', dir=tmpdir) as tmp:
+                with z.open(member) as source:
+                    shutil.copyfileobj(source, tmp, length=16 * 1024 ** 2)
+                tmp.flush()
+                with xr.open_dataset(tmp.name) as ds:
+                    yield ds
+
+
+def create_store(store: str, template: xr.Dataset, start: str, end: str, spatial_chunk: int = 180) -> None:
+    """
+    Write the metadata and coordinates of a Zarr store covering every hour from start to end without writing any
+    runoff values. Downloads then fill their own time range of the store independently.
+
+    Args:
+        store: Path to the Zarr store
+        template: A normalized ERA5 dataset with the grid of the downloads
+        start: First hour of the store, e.g. 1940-01-01
+        end: Last day of the store, e.g. 2023-12-31. The store ends at 23:00 of this day
+        spatial_chunk: Chunk size of the latitude and longitude dimensions
+
+    Returns:
+        None
+    """
+    times = pd.date_range(pd.Timestamp(start).floor('D'), pd.Timestamp(end).floor('D') + pd.Timedelta(hours=23),
+                          freq='h')
+    lat_name, lon_name = [d for d in template[RUNOFF_VARIABLE].dims if d != 'time']
+    shape = (times.size, template.sizes[lat_name], template.sizes[lon_name])
+    chunks = (TIME_CHUNK, min(spatial_chunk, shape[1]), min(spatial_chunk, shape[2]))
+    skeleton = xr.Dataset(
+        {
+            RUNOFF_VARIABLE: (
+                ('time', lat_name, lon_name),
+                dask.array.full(shape, np.nan, dtype='float32', chunks=chunks),
+                template[RUNOFF_VARIABLE].attrs,
+            ),
+        },
+        coords={
+            'time': times,
+            lat_name: template[lat_name].values,
+            lon_name: template[lon_name].values,
+        },
+        attrs=template.attrs,
+    )
+    skeleton.to_zarr(
+        store,
+        mode='w-',
+        compute=False,
+        consolidated=True,
+        encoding={
+            RUNOFF_VARIABLE: {'compressor': Blosc(cname='zstd', clevel=3, shuffle=Blosc.SHUFFLE), 'chunks': chunks},
+            'time': {'units': 'hours since 1900-01-01 00:00:00', 'dtype': 'int64'},
+        },
+    )
+    return
+
+
+def write_to_store(ds: xr.Dataset, store: str) -> slice:
+    """
+    Write the runoff of a normalized ERA5 dataset into its time range of an existing store
+
+    Args:
+        ds: The normalized dataset
+        store: Path to the Zarr store made with create_store
+
+    Returns:
+        slice of the time indexes written
+    """
+    store_times = xr.open_zarr(store, consolidated=True)['time'].to_index()
+    times = ds['time'].to_index()
+    start = store_times.get_loc(times[0])
+    region = slice(start, start + times.size)
+    if not store_times[region].equals(times):
+        raise ValueError(f'The time steps from {times[0]} to {times[-1]} are not hourly or not within the store')
+    if start % TIME_CHUNK or (region.stop % TIME_CHUNK and region.stop != store_times.size):
+        # partial chunks would be written by more than one download at the same time
+        raise ValueError(f'The time steps from {times[0]} to {times[-1]} do not start and end on whole days')
+
+    z = zarr.open_consolidated(store, mode='r')
+    chunks = dict(zip(ds[RUNOFF_VARIABLE].dims, z[RUNOFF_VARIABLE].chunks))
+    runoff = ds[[RUNOFF_VARIABLE]].drop_vars(list(ds.coords)).astype('float32').chunk(chunks)
+    runoff[RUNOFF_VARIABLE].encoding = {}
+    runoff.attrs = {}
+    with dask.config.set(scheduler='synchronous'):
+        runoff.to_zarr(store, region={'time': region}, consolidated=False)
+    return region
+
+
+def convert_download(path: str, store: str, start: str = None, end: str = None, spatial_chunk: int = 180,
+                     tmpdir: str = None) -> None:
+    """
+    Write a downloaded ERA5 file into the store, creating the store from the first download if it does not exist
+
+    Args:
+        path: Path to the downloaded netCDF or zip file
+        store: Path to the Zarr store
+        start: First day of the store, used when the store is created
+        end: Last day of the store, used when the store is created
+        spatial_chunk: Chunk size of the latitude and longitude dimensions, used when the store is created
+        tmpdir: Directory for temporary files extracted from zips
+
+    Returns:
+        None
+    """
+    for ds in open_download(path, tmpdir):
+        ds = normalize_era5(ds)
+        with store_lock:
+            if not os.path.exists(store):
+                logging.info(f'Creating {store} from {start} to {end}')
+                create_store(store, ds, start, end, spatial_chunk)
+        region = write_to_store(ds, store)
+        logging.info(f'Wrote {os.path.basename(path)} to time steps {region.start} to {region.stop}')
+    return
+
+
+if __name__ == '__main__':
+    """
+    Convert ERA5 or ERA5-Land runoff downloads into a single time chunked Zarr store
+
+    The store covers every hour from the start year to the end year and each download fills its own days, so files
+    can be converted in any order and at the same time as the remaining files download.
+
+    Arguments:
+    --store: Path to the Zarr store
+    --downloadsdir: Directory of downloaded netCDF or netcdf.zip files
+    --dataset: era5 or era5-land, used to select the downloads and to download them with --download
+    --startyear: First year of the store
+    --endyear: Last year of the store
+    --download: Download missing files with download_era5.py and convert each as it completes. Files already
+        converted are recorded in the download state file and skipped when the command is run again
+    --workers: Number of files downloaded and converted at the same time
+    --spatialchunk: Chunk size of the latitude and longitude dimensions
+    --tmpdir: Directory for temporary files extracted from zips
+
+    Usage:
+    python era5_to_zarr.py --store /mnt/era5.zarr --downloadsdir /mnt/era5 --dataset era5 --startyear 1940 --endyear 2023
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--store', type=str, required=True,
+                        help='Path to the Zarr store')
+    parser.add_argument('--downloadsdir', type=str, required=True,
+                        help='Directory of downloaded netCDF or netcdf.zip files')
+    parser.add_argument('--dataset', type=str, required=True, choices=['era5', 'era5-land'],
+                        help='Which ERA5 dataset the store holds')
+    parser.add_argument('--startyear', type=int, required=True,
+                        help='First year of the store')
+    parser.add_argument('--endyear', type=int, required=True,
+                        help='Last year of the store')
+    parser.add_argument('--download', action='store_true', default=False,
+                        help='Download missing files and convert each as it completes')
+    parser.add_argument('--workers', type=int, required=False, default=4,
+                        help='Number of files downloaded and converted at the same time')
+    parser.add_argument('--spatialchunk', type=int, required=False, default=180,
+                        help='Chunk size of the latitude and longitude dimensions')
+    parser.add_argument('--tmpdir', type=str, required=False, default=None,
+                        help='Directory for temporary files extracted from zips')
+    parser.add_argument('--client', type=str, required=False, default=None,
+                        help='module:name of a client factory to use instead of cdsapi.Client')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        stream=sys.stdout)
+
+    store_start = f'{args.startyear}-01-01'
+    store_end = f'{args.endyear}-12-31'
+
+    def convert(file: str) -> None:
+        convert_download(file, args.store, store_start, store_end, args.spatialchunk, args.tmpdir)
+
+    if args.download:
+        os.makedirs(args.downloadsdir, exist_ok=True)
+        state_file = os.path.join(args.downloadsdir, 'download_state.json')
+        if not os.path.exists(args.store):
+            # downloads marked converted were written to a store that has since been removed
+            download_era5.reset_converted(state_file)
+        make_tasks = download_era5.era5_tasks if args.dataset == 'era5' else download_era5.era5_land_tasks
+        download_era5.download_all(
+            make_tasks(args.startyear, args.endyear, args.downloadsdir),
+            client_factory=download_era5.load_client_factory(args.client),
+            state_file=state_file,
+            workers=args.workers,
+            on_complete=lambda task: convert(task['target']),
+        )
+    else:
+        pattern = '*_era5_hourly.nc' if args.dataset == 'era5' else '*_era5land_hourly.netcdf.zip'
+        files = natsort.natsorted(glob.glob(os.path.join(args.downloadsdir, pattern)))
+        logging.info(f'Converting {len(files)} files')
+        with ThreadPoolExecutor(args.workers) as executor:
+            list(executor.map(convert, files))
+
+    zarr.consolidate_metadata(args.store)
+    logging.info(f'Consolidated {args.store}')
@@ -0,0 +1,364 @@
+import argparse
+import datetime
+import glob
+import logging
+import os
+import sys
+from multiprocessing import Pool
+
+import natsort
+import netCDF4
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import xarray as xr
+
+RUNOFF_VARIABLES = ('ro', 'RO', 'runoff')
+
+
+def _file_signature(path: str) -> list:
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def weight_matrix(weight_table: str, riv_bas_id_file: str, cache_file: str = None) -> dict:
+    """
+    Build the sparse matrix of the area of each runoff grid cell which drains to each river reach
+
+    The weight table has 1 row per pair of river reach and grid cell which overlap. The first column is the rivid and
+    the table has columns area_sqm, lon_index and lat_index, where the indexes refer to the runoff grid. Only the grid
+    cells in the table are read from the runoff files, so the matrix columns are the unique cells in the table.
+
+    The matrix is cached as a npz file and rebuilt when the weight table or riv_bas_id file changes.
+
+    Args:
+        weight_table: Path to the weight table csv
+        riv_bas_id_file: Path to the csv of rivids in the order of the inflow files
+        cache_file: Path to the npz cache file. If None, nothing is cached
+
+    Returns:
+        dict with the weights as a (rivid, cell) csr matrix in square meters, the rivid array, and the lat_index and
+        lon_index of each cell
+    """
+    signature = np.array(_file_signature(weight_table) + _file_signature(riv_bas_id_file))
+    if cache_file is not None and os.path.exists(cache_file):
+        with np.load(cache_file) as cache:
+            if np.array_equal(cache['signature'], signature):
+                return {
+                    'weights': scipy.sparse.csr_matrix(
+                        (cache['data'], cache['indices'], cache['indptr']), shape=tuple(cache['shape'])
+                    ),
+                    'rivid': cache['rivid'],
+                    'lat_index': cache['lat_index'],
+                    'lon_index': cache['lon_index'],
+                }
+
+    rivid = pd.read_csv(riv_bas_id_file, header=None).iloc[:, 0].to_numpy().astype('int64')
+    df = pd.read_csv(weight_table)
+    df = df.rename(columns={df.columns[0]: 'rivid'})
+    df = df[df['area_sqm'] > 0]
+
+    rows = pd.Index(rivid).get_indexer(df['rivid'].to_numpy())
+    df = df[rows >= 0]
+    rows = rows[rows >= 0]
+    cells, columns = np.unique(df[['lat_index', 'lon_index']].to_numpy().astype('int64'), axis=0, return_inverse=True)
+    # duplicate rivid and cell pairs are summed by the sparse constructor
+    weights = scipy.sparse.csr_matrix(
+        (df['area_sqm'].to_numpy().astype('float64'), (rows, columns.ravel())), shape=(rivid.size, cells.shape[0])
+    )
+
+    if cache_file is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+        # np.savez adds .npz to paths without it so the temporary file keeps the extension
+        tmp_file = f'{cache_file[:-4]}.tmp.npz'
+        np.savez(tmp_file, signature=signature, data=weights.data, indices=weights.indices, indptr=weights.indptr,
+                 shape=np.array(weights.shape), rivid=rivid, lat_index=cells[:, 0], lon_index=cells[:, 1])
+        os.replace(tmp_file, cache_file)
+
+    return {'weights': weights, 'rivid': rivid, 'lat_index': cells[:, 0], 'lon_index': cells[:, 1]}
+
+
+def _runoff_variable(ds: xr.Dataset) -> xr.DataArray:
+    for name in RUNOFF_VARIABLES:
+        if name in ds.data_vars:
+            da = ds[name]
+            break
+    else:
+        raise ValueError(f'None of the variables {RUNOFF_VARIABLES} are in the runoff file')
+    if 'valid_time' in da.dims:
+        da = da.rename({'valid_time': 'time'})
+    if 'expver' in da.dims:
+        raise ValueError('Merge the expver dimension with merge_expver_variables.py before generating inflows')
+    return da.transpose('time', ...)
+
+
+def runoff_datasets(runoff_paths: list):
+    """
+    Open each source of runoff in time order
+
+    Zarr stores, such as the one written by era5_to_zarr.py, are split into years so each year is written to its own
+    inflow file like a yearly netCDF download would be.
+
+    Args:
+        runoff_paths: Paths to runoff netCDF files or Zarr stores in time order
+
+    Yields:
+        tuple of a name for the source and the open xr.Dataset
+    """
+    for path in runoff_paths:
+        if path.rstrip(os.sep).endswith('.zarr'):
+            with xr.open_zarr(path) as ds:
+                time_name = 'valid_time' if 'valid_time' in ds.dims else 'time'
+                years, starts = np.unique(ds[time_name].dt.year.values, return_index=True)
+                stops = np.append(starts[1:], ds.sizes[time_name])
+                for year, start, stop in zip(years, starts, stops):
+                    yield f'{path} ({year})', ds.isel({time_name: slice(start, stop)})
+        else:
+            with xr.open_dataset(path) as ds:
+                yield path, ds
+
+
+def create_inflow_file(path: str, rivid: np.ndarray, lat: np.ndarray, lon: np.ndarray) -> netCDF4.Dataset:
+    """
+    Create a RAPID Vlat file with an unlimited time dimension
+
+    Args:
+        path: Path to the netCDF file
+        rivid: The rivids in the order of riv_bas_id
+        lat: Latitude of each rivid
+        lon: Longitude of each rivid
+
+    Returns:
+        The open netCDF4.Dataset
+    """
+    ds = netCDF4.Dataset(path, 'w', format='NETCDF4')
+    ds.createDimension('time', None)
+    ds.createDimension('rivid', rivid.size)
+    ds.createDimension('nv', 2)
+
+    m3_riv = ds.createVariable('m3_riv', 'f4', ('time', 'rivid'), zlib=True, complevel=1,
+                               chunksizes=(1, rivid.size))
+    m3_riv.long_name = 'accumulated external water volume inflow upstream of each river reach'
+    m3_riv.units = 'm3'
+    m3_riv.coordinates = 'lon lat'
+    m3_riv.grid_mapping = 'crs'
+    m3_riv.cell_methods = 'time: sum'
+
+    rivid_var = ds.createVariable('rivid', 'i4', ('rivid',))
+    rivid_var.long_name = 'unique identifier for each river reach'
+    rivid_var.units = '1'
+    rivid_var.cf_role = 'timeseries_id'
+    rivid_var[:] = rivid
+
+    time_var = ds.createVariable('time', 'i8', ('time',))
+    time_var.standard_name = 'time'
+    time_var.long_name = 'time'
+    time_var.units = 'seconds since 1970-01-01 00:00:00 +00:00'
+    time_var.axis = 'T'
+    time_var.calendar = 'gregorian'
+    time_var.bounds = 'time_bnds'
+    time_bnds = ds.createVariable('time_bnds', 'i8', ('time', 'nv'))
+    time_bnds.units = time_var.units
+
+    for name, values, standard_name, units, axis in (('lon', lon, 'longitude', 'degrees_east', 'X'),
+                                                     ('lat', lat, 'latitude', 'degrees_north', 'Y')):
+        var = ds.createVariable(name, 'f8', ('rivid',))
+        var.long_name = f'{standard_name} of a point related to each river reach'
+        var.standard_name = standard_name
+        var.units = units
+        var.axis = axis
+        var[:] = values
+
+    crs = ds.createVariable('crs', 'i4')
+    crs.grid_mapping_name = 'latitude_longitude'
+    crs.epsg_code = 'EPSG:4326'
+    crs.semi_major_axis = 6378137.0
+    crs.inverse_flattening = 298.257223563
+
+    ds.Conventions = 'CF-1.6'
+    ds.featureType = 'timeSeries'
+    ds.title = 'RAPID lateral inflow'
+    ds.history = f'date created: {datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S+00:00")}'
+    return ds
+
+
+def generate_vpu_inflows(vpu_directory: str,
+                         runoff_files: list,
+                         inflows_directory: str,
+                         weight_table: str = None,
+                         cache_file: str = None,
+                         timestep: int = None,
+                         accumulated: bool = False,
+                         block_size: int = 240, ) -> list:
+    """
+    Write 1 RAPID Vlat file per runoff file, or per year of a runoff Zarr store, for a VPU
+
+    The runoff of the grid cells in the weight table is read in blocks of time steps and multiplied by the sparse
+    weight matrix, so the volume of every reach for a whole block is a single sparse matrix product.
+
+    Runoff values are depths of water in meters accumulated over the time step ending at each time. The inflow files
+    have time_bnds of [start, end] seconds for each time step as generate_namelist.py expects.
+
+    Args:
+        vpu_directory: Path to the directory of inputs for the VPU
+        runoff_files: Paths to the runoff netCDF files or Zarr stores in time order
+        inflows_directory: Directory to save the inflow files for the VPU
+        weight_table: Path to the weight table csv. Defaults to the only weight*.csv in the VPU directory
+        cache_file: Path to the npz cache of the weight matrix. Defaults to weight_matrix.npz in the VPU directory
+        timestep: Time step of the inflow files in seconds. Must be a multiple of the runoff time step. Defaults to
+            the runoff time step
+        accumulated: The runoff accumulates from 00 UTC each day, e.g. ERA5-Land, and is converted to increments
+        block_size: Number of runoff time steps read at once
+
+    Returns:
+        list of paths to the inflow files written
+    """
+    vpu = os.path.basename(vpu_directory)
+    if weight_table is None:
+        weight_tables = glob.glob(os.path.join(vpu_directory, 'weight*.csv'))
+        assert len(weight_tables) == 1, f'Expected 1 weight table in {vpu_directory}, found {len(weight_tables)}'
+        weight_table = weight_tables[0]
+    if cache_file is None:
+        cache_file = os.path.join(vpu_directory, 'weight_matrix.npz')
+    matrix = weight_matrix(weight_table, os.path.join(vpu_directory, 'riv_bas_id.csv'), cache_file)
+    weights = matrix['weights']
+
+    # only read the rectangle of the grid containing the cells of this VPU
+    lat_slice = slice(int(matrix['lat_index'].min()), int(matrix['lat_index'].max()) + 1)
+    lon_slice = slice(int(matrix['lon_index'].min()), int(matrix['lon_index'].max()) + 1)
+    cell_lat = matrix['lat_index'] - lat_slice.start
+    cell_lon = matrix['lon_index'] - lon_slice.start
+
+    os.makedirs(inflows_directory, exist_ok=True)
+    written = []
+    previous = None
+    for runoff_file, ds in runoff_datasets(runoff_files):
+        runoff = _runoff_variable(ds)
+        lat_name, lon_name = runoff.dims[1:3]
+        runoff = runoff.isel({lat_name: lat_slice, lon_name: lon_slice})
+        times = runoff['time'].values.astype('datetime64[s]').astype('int64')
+        if times.size < 2 and timestep is None:
+            raise ValueError(f'Cannot determine the time step of {runoff_file}')
+        runoff_step = int(np.diff(times).min()) if times.size > 1 else timestep
+        step = timestep or runoff_step
+        aggregate = step // runoff_step
+        assert step % runoff_step == 0, f'timestep must be a multiple of the runoff time step {runoff_step}'
+        # the first time step of a file ends at its first time
+        n_steps = times.size // aggregate
+        if n_steps == 0:
+            continue
+        if times.size % aggregate:
+            logging.warning(f'{vpu}: ignoring the last {times.size % aggregate} time steps of {runoff_file}')
+        starts = times[aggregate - 1::aggregate][:n_steps] - step
+
+        start_date = datetime.datetime.utcfromtimestamp(int(starts[0])).strftime('%Y%m%d')
+        end_date = datetime.datetime.utcfromtimestamp(int(starts[-1])).strftime('%Y%m%d')
+        inflow_file = os.path.join(inflows_directory, f'm3_{vpu}_{start_date}_{end_date}.nc')
+
+        # the location of each reach is the area weighted center of its grid cells
+        lat = runoff[lat_name].values[cell_lat].astype('float64')
+        lon = runoff[lon_name].values[cell_lon].astype('float64')
+        area = np.asarray(weights.sum(axis=1)).ravel()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            reach_lat = np.where(area > 0, (weights @ lat) / area, np.nan)
+            reach_lon = np.where(area > 0, (weights @ lon) / area, np.nan)
+
+        block_size = max(aggregate, block_size - block_size % aggregate)
+        with create_inflow_file(f'{inflow_file}.part', matrix['rivid'], reach_lat, reach_lon) as inflows:
+            for block_start in range(0, n_steps * aggregate, block_size):
+                block_stop = min(block_start + block_size, n_steps * aggregate)
+                grid = runoff.isel(time=slice(block_start, block_stop)).values
+                cells = grid[:, cell_lat, cell_lon].astype('float64')
+                # e.g. time steps of a Zarr store which have not been converted yet
+                missing = np.flatnonzero(np.isnan(cells).all(axis=1))
+                if missing.size:
+                    missing_time = datetime.datetime.utcfromtimestamp(int(times[block_start + missing[0]]))
+                    raise ValueError(f'{runoff_file} has no runoff for any cell of {vpu} at {missing_time}')
+                cells = np.nan_to_num(cells)
+
+                if accumulated:
+                    hours = (times[block_start:block_stop] // 3600) % 24
+                    before = np.vstack([previous if previous is not None else np.zeros_like(cells[:1]),
+                                        cells[:-1]])
+                    previous = cells[-1:].copy()
+                    # the value at 01 UTC is the first hour of accumulation
+                    cells = np.where((hours == 1)[:, None], cells, cells - before)
+                    cells = np.maximum(cells, 0)
+
+                volumes = (weights @ cells.T).T
+                volumes = volumes.reshape(-1, aggregate, volumes.shape[1]).sum(axis=1)
+
+                out_start = block_start // aggregate
+                out_stop = out_start + volumes.shape[0]
+                inflows['m3_riv'][out_start:out_stop] = volumes.astype('float32')
+                inflows['time'][out_start:out_stop] = starts[out_start:out_stop]
+                inflows['time_bnds'][out_start:out_stop] = np.stack(
+                    [starts[out_start:out_stop], starts[out_start:out_stop] + step], axis=1
+                )
+        os.replace(f'{inflow_file}.part', inflow_file)
+        written.append(inflow_file)
+        logging.info(f'{vpu}: wrote {inflow_file}')
+    return written
+
+
+def _generate_vpu_inflows(kwargs: dict) -> str:
+    generate_vpu_inflows(**kwargs)
+    return os.path.basename(kwargs['vpu_directory'])
+
+
+if __name__ == '__main__':
+    """
+    Generate RAPID inflow (Vlat) files for each VPU from gridded runoff such as ERA5
+
+    Arguments:
+    --runoffdir: Directory of runoff netCDF files, or a runoff Zarr store such as era5_to_zarr.py writes
+    --inputsdir: Directory containing subdirectories of inputs for each VPU with riv_bas_id.csv and a weight table
+    --inflowsdir: Directory to save subdirectories of inflow files for each VPU
+    --timestep: Hours in each time step of the inflow files. Defaults to the runoff time step
+    --accumulated: The runoff accumulates from 00 UTC each day, e.g. ERA5-Land
+    --blocksize: Number of runoff time steps read at once
+    --workers: Number of VPUs to process at the same time
+
+    Usage:
+    python generate_inflows.py --runoffdir /mnt/era5 --inputsdir /mnt/inputs --inflowsdir /mnt/inflows --timestep 3
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runoffdir', type=str, required=True,
+                        help='Directory of runoff netCDF files, or a runoff Zarr store')
+    parser.add_argument('--inputsdir', type=str, required=True,
+                        help='Directory containing subdirectories of inputs for each VPU')
+    parser.add_argument('--inflowsdir', type=str, required=True,
+                        help='Directory to save subdirectories of inflow files for each VPU')
+    parser.add_argument('--timestep', type=int, required=False, default=None,
+                        help='Hours in each time step of the inflow files. Defaults to the runoff time step')
+    parser.add_argument('--accumulated', action='store_true', default=False,
+                        help='The runoff accumulates from 00 UTC each day, e.g. ERA5-Land')
+    parser.add_argument('--blocksize', type=int, required=False, default=240,
+                        help='Number of runoff time steps read at once')
+    parser.add_argument('--workers', type=int, required=False, default=os.cpu_count(),
+                        help='Number of VPUs to process at the same time')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        stream=sys.stdout)
+
+    if args.runoffdir.rstrip(os.sep).endswith('.zarr'):
+        runoff_files = [args.runoffdir, ]
+    else:
+        runoff_files = natsort.natsorted(glob.glob(os.path.join(args.runoffdir, '*.nc')))
+    vpu_dirs = sorted(d for d in glob.glob(os.path.join(args.inputsdir, '*')) if os.path.isdir(d))
+    jobs = [
+        {
+            'vpu_directory': vpu_dir,
+            'runoff_files': runoff_files,
+            'inflows_directory': os.path.join(args.inflowsdir, os.path.basename(vpu_dir)),
+            'timestep': args.timestep * 3600 if args.timestep else None,
+            'accumulated': args.accumulated,
+            'block_size': args.blocksize,
+        } for vpu_dir in vpu_dirs
+    ]
+    logging.info(f'Generating inflows for {len(jobs)} VPUs from {len(runoff_files)} runoff files')
+    with Pool(min(args.workers, max(len(jobs), 1))) as p:
+        for vpu in p.imap_unordered(_generate_vpu_inflows, jobs):
+            logging.info(f'Finished VPU {vpu}')
@@ -1,6 +1,9 @@
 import glob
+import json
 import os
 import argparse
+from multiprocessing import Pool
+
 import netCDF4
 import pandas as pd
 import natsort
@@ -138,13 +141,97 @@ def rapid_namelist(
         f.write(namelist_string)
 
 
+def _file_signature(path: str) -> list:
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def vpu_metadata(vpu_directory: str, inflow_files: list, cache_file: str = None) -> dict:
+    """
+    Read the reach counts of a VPU and the time steps of its inflow files which are needed to write namelists
+
+    The values are cached in a json manifest next to the namelists. Each entry records the modification time and size
+    of the file it was read from and is only read again when the file changes, so that the rapid_connect and
+    riv_bas_id csvs and each inflow file are read once rather than once per namelist.
+
+    Args:
+        vpu_directory: Path to the directory of inputs for the VPU
+        inflow_files: Paths to the inflow files of the VPU
+        cache_file: Path to the json manifest. If None, nothing is cached
+
+    Returns:
+        dict with reaches_in_rapid_connect, max_upstream_reaches, reaches_total, and a dict of time_step and time_total
+        for each inflow file by path
+    """
+    cache = {}
+    if cache_file is not None and os.path.exists(cache_file):
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            logging.warning(f'Ignoring unreadable metadata cache {cache_file}')
+    updated = False
+
+    rapid_connect_file = os.path.join(vpu_directory, 'rapid_connect.csv')
+    rapid_connect = cache.get('rapid_connect', {})
+    if rapid_connect.get('signature') != _file_signature(rapid_connect_file):
+        df = pd.read_csv(rapid_connect_file, header=None)
+        rapid_connect_columns = ['rivid', 'next_down', 'count_upstream']  # plus 1 per possible upstream reach
+        rapid_connect = {
+            'signature': _file_signature(rapid_connect_file),
+            'rows': df.shape[0],
+            'max_upstream_reaches': df.columns.shape[0] - len(rapid_connect_columns),
+        }
+        updated = True
+
+    riv_bas_id_file = os.path.join(vpu_directory, 'riv_bas_id.csv')
+    riv_bas_id = cache.get('riv_bas_id', {})
+    if riv_bas_id.get('signature') != _file_signature(riv_bas_id_file):
+        riv_bas_id = {
+            'signature': _file_signature(riv_bas_id_file),
+            'rows': pd.read_csv(riv_bas_id_file, header=None).shape[0],
+        }
+        updated = True
+
+    inflows = {}
+    for inflow_file in inflow_files:
+        inflow = cache.get('inflows', {}).get(inflow_file, {})
+        if inflow.get('signature') != _file_signature(inflow_file):
+            with netCDF4.Dataset(inflow_file) as ds:
+                time_bnds = ds['time_bnds'][:]
+            inflow = {
+                'signature': _file_signature(inflow_file),
+                'time_step': (time_bnds[0, 1] - time_bnds[0, 0]).item(),
+                'time_total': (time_bnds[-1, 1] - time_bnds[0, 0]).item(),
+            }
+            updated = True
+        inflows[inflow_file] = inflow
+    # keep entries for inflow files which were not requested this time, e.g. by other segments
+    inflows = {**cache.get('inflows', {}), **inflows}
+
+    if cache_file is not None and updated:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(f'{cache_file}.tmp', 'w') as f:
+            json.dump({'rapid_connect': rapid_connect, 'riv_bas_id': riv_bas_id, 'inflows': inflows}, f)
+        os.replace(f'{cache_file}.tmp', cache_file)
+
+    return {
+        'reaches_in_rapid_connect': rapid_connect['rows'],
+        'max_upstream_reaches': rapid_connect['max_upstream_reaches'],
+        'reaches_total': riv_bas_id['rows'],
+        'inflows': inflows,
+    }
+
+
 def rapid_namelist_from_directories(vpu_directory: str,
                                     inflows_directory: str,
                                     namelists_directory: str,
                                     outputs_directory: str,
                                     datesubdir: bool = False,
                                     qinit_file: str = None,
-                                    search_for_qinit_file: bool = True, ) -> None:
+                                    search_for_qinit_file: bool = True,
+                                    inflow_files: list = None,
+                                    metadata_cache_file: str = None, ) -> None:
     vpu_code = os.path.basename(vpu_directory)
     k_file = os.path.join(vpu_directory, f'k.csv')
     x_file = os.path.join(vpu_directory, f'x.csv')
@@ -154,12 +241,16 @@ def rapid_namelist_from_directories(vpu_directory: str,
     for x in (k_file, x_file, riv_bas_id_file, rapid_connect_file):
         assert os.path.exists(x), f'{x} does not exist'
 
-    inflow_files = natsort.natsorted(glob.glob(os.path.join(inflows_directory, '*.nc')))
+    if inflow_files is None:
+        inflow_files = natsort.natsorted(glob.glob(os.path.join(inflows_directory, '*.nc')))
     if not len(inflow_files):
         print(f'No inflow files found for VPU {vpu_code}')
         return
 
     os.makedirs(namelists_directory, exist_ok=True)
+    if metadata_cache_file is None:
+        metadata_cache_file = os.path.join(namelists_directory, 'metadata_cache.json')
+    metadata = vpu_metadata(vpu_directory, inflow_files, metadata_cache_file)
 
     for idx, inflow_file in enumerate(sorted(inflow_files)):
         inflow_file_name_params = os.path.basename(inflow_file).replace('.nc', '').split('_')
@@ -188,9 +279,8 @@ def rapid_namelist_from_directories(vpu_directory: str,
             os.makedirs(os.path.join(outputs_directory, f'{start_date}'), exist_ok=True)
             qout_path = os.path.join(outputs_directory, f'{start_date}', qout_file_name, )
 
-        with netCDF4.Dataset(inflow_file) as ds:
-            time_step_inflows = ds['time_bnds'][0, 1] - ds['time_bnds'][0, 0]
-            time_total_inflow = ds['time_bnds'][-1, 1] - ds['time_bnds'][0, 0]
+        time_step_inflows = metadata['inflows'][inflow_file]['time_step']
+        time_total_inflow = metadata['inflows'][inflow_file]['time_total']
         time_total = time_total_inflow
         timestep_inp_runoff = time_step_inflows
         timestep_calc = time_step_inflows
@@ -204,10 +294,11 @@ def rapid_namelist_from_directories(vpu_directory: str,
         #     qinit_file = possible_qinit_files[-1]
         # else:
         #     qinit_file = ''
-        use_qinit_file = idx > 0 or qinit_file is not None
-        qinit_file = os.path.join(
-            outputs_directory, f'Qfinal_{vpu_code}_{inflow_files[idx - 1].split("_")[-1]}'
-        ) if use_qinit_file else ''
+        use_qinit_file = idx > 0 or bool(qinit_file)
+        if idx > 0:
+            qinit_file = os.path.join(
+                outputs_directory, f'Qfinal_{vpu_code}_{inflow_files[idx - 1].split("_")[-1]}'
+            )
 
         rapid_namelist(namelist_save_path=namelist_save_path,
                        k_file=k_file,
@@ -223,11 +314,85 @@ def rapid_namelist_from_directories(vpu_directory: str,
                        write_qfinal_file=write_qfinal_file,
                        qfinal_file=qfinal_file,
                        use_qinit_file=use_qinit_file,
-                       qinit_file=qinit_file, )
+                       qinit_file=qinit_file or '',
+                       reaches_in_rapid_connect=metadata['reaches_in_rapid_connect'],
+                       max_upstream_reaches=metadata['max_upstream_reaches'],
+                       reaches_total=metadata['reaches_total'], )
 
     return
 
 
+def rapid_namelist_segments_from_directories(vpu_directory: str,
+                                             inflows_directory: str,
+                                             namelists_directory: str,
+                                             outputs_directory: str,
+                                             segments: int,
+                                             spinup_files: int = 1, ) -> None:
+    """
+    Generate namelists which split the inflow files of a VPU into segments of time that can be run at the same time
+
+    Each segment after the first starts with a spin-up: the spinup_files inflow files before the segment are routed
+    from a cold start and the Qfinal of the last one is the Qinit of the first file of the segment. The namelists of
+    each segment are saved to a separate directory, {namelists_directory}_seg{NN}, so runrapid.py runs the segments
+    as independent jobs. Spin-up outputs are written to outputs_directory/spinup/seg{NN} and are discarded by
+    stitch_time_segments.py.
+
+    Args:
+        vpu_directory: Path to the directory of inputs for the VPU
+        inflows_directory: Path to the directory of inflow files for the VPU
+        namelists_directory: Path to the namelists directory for the VPU. A _seg{NN} suffix is added for each segment
+        outputs_directory: Path to the directory for the Qout and Qfinal files of the VPU
+        segments: Number of segments to split the inflow files into
+        spinup_files: Number of inflow files before each segment to route as the spin-up
+
+    Returns:
+        None
+    """
+    inflow_files = natsort.natsorted(glob.glob(os.path.join(inflows_directory, '*.nc')))
+    if not len(inflow_files):
+        print(f'No inflow files found for VPU {os.path.basename(vpu_directory)}')
+        return
+    segments = max(1, min(segments, len(inflow_files)))
+    # every segment reads the same inputs so they share the cache of the first segment
+    metadata_cache_file = os.path.join(f'{namelists_directory}_seg00', 'metadata_cache.json')
+    bounds = [round(i * len(inflow_files) / segments) for i in range(segments + 1)]
+
+    for segment, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        segment_namelists_directory = f'{namelists_directory}_seg{segment:02d}'
+        qinit_file = None
+        if start > 0:
+            spinup = inflow_files[max(0, start - spinup_files):start]
+            spinup_directory = os.path.join(outputs_directory, 'spinup', f'seg{segment:02d}')
+            rapid_namelist_from_directories(vpu_directory=vpu_directory,
+                                            inflows_directory=inflows_directory,
+                                            namelists_directory=segment_namelists_directory,
+                                            outputs_directory=spinup_directory,
+                                            inflow_files=spinup,
+                                            metadata_cache_file=metadata_cache_file, )
+            qinit_file = os.path.join(
+                spinup_directory, f'Qfinal_{os.path.basename(vpu_directory)}_{spinup[-1].split("_")[-1]}'
+            )
+        rapid_namelist_from_directories(vpu_directory=vpu_directory,
+                                        inflows_directory=inflows_directory,
+                                        namelists_directory=segment_namelists_directory,
+                                        outputs_directory=outputs_directory,
+                                        qinit_file=qinit_file,
+                                        inflow_files=inflow_files[start:end],
+                                        metadata_cache_file=metadata_cache_file, )
+    return
+
+
+def _namelists_for_vpu(kwargs: dict) -> str:
+    segments = kwargs.pop('segments')
+    spinup_files = kwargs.pop('spinup_files')
+    datesubdir = kwargs.pop('datesubdir')
+    if segments > 1:
+        rapid_namelist_segments_from_directories(**kwargs, segments=segments, spinup_files=spinup_files)
+    else:
+        rapid_namelist_from_directories(**kwargs, datesubdir=datesubdir)
+    return os.path.basename(kwargs['vpu_directory'])
+
+
 if __name__ == '__main__':
     """
     Prepare rapid namelist files for a directory of VPU inputs
@@ -236,6 +401,12 @@ if __name__ == '__main__':
     argparser.add_argument('--basedir', type=str, required=True)
     argparser.add_argument('--dockerpaths', action='store_true', default=False)
     argparser.add_argument('--datesubdir', action='store_true', default=False)
+    argparser.add_argument('--segments', type=int, default=1,
+                           help='Split the inflow files of each VPU into this many segments that run in parallel')
+    argparser.add_argument('--spinupfiles', type=int, default=1,
+                           help='Number of inflow files before each segment to route as its spin-up')
+    argparser.add_argument('--workers', type=int, default=os.cpu_count(),
+                           help='Number of VPUs to generate namelists for at the same time')
     args = argparser.parse_args()
 
     base_dir = args.basedir
@@ -255,16 +426,20 @@ if __name__ == '__main__':
     )
 
     all_vpu_dirs = sorted([x for x in glob.glob(os.path.join(vpu_dirs, '*')) if os.path.isdir(x)])
-    for vpu_dir in all_vpu_dirs:
-        inflow_dir = os.path.join(inflow_dirs, os.path.basename(vpu_dir))
-        namelist_dir = os.path.join(namelist_dirs, os.path.basename(vpu_dir))
-        output_dir = os.path.join(output_dirs, os.path.basename(vpu_dir))
-
-        rapid_namelist_from_directories(vpu_directory=vpu_dir,
-                                        inflows_directory=inflow_dir,
-                                        namelists_directory=namelist_dir,
-                                        outputs_directory=output_dir,
-                                        datesubdir=datesubdir, )
+    jobs = [
+        {
+            'vpu_directory': vpu_dir,
+            'inflows_directory': os.path.join(inflow_dirs, os.path.basename(vpu_dir)),
+            'namelists_directory': os.path.join(namelist_dirs, os.path.basename(vpu_dir)),
+            'outputs_directory': os.path.join(output_dirs, os.path.basename(vpu_dir)),
+            'datesubdir': datesubdir,
+            'segments': args.segments,
+            'spinup_files': args.spinupfiles,
+        } for vpu_dir in all_vpu_dirs
+    ]
+    with Pool(min(args.workers, max(len(jobs), 1))) as p:
+        for vpu in p.imap_unordered(_namelists_for_vpu, jobs):
+            logging.info(f'Generated namelists for VPU {vpu}')
 
     if dockerpaths and base_dir != '/mnt':
         for file in glob.glob(os.path.join(namelist_dirs, '*', 'namelist*')):
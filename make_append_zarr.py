@@ -1,83 +1,249 @@
+import argparse
 import glob
 import logging
 import os
 import sys
+from multiprocessing import Pool
 
 import numpy as np
 import pandas as pd
 
 import dask
+import dask.array as da
 import xarray as xr
+import zarr
+
+ds_attrs = {
+    'author': 'Riley Hales, PhD',
+    'history': 'Created 2023-10-26',
+    'institution': 'GEOGloWS',
+    'references': 'https://geoglows.ecmwf.int/',
+    'source': 'GEOGloWS Hydrologic Model Version 2',
+    'title': 'GEOGloWS V2 Retrospective Simulation',
+    'layout': 'timeseries',
+}
+
+time_attrs = {
+    'units': 'seconds since 1970-01-01',
+    'calendar': 'standard',
+    'axis': 'T',
+    'standard_name': 'time'
+}
+
+vars_to_drop = ['Qout_err', 'lat', 'lon', 'crs', 'time_bnds']
+
+
+def open_vpu(vpu_dir: str) -> xr.Dataset:
+    """
+    Open the Qout files of a VPU with the extra variables dropped and times as integer seconds since 1970
+
+    Args:
+        vpu_dir: Directory of Qout files for a VPU
+
+    Returns:
+        xr.Dataset
+    """
+    ds = xr.open_mfdataset(os.path.join(vpu_dir, 'Qout*.nc*'))
+    times = pd.to_datetime(ds['time'].values).values.astype('datetime64[s]').astype(np.int64)
+    ds['time'] = xr.DataArray(times, dims='time', attrs=time_attrs)
+    return ds.drop_vars([v for v in vars_to_drop if v in ds.variables])
+
+
+def scan_vpu(vpu_dir: str) -> dict:
+    """
+    Read the rivid and time coordinates of a VPU
+
+    Args:
+        vpu_dir: Directory of Qout files for a VPU
+
+    Returns:
+        dict with the vpu_dir, rivid values, and time values
+    """
+    with open_vpu(vpu_dir) as ds:
+        return {
+            'vpu_dir': vpu_dir,
+            'rivid': ds['rivid'].values,
+            'time': ds['time'].values,
+        }
+
+
+def rivid_chunk_size(n_times: int, itemsize: int, chunk_mb: float) -> int:
+    """Number of rivids in a chunk holding every time step which is about chunk_mb megabytes"""
+    return max(1, int(chunk_mb * 1e6 // (n_times * itemsize)))
+
+
+def region_tasks(vpu_sizes: list, rivid_chunk: int, chunks_per_task: int = 1) -> list:
+    """
+    Split the rivid axis into ranges that start and end on chunk boundaries and list the VPUs overlapping each range
+
+    A range may hold the end of one VPU and the start of the next so that every chunk is written by exactly 1 task.
+
+    Args:
+        vpu_sizes: List of (vpu_dir, number of rivids) in the order they are stored
+        rivid_chunk: Number of rivids in a chunk
+        chunks_per_task: Number of chunks written by each task
+
+    Returns:
+        list of dicts with the start and stop of the range and a list of (vpu_dir, start, stop) within each VPU
+    """
+    offsets = np.concatenate([[0, ], np.cumsum([size for _, size in vpu_sizes])])
+    total = int(offsets[-1])
+    step = rivid_chunk * chunks_per_task
+    tasks = []
+    for start in range(0, total, step):
+        stop = min(start + step, total)
+        pieces = []
+        for (vpu_dir, _), vpu_start, vpu_stop in zip(vpu_sizes, offsets[:-1], offsets[1:]):
+            if vpu_stop <= start or vpu_start >= stop:
+                continue
+            pieces.append((vpu_dir, int(max(start, vpu_start) - vpu_start), int(min(stop, vpu_stop) - vpu_start)))
+        tasks.append({'start': start, 'stop': stop, 'pieces': pieces})
+    return tasks
+
+
+def create_skeleton(zarr_path: str, template: xr.Dataset, rivids: np.ndarray, rivid_chunk: int) -> None:
+    """
+    Write the metadata and coordinates of the full size store without computing any discharge values
+
+    Args:
+        zarr_path: Path to the Zarr store
+        template: Dataset of 1 VPU, from open_vpu, to copy the variables, dtypes and attributes from
+        rivids: rivid values of every VPU in the order they are stored
+        rivid_chunk: Number of rivids in a chunk
+
+    Returns:
+        None
+    """
+    n_times = template['time'].size
+    sizes = {'time': n_times, 'rivid': rivids.size}
+    chunks = {'time': n_times, 'rivid': rivid_chunk}
+    skeleton = xr.Dataset(
+        {
+            var: (
+                template[var].dims,
+                da.full(
+                    tuple(sizes[d] for d in template[var].dims),
+                    np.nan,
+                    dtype=template[var].dtype,
+                    chunks=tuple(chunks[d] for d in template[var].dims),
+                ),
+                template[var].attrs,
+            )
+            for var in template.data_vars
+        },
+        coords={
+            'time': template['time'],
+            'rivid': xr.DataArray(rivids, dims='rivid', attrs=template['rivid'].attrs),
+        },
+        attrs=ds_attrs,
+    )
+    skeleton.to_zarr(zarr_path, mode='w', compute=False)
+    return
+
+
+def write_region(task: dict) -> str:
+    """
+    Write the discharge of a chunk aligned rivid range, from 1 or more VPUs, into its region of the store
+
+    Args:
+        task: dict with the zarr_path, rivid_chunk, and a range from region_tasks
+
+    Returns:
+        str description of the range written
+    """
+    datasets = [open_vpu(vpu_dir).isel(rivid=slice(start, stop)) for vpu_dir, start, stop in task['pieces']]
+    try:
+        ds = xr.concat(datasets, dim='rivid') if len(datasets) > 1 else datasets[0]
+        # variables without a rivid dimension, like time, are already in the skeleton and can't be region written
+        ds = ds.drop_vars([v for v in ds.variables if 'rivid' not in ds[v].dims])
+        # the process pool is the parallelism, threads in every process would oversubscribe the cpus
+        with dask.config.set(scheduler='synchronous'):
+            (
+                ds
+                .chunk({'time': -1, 'rivid': task['rivid_chunk']})
+                .to_zarr(task['zarr_path'], region={'rivid': slice(task['start'], task['stop'])})
+            )
+    finally:
+        for ds in datasets:
+            ds.close()
+    return f'rivids {task["start"]} to {task["stop"]} from {", ".join(p[0] for p in task["pieces"])}'
+
+
+def build_zarr(vpu_dirs: list, zarr_path: str, workers: int = 4, chunk_mb: float = 100,
+               chunks_per_task: int = 1) -> None:
+    """
+    Build the retrospective Zarr store of every VPU by writing chunk aligned regions in parallel
+
+    Args:
+        vpu_dirs: Directories of Qout files for each VPU, in the order they are stored
+        zarr_path: Path to the Zarr store
+        workers: Number of processes writing regions
+        chunk_mb: Approximate size of each chunk in megabytes
+        chunks_per_task: Number of chunks written by each task
+
+    Returns:
+        None
+    """
+    logging.info(f'Scanning {len(vpu_dirs)} VPUs')
+    with Pool(workers) as p:
+        scans = p.map(scan_vpu, vpu_dirs)
+    for scan in scans[1:]:
+        if not np.array_equal(scan['time'], scans[0]['time']):
+            raise ValueError(f'Times of {scan["vpu_dir"]} do not match {scans[0]["vpu_dir"]}')
+    rivids = np.concatenate([scan['rivid'] for scan in scans])
+    if np.unique(rivids).size != rivids.size:
+        raise ValueError('rivids are repeated between VPUs')
+
+    with open_vpu(vpu_dirs[0]) as template:
+        itemsize = max(template[v].dtype.itemsize for v in template.data_vars)
+        rivid_chunk = rivid_chunk_size(template['time'].size, itemsize, chunk_mb)
+        logging.info(f'Writing skeleton of {rivids.size} rivids with chunks of {rivid_chunk} rivids')
+        create_skeleton(zarr_path, template, rivids, rivid_chunk)
+
+    tasks = region_tasks([(scan['vpu_dir'], scan['rivid'].size) for scan in scans], rivid_chunk, chunks_per_task)
+    for task in tasks:
+        task.update({'zarr_path': zarr_path, 'rivid_chunk': rivid_chunk})
+    logging.info(f'Writing {len(tasks)} regions with {workers} workers')
+    with Pool(workers) as p:
+        for i, message in enumerate(p.imap_unordered(write_region, tasks)):
+            logging.info(f'Wrote {message} ({i + 1}/{len(tasks)})')
+
+    zarr.consolidate_metadata(zarr_path)
+    return
+
 
 if __name__ == '__main__':
+    """
+    Combine the Qout files of every VPU into a single Zarr store by writing chunk aligned regions in parallel
+
+    Arguments:
+    --vpudirs: Glob pattern of the directories of Qout files for each VPU
+    --zarrpath: Path to the Zarr store
+    --workers: Number of processes writing regions
+    --chunkmb: Approximate size of each chunk in megabytes
+    --taskchunks: Number of chunks written by each task
+
+    Usage:
+    python make_append_zarr.py --vpudirs "/mnt/outputs/*" --zarrpath /data/retro.zarr --workers 16
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vpudirs', type=str, required=False, default='/mnt/outputs/*',
+                        help='Glob pattern of the directories of Qout files for each VPU')
+    parser.add_argument('--zarrpath', type=str, required=False, default='/data/retro.zarr',
+                        help='Path to the Zarr store')
+    parser.add_argument('--workers', type=int, required=False, default=os.cpu_count(),
+                        help='Number of processes writing regions')
+    parser.add_argument('--chunkmb', type=float, required=False, default=100,
+                        help='Approximate size of each chunk in megabytes')
+    parser.add_argument('--taskchunks', type=int, required=False, default=1,
+                        help='Number of chunks written by each task')
+    args = parser.parse_args()
+
     logging.basicConfig(
         level=logging.INFO,
         format='%(asctime)s - %(message)s',
         stream=sys.stdout,
     )
 
-    ds_attrs = {
-        'author': 'Riley Hales, PhD',
-        'history': 'Created 2023-10-26',
-        'institution': 'GEOGloWS',
-        'references': 'https://geoglows.ecmwf.int/',
-        'source': 'GEOGloWS Hydrologic Model Version 2',
-        'title': 'GEOGloWS V2 Retrospective Simulation',
-    }
-
-    time_attrs = {
-        'units': 'seconds since 1970-01-01',
-        'calendar': 'standard',
-        'axis': 'T',
-        'standard_name': 'time'
-    }
-
-    vars_to_drop = ['Qout_err', 'lat', 'lon', 'crs', 'time_bnds']
-    zarr_path = '/data/retro.zarr'
-    vpu_dirs_path = '/mnt/outputs/*'
-    vpus = sorted([d for d in glob.glob(vpu_dirs_path) if os.path.isdir(d)])
-
-    with dask.config.set(**{
-        'array.slicing.split_large_chunks': True,
-        'array.chunk-size': '100MB',
-    }):
-        logging.info('reading first file')
-        first_vpu = vpus.pop(0)
-        logging.info(f'first vpu dir is {first_vpu}')
-        with xr.open_mfdataset(os.path.join(first_vpu, 'Qout*.nc*')) as ds:
-            # number of elements along each dimension to write to a sub file
-            chunks = {
-                'time': ds['time'].size,
-                'rivid': 'auto',
-            }
-            times = pd.to_datetime(ds['time'].values).values.astype('datetime64[s]').astype(np.int64)
-            ds['time'] = xr.DataArray(times, dims='time', attrs=time_attrs)
-            ds.attrs = ds_attrs
-            logging.info('writing first file')
-            (
-                ds
-                .drop_vars(vars_to_drop)
-                .chunk(chunks)
-                .to_zarr(zarr_path, mode='w')
-            )
-
-        for vpu in vpus:
-            logging.info(f'reading file {vpu}')
-            with xr.open_mfdataset(os.path.join(vpu, 'Qout*.nc*')) as ds:
-                chunks = {
-                    'time': ds['time'].size,
-                    'rivid': 'auto',
-                }
-                logging.info('setting correct time values')
-                times = pd.to_datetime(ds['time'].values).values.astype('datetime64[s]').astype(np.int64)
-                ds['time'] = xr.DataArray(times, dims='time', attrs=time_attrs)
-
-                ds.attrs = ds_attrs
-                logging.info(f'appending files from {vpu}')
-                (
-                    ds
-                    .drop_vars(vars_to_drop)
-                    .chunk(chunks)
-                    .assign_attrs(ds_attrs)
-                    .to_zarr(zarr_path, append_dim='rivid', mode='a')
-                )
+    vpus = sorted([d for d in glob.glob(args.vpudirs) if os.path.isdir(d)])
+    build_zarr(vpus, args.zarrpath, args.workers, args.chunkmb, args.taskchunks)
@@ -13,6 +13,7 @@ ds_attrs = {
     'references': 'https://geoglows.ecmwf.int/',
     'source': 'GEOGloWS Hydrologic Model Version 2',
     'title': 'GEOGloWS V2 Retrospective Simulation',
+    'layout': 'timeseries',
 }
 
 time_attrs = {
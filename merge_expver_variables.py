@@ -1,37 +1,84 @@
+import argparse
 import glob
+import logging
+import os
+import sys
+from multiprocessing import Pool
 
-import numpy as np
+import dask
 import xarray as xr
 
-for file in glob.glob('./2023era5/*.nc'):
-    with xr.open_dataset(file) as ds:
-        # find the time steps where the runoff is not nan when expver=1
-        a = ds.ro.sel(latitude=0, longitude=0, expver=1)
-        expver1_timesteps = a.time[~np.isnan(a)]
-
-        # find the time steps where the runoff is not nan when expver=5
-        b = ds.ro.sel(latitude=0, longitude=0, expver=5)
-        expver5_timesteps = b.time[~np.isnan(b)]
-
-        # assert that the two timesteps combined are the same as the original
-        assert len(ds.time) == len(expver1_timesteps) + len(expver5_timesteps)
-
-        new_file_name = file.replace('.nc', '_noexpver_compressed.nc')
-
-        # combine the two
-        (
-            xr
-            .concat(
-                [
-                    ds.sel(expver=1, time=expver1_timesteps.values).drop_vars('expver'),
-                    ds.sel(expver=5, time=expver5_timesteps.values).drop_vars('expver')
-                ],
-                dim='time'
-            )
-            .to_netcdf(
-                new_file_name,
-                encoding={
-                    'ro': {'zlib': True, 'complevel': 9}
-                }
-            )
-        )
+from era5_to_zarr import collapse_expver
+
+
+def merge_expver_file(file: str, complevel: int = 1, time_chunk: int = 24) -> str:
+    """
+    Write a copy of an ERA5 file with the expver=1 and expver=5 values combined into a single time series
+
+    The file is read and written in chunks of time steps. Each chunk combines the expvers over the whole grid with
+    combine_first, so both expver layers are never held in memory for more than one chunk.
+
+    Args:
+        file: Path to the ERA5 netCDF file with an expver dimension
+        complevel: zlib compression level of the new file. Low levels with shuffle compress nearly as well as 9 in a
+            fraction of the time
+        time_chunk: Number of time steps read, combined and written at once
+
+    Returns:
+        str path to the new file
+    """
+    new_file_name = file.replace('.nc', '_noexpver_compressed.nc')
+    with xr.open_dataset(file, chunks={'time': time_chunk}) as ds:
+        merged = collapse_expver(ds)
+        encoding = {
+            var: {
+                'zlib': True,
+                'complevel': complevel,
+                'shuffle': True,
+                'chunksizes': tuple(min(time_chunk, s) if d == 'time' else s for d, s in merged[var].sizes.items()),
+            }
+            for var in merged.data_vars
+        }
+        with dask.config.set(scheduler='synchronous'):
+            merged.to_netcdf(f'{new_file_name}.part', format='NETCDF4', encoding=encoding)
+    os.replace(f'{new_file_name}.part', new_file_name)
+    return new_file_name
+
+
+def _merge_expver_file(args: tuple) -> str:
+    return merge_expver_file(*args)
+
+
+if __name__ == '__main__':
+    """
+    Combine the ERA5 and ERA5T (expver 1 and 5) values of ERA5 downloads which include the most recent months
+
+    Arguments:
+    --inputdir: Directory of ERA5 netCDF files with an expver dimension
+    --workers: Number of files to merge at the same time
+    --complevel: zlib compression level of the merged files
+    --timechunk: Number of time steps processed at once
+
+    Usage:
+    python merge_expver_variables.py --inputdir ./2023era5 --workers 4
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--inputdir', type=str, required=False, default='./2023era5',
+                        help='Directory of ERA5 netCDF files with an expver dimension')
+    parser.add_argument('--workers', type=int, required=False, default=os.cpu_count(),
+                        help='Number of files to merge at the same time')
+    parser.add_argument('--complevel', type=int, required=False, default=1,
+                        help='zlib compression level of the merged files')
+    parser.add_argument('--timechunk', type=int, required=False, default=24,
+                        help='Number of time steps processed at once')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        stream=sys.stdout)
+
+    files = [f for f in glob.glob(os.path.join(args.inputdir, '*.nc')) if not f.endswith('_noexpver_compressed.nc')]
+    logging.info(f'Merging expver in {len(files)} files')
+    with Pool(max(1, min(args.workers, len(files)))) as p:
+        for new_file in p.imap_unordered(_merge_expver_file, [(f, args.complevel, args.timechunk) for f in files]):
+            logging.info(f'Wrote {new_file}')
@@ -0,0 +1,287 @@
+import argparse
+import datetime
+import sys
+
+import netCDF4
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from runrapid import read_namelist
+
+# number of routed time steps held in memory before they are written to the Qout file
+WRITE_BLOCK = 256
+
+
+class MuskingumNetwork:
+    """
+    A river network prepared for solving the RAPID Muskingum equations
+
+    Reaches are put in the order of riv_bas_id, which is the order of the Qout and Qfinal files, and grouped into
+    topological levels: headwater reaches are level 0 and every other reach is one level below the deepest reach
+    flowing into it. All reaches in a level only depend on reaches in earlier levels so each level is solved at once.
+
+    Args:
+        k_file: Path to the csv of Muskingum k in seconds for each reach, in the order of riv_bas_id_file
+        x_file: Path to the csv of Muskingum x for each reach, in the order of riv_bas_id_file
+        rapid_connect_file: Path to the rapid_connect csv: rivid, downstream rivid, upstream count, upstream rivids
+        riv_bas_id_file: Path to the csv of rivids to route
+    """
+
+    def __init__(self, k_file: str, x_file: str, rapid_connect_file: str, riv_bas_id_file: str):
+        self.rivid = pd.read_csv(riv_bas_id_file, header=None).iloc[:, 0].to_numpy().astype('int64')
+        self.k = pd.read_csv(k_file, header=None).iloc[:, 0].to_numpy().astype('float64')
+        self.x = pd.read_csv(x_file, header=None).iloc[:, 0].to_numpy().astype('float64')
+        connect = pd.read_csv(rapid_connect_file, header=None, usecols=[0, 1])
+        assert self.k.size == self.x.size == self.rivid.size, 'k, x and riv_bas_id must have the same number of rows'
+
+        # N[i, j] is 1 when reach j flows into reach i. Reaches outside of riv_bas_id are not routed
+        position = pd.Series(np.arange(self.rivid.size), index=self.rivid)
+        upstream = connect[0].map(position)
+        downstream = connect[1].map(position)
+        links = upstream.notna() & downstream.notna()
+        n = self.rivid.size
+        self.network = scipy.sparse.csr_matrix(
+            (np.ones(links.sum()), (downstream[links].astype(int), upstream[links].astype(int))), shape=(n, n)
+        )
+
+        # the level of each reach is the length of the longest path from a headwater to it
+        level = np.zeros(n, dtype=int)
+        upstream_count = np.diff(self.network.indptr)
+        remaining = upstream_count.copy()
+        current = np.flatnonzero(remaining == 0)
+        depth = 0
+        solved = 0
+        network_csc = self.network.tocsc()
+        while current.size:
+            level[current] = depth
+            solved += current.size
+            # each reach in the current level reduces the unsolved upstream count of the reach it flows into
+            downstream_of_current = network_csc[:, current].tocoo().row
+            np.subtract.at(remaining, downstream_of_current, 1)
+            current = np.unique(downstream_of_current[remaining[downstream_of_current] == 0])
+            depth += 1
+        assert solved == n, 'rapid_connect contains a loop'
+        self.levels = [np.flatnonzero(level == d) for d in range(1, depth)]
+        self.level_networks = [self.network[idx] for idx in self.levels]
+
+    def coefficients(self, dt: float) -> tuple:
+        """
+        Muskingum coefficients of each reach for a routing time step
+
+        Args:
+            dt: The routing time step in seconds
+
+        Returns:
+            tuple of the C1, C2 and C3 arrays
+        """
+        denominator = self.k * (1 - self.x) + dt / 2
+        c1 = (dt / 2 - self.k * self.x) / denominator
+        c2 = (dt / 2 + self.k * self.x) / denominator
+        c3 = (self.k * (1 - self.x) - dt / 2) / denominator
+        return c1, c2, c3
+
+    def solve(self, rhs: np.ndarray, c1: np.ndarray) -> np.ndarray:
+        """
+        Solve (I - C1 N) Q = rhs level by level
+
+        Args:
+            rhs: The right hand side for each reach
+            c1: The C1 coefficient of each reach
+
+        Returns:
+            np.ndarray of discharge for each reach
+        """
+        q = rhs.copy()
+        for idx, level_network in zip(self.levels, self.level_networks):
+            q[idx] += c1[idx] * (level_network @ q)
+        return q
+
+    def route(self, q: np.ndarray, lateral: np.ndarray, dt: float, substeps: int) -> tuple:
+        """
+        Route one lateral inflow time step with substeps of the routing time step
+
+        Solves (I - C1 N) Q(t+dt) = C1 Qe + C2 (N Q(t) + Qe) + C3 Q(t) for each substep where Qe is the lateral inflow
+
+        Args:
+            q: Discharge at the start of the time step for each reach
+            lateral: Lateral inflow rate for each reach in m3/s, constant over the time step
+            dt: The routing time step in seconds
+            substeps: The number of routing time steps in the lateral inflow time step
+
+        Returns:
+            tuple of the discharge at the end of the time step and the average discharge over the substeps
+        """
+        c1, c2, c3 = self.coefficients(dt)
+        total = np.zeros_like(q)
+        for _ in range(substeps):
+            q = self.solve(c1 * lateral + c2 * (self.network @ q + lateral) + c3 * q, c1)
+            total += q
+        return q, total / substeps
+
+
+def read_qinit(qinit_file: str, rivid: np.ndarray) -> np.ndarray:
+    """
+    Read the initial discharge for each reach from the last time step of a Qfinal or Qout file
+
+    Args:
+        qinit_file: Path to the netCDF file
+        rivid: The rivids to read in order
+
+    Returns:
+        np.ndarray of discharge for each rivid, 0 for rivids missing from the file
+    """
+    with netCDF4.Dataset(qinit_file) as ds:
+        q = pd.Series(np.ma.filled(ds['Qout'][-1, :], 0).astype('float64'), index=ds['rivid'][:].astype('int64'))
+    return q.reindex(rivid).fillna(0).to_numpy()
+
+
+def create_qout_file(path: str, rivid: np.ndarray, vlat: netCDF4.Dataset, n_times: int = None) -> netCDF4.Dataset:
+    """
+    Create a Qout or Qfinal file with the same format, variables and attributes that RAPID writes
+
+    Args:
+        path: Path to the netCDF file
+        rivid: The rivids in the file
+        vlat: The open Vlat file to copy lat and lon from
+        n_times: Length of the time dimension, or None for an unlimited dimension
+
+    Returns:
+        The open netCDF4.Dataset
+    """
+    ds = netCDF4.Dataset(path, 'w', format='NETCDF3_64BIT_OFFSET')
+    ds.createDimension('time', n_times)
+    ds.createDimension('rivid', rivid.size)
+    ds.createDimension('nv', 2)
+
+    qout = ds.createVariable('Qout', 'f4', ('time', 'rivid'), fill_value=-9999.0)
+    qout.long_name = 'average river water discharge downstream of each river reach'
+    qout.units = 'm3 s-1'
+    qout.coordinates = 'lon lat'
+    qout.grid_mapping = 'crs'
+    qout.cell_methods = 'time: mean'
+
+    qout_err = ds.createVariable('Qout_err', 'f4', ('time', 'rivid'), fill_value=-9999.0)
+    qout_err.long_name = 'average river water discharge uncertainty downstream of each river reach'
+    qout_err.units = 'm3 s-1'
+    qout_err.coordinates = 'lon lat'
+    qout_err.grid_mapping = 'crs'
+    qout_err.cell_methods = 'time: mean'
+
+    rivid_var = ds.createVariable('rivid', 'i4', ('rivid',))
+    rivid_var.long_name = 'unique identifier for each river reach'
+    rivid_var.units = '1'
+    rivid_var.cf_role = 'timeseries_id'
+    rivid_var[:] = rivid
+
+    time_var = ds.createVariable('time', 'i4', ('time',))
+    time_var.standard_name = 'time'
+    time_var.long_name = 'time'
+    time_var.units = 'seconds since 1970-01-01 00:00:00 +00:00'
+    time_var.axis = 'T'
+    time_var.calendar = 'gregorian'
+    time_var.bounds = 'time_bnds'
+    ds.createVariable('time_bnds', 'i4', ('time', 'nv'))
+
+    vlat_rivid = pd.Index(vlat['rivid'][:].astype('int64'))
+    for name, standard_name, units, axis in (('lon', 'longitude', 'degrees_east', 'X'),
+                                             ('lat', 'latitude', 'degrees_north', 'Y')):
+        var = ds.createVariable(name, 'f8', ('rivid',), fill_value=-9999.0)
+        var.long_name = f'{standard_name} of a point related to each river reach'
+        var.standard_name = standard_name
+        var.units = units
+        var.axis = axis
+        if name in vlat.variables and vlat[name].dimensions == ('rivid',):
+            values = pd.Series(np.asarray(vlat[name][:], dtype='float64'), index=vlat_rivid)
+            var[:] = values.reindex(rivid).fillna(-9999.0).to_numpy()
+
+    crs = ds.createVariable('crs', 'i4')
+    crs.grid_mapping_name = 'latitude_longitude'
+    crs.epsg_code = 'EPSG:4326'
+    crs.semi_major_axis = 6378137.0
+    crs.inverse_flattening = 298.257223563
+
+    ds.Conventions = 'CF-1.6'
+    ds.featureType = 'timeSeries'
+    ds.title = 'RAPID discharge'
+    ds.source = 'muskingum.py'
+    ds.history = f'date created: {datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S+00:00")}'
+    return ds
+
+
+def route_namelist(namelist: str, network: MuskingumNetwork = None) -> None:
+    """
+    Route the Vlat file of a RAPID namelist and write its Qout and Qfinal files like RAPID would
+
+    Args:
+        namelist: Path to the namelist file
+        network: A network already read from the files in the namelist, e.g. to route many ensemble members
+
+    Returns:
+        None
+    """
+    options = read_namelist(namelist)
+    if network is None:
+        network = MuskingumNetwork(options['k_file'], options['x_file'], options['rapid_connect_file'],
+                                   options['riv_bas_id_file'])
+    tau_r = options['ZS_TauR']
+    dt = options['ZS_dtR']
+    substeps = max(1, round(tau_r / dt))
+    n_steps = round(options['ZS_TauM'] / tau_r)
+
+    q = np.zeros(network.rivid.size)
+    if options.get('BS_opt_Qinit') == '.true.' and options.get('Qinit_file'):
+        q = read_qinit(options['Qinit_file'], network.rivid)
+
+    with netCDF4.Dataset(options['Vlat_file']) as vlat:
+        # reorder the inflow columns to the order of riv_bas_id
+        columns = pd.Index(vlat['rivid'][:].astype('int64')).get_indexer(network.rivid)
+        assert (columns >= 0).all(), 'Some rivids in riv_bas_id are not in the Vlat file'
+        n_steps = min(n_steps, vlat['m3_riv'].shape[0])
+        times = vlat['time'][:n_steps]
+        time_bnds = vlat['time_bnds'][:n_steps] if 'time_bnds' in vlat.variables else None
+
+        # written in place like RAPID so progress can be read from the record count in the header. a partial file has
+        # fewer records than the namelist needs, which the resume check treats as incomplete
+        with create_qout_file(options['Qout_file'], network.rivid, vlat) as qout:
+            for start in range(0, n_steps, WRITE_BLOCK):
+                stop = min(start + WRITE_BLOCK, n_steps)
+                lateral = np.ma.filled(vlat['m3_riv'][start:stop], 0).astype('float64')[:, columns] / tau_r
+                block = np.empty((stop - start, network.rivid.size), dtype='float32')
+                for i in range(stop - start):
+                    q, block[i] = network.route(q, lateral[i], dt, substeps)
+                qout['Qout'][start:stop] = block
+                qout['time'][start:stop] = times[start:stop]
+                if time_bnds is not None:
+                    qout['time_bnds'][start:stop] = time_bnds[start:stop]
+                qout.sync()
+
+        if options.get('BS_opt_Qfinal') == '.true.' and options.get('Qfinal_file'):
+            with create_qout_file(options['Qfinal_file'], network.rivid, vlat, n_times=1) as qfinal:
+                qfinal['Qout'][0] = q
+                qfinal['time'][0] = times[-1] if n_steps else 0
+                if time_bnds is not None and n_steps:
+                    qfinal['time_bnds'][0] = time_bnds[-1]
+    return
+
+
+if __name__ == '__main__':
+    """
+    Route the inflows of a RAPID namelist with the Muskingum method without the RAPID executable
+
+    Takes the same --namelist argument as RAPID so it can be used in place of the RAPID executable. Other RAPID
+    (PETSc) options are ignored.
+
+    Usage:
+        python muskingum.py --namelist /path/to/namelist
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--namelist', type=str, required=True,
+                        help='Path to the RAPID namelist file', )
+    args, _ = parser.parse_known_args()
+
+    try:
+        route_namelist(args.namelist)
+    except Exception as e:
+        print(e, file=sys.stderr)
+        exit(1)
@@ -10,8 +10,8 @@
 # Last Updated: 2023-09-28
 # Purpose: postprocesses forecasts for a single computation region
 #          creates a table of styling information for mapping
-#          uses NCO to calculate ensemble statistics
-# Requirements: NCO, netCDF4, pandas, xarray
+#          calculates ensemble statistics in a single pass over the members
+# Requirements: netCDF4, numpy, pandas, pyarrow, xarray
 # tested python version: 3.11
 #################################################################
 
@@ -19,17 +19,169 @@ import argparse
 import glob
 import logging
 import os
-import subprocess as sp
 import sys
+import time
+from multiprocessing import Pool
 
 import netCDF4 as nc
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import xarray as xr
 
+RETURN_PERIODS = (2, 5, 10, 25, 50, 100)
+THICKNESS_THRESHOLDS = (20, 250, 1500, 10000, 30000)
+PERCENTILES = (10, 25, 50, 75, 90)
+
+
+def ensemble_statistics(qout_files: list, max_days: int = None) -> dict:
+    """
+    Calculate ensemble statistics by reading each member once and updating running statistics in preallocated arrays
+
+    Args:
+        qout_files: Paths to the Qout file of each ensemble member
+        max_days: Number of days after the first time step to read from each member. Defaults to every time step
+
+    Returns:
+        dict with the rivid and time coordinates and the mean, max, min and std (sample standard deviation) arrays
+        with shape (time, rivid)
+    """
+    stats = {}
+    for n, qout_file in enumerate(sorted(qout_files), start=1):
+        with xr.open_dataset(qout_file) as ds:
+            dates = pd.to_datetime(ds['time'].values)
+            if max_days is not None:
+                dates = dates[dates <= dates[0] + pd.Timedelta(days=max_days)]
+            qout = ds['Qout'].isel(time=slice(0, dates.shape[0])).transpose('time', 'rivid').values
+            if not stats:
+                stats = {
+                    'rivid': ds['rivid'].values,
+                    'time': dates,
+                    'mean': np.zeros(qout.shape, dtype=np.float64),
+                    'm2': np.zeros(qout.shape, dtype=np.float64),
+                    'max': np.full(qout.shape, np.nan, dtype=qout.dtype),
+                    'min': np.full(qout.shape, np.nan, dtype=qout.dtype),
+                }
+            elif not stats['time'].equals(dates) or not np.array_equal(stats['rivid'], ds['rivid'].values):
+                raise ValueError(f'Time or rivid coordinates of {qout_file} do not match the other ensemble members')
+
+        # welford's algorithm for a numerically stable running mean and variance
+        delta = qout - stats['mean']
+        stats['mean'] += delta / n
+        stats['m2'] += delta * (qout - stats['mean'])
+        np.fmax(stats['max'], qout, out=stats['max'])
+        np.fmin(stats['min'], qout, out=stats['min'])
+
+    # statistics are accumulated in float64 and returned with the dtype of the members like nces
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stats['std'] = np.sqrt(stats.pop('m2') / (n - 1)).astype(stats['max'].dtype)
+    stats['mean'] = stats['mean'].astype(stats['max'].dtype)
+    return stats
+
+
+def write_nces_file(template_file: str, qout: np.ndarray, stat: str, save_path: str) -> None:
+    """
+    Save an ensemble statistic with the variables and dimensions of the nces output it replaces
+
+    Args:
+        template_file: Path to the Qout file of one ensemble member to copy the coordinates and attributes from
+        qout: Array of the statistic with shape (time, rivid)
+        stat: Name of the nces operation the statistic matches, avg or max
+        save_path: Path to the netCDF file to save
+
+    Returns:
+        None
+    """
+    tmp_path = f'{save_path}.tmp'
+    with nc.Dataset(template_file) as src, nc.Dataset(tmp_path, 'w', format=src.data_model) as out:
+        out.setncatts({k: src.getncattr(k) for k in src.ncattrs()})
+        out.history = f'ensemble {stat} of Qout calculated by postprocess_geoglows_forecasts.py'
+        out.createDimension('time', qout.shape[0])
+        out.createDimension('rivid', qout.shape[1])
+        for name in ('time', 'rivid'):
+            var = out.createVariable(name, src[name].dtype, (name,))
+            var.setncatts({k: src[name].getncattr(k) for k in src[name].ncattrs() if k != '_FillValue'})
+            var[:] = src[name][:qout.shape[0]] if name == 'time' else src[name][:]
+        dims = src['Qout'].dimensions
+        var = out.createVariable('Qout', qout.dtype, dims, fill_value=getattr(src['Qout'], '_FillValue', None))
+        var.setncatts({k: src['Qout'].getncattr(k) for k in src['Qout'].ncattrs() if k != '_FillValue'})
+        var[:] = qout if dims == ('time', 'rivid') else qout.T
+    os.replace(tmp_path, save_path)
+    return
+
+
+def ensemble_percentiles(qout_files: list, save_path: str, memory_budget: int = 1024 ** 3) -> None:
+    """
+    Calculate percentiles across the ensemble members for every rivid and time step and save them to a netCDF
+
+    The members are read in blocks of rivids across all members so that only one block is held in memory at a time.
+
+    Args:
+        qout_files: Paths to the Qout file of each ensemble member
+        save_path: Path to the netCDF file to save the percentiles
+        memory_budget: Approximate number of bytes of Qout to hold in memory at once
+
+    Returns:
+        None
+    """
+    members = [nc.Dataset(f) for f in sorted(qout_files)]
+    try:
+        for ds in members:
+            ds.set_auto_mask(False)
+        first = members[0]
+        qout_dims = first['Qout'].dimensions
+        n_time = first.dimensions['time'].size
+        n_rivid = first.dimensions['rivid'].size
+        for ds in members:
+            if ds['Qout'].dimensions != qout_dims or ds['Qout'].shape != first['Qout'].shape:
+                raise ValueError(f'Qout in {ds.filepath()} does not match the other ensemble members')
+
+        # the block of members and the sorted copy made by np.percentile
+        block_size = max(1, int(memory_budget // (2 * len(members) * n_time * first['Qout'].dtype.itemsize)))
+        logging.info(f'Calculating percentiles in blocks of {block_size} rivids')
+
+        tmp_path = f'{save_path}.tmp'
+        with nc.Dataset(tmp_path, 'w') as out:
+            out.createDimension('percentile', len(PERCENTILES))
+            out.createDimension('time', n_time)
+            out.createDimension('rivid', n_rivid)
+            out.createVariable('percentile', 'i4', ('percentile',))[:] = PERCENTILES
+            for name in ('time', 'rivid'):
+                var = out.createVariable(name, first[name].dtype, (name,))
+                var.setncatts({k: first[name].getncattr(k) for k in first[name].ncattrs() if k != '_FillValue'})
+                var[:] = first[name][:]
+            qout = out.createVariable('Qout', 'f4', ('percentile', 'time', 'rivid'), zlib=True, complevel=1,
+                                      chunksizes=(1, n_time, min(block_size, n_rivid)))
+            qout.long_name = 'Percentiles of discharge across the ensemble members'
+            qout.units = 'm3 s-1'
+            out.description = f'Percentiles of {len(members)} ensemble members'
+
+            rivid_axis = qout_dims.index('rivid')
+            for start in range(0, n_rivid, block_size):
+                stop = min(start + block_size, n_rivid)
+                block = np.stack([
+                    np.moveaxis(ds['Qout'][(slice(None),) * rivid_axis + (slice(start, stop),)], rivid_axis, -1)
+                    for ds in members
+                ])
+                qout[:, :, start:stop] = np.percentile(block, PERCENTILES, axis=0)
+        os.replace(tmp_path, save_path)
+    finally:
+        for ds in members:
+            ds.close()
+    return
+
 
 def postprocess_vpu_forecast_directory(workspace: str,
                                        returnperiods: str,
-                                       nces_exec: str = 'nces', ):
+                                       percentiles: bool = False,
+                                       percentiles_memory: int = 1024 ** 3, ):
+    ensemble_files = [x for x in glob.glob(os.path.join(workspace, 'Qout*.nc')) if 'ens52' not in x]
+    percentiles_file = os.path.join(workspace, 'ensemble_percentiles.nc')
+    if percentiles and not os.path.exists(percentiles_file):
+        logging.info(f'Creating ensemble percentiles: {percentiles_file}')
+        ensemble_percentiles(ensemble_files, percentiles_file, percentiles_memory)
+
     # creates file name for the csv file
     date_string = os.path.split(workspace)[1].replace('.', '')
     region_name = os.path.basename(os.path.split(workspace)[0])
@@ -39,30 +191,20 @@ def postprocess_vpu_forecast_directory(workspace: str,
         return
     logging.info(f'Creating style table: {style_table_file_name}')
 
-    # calls NCO's nces function to calculate ensemble statistics for the max, mean, and min
-    # Qout. * ens([1 - 9] | [1 - 4][0 - 9] | 5[0 - 1])\.nc
+    # ensemble statistics of members 1-51. ens52 is the high resolution member
+    logging.info('Calculating ensemble statistics')
+    stats = ensemble_statistics(ensemble_files)
+    # the mean and max are still saved with the names and layout of the nces outputs for existing readers
+    for stat, key in (('avg', 'mean'), ('max', 'max')):
+        write_nces_file(sorted(ensemble_files)[0], stats[key], stat, os.path.join(workspace, f'nces.{stat}.nc'))
 
-    logging.info('Calling NCES statistics')
-    for stat in ['avg', 'max']:
-        findstr = ' '.join([x for x in glob.glob(os.path.join(workspace, 'Qout*.nc')) if 'ens52' not in x])
-        output_filename = os.path.join(workspace, 'nces.{0}.nc'.format(stat))
-        ncesstr = f"{nces_exec} -O --op_typ={stat} -o {output_filename}"
-        sp.call(f'{ncesstr} {findstr}', shell=True)
+    # the style table is limited to the first 10 days
+    first_days = stats['time'] <= stats['time'][0] + pd.Timedelta(days=10)
+    comids = stats['rivid']
+    dates = stats['time'][first_days]
 
-    # read the date and COMID lists from one of the netcdfs
-    with xr.open_dataset(glob.glob(os.path.join(workspace, 'nces.avg.nc'))[0]) as ds:
-        comids = ds['rivid'][:].values
-        dates = pd.to_datetime(ds['time'][:].values)
-        mean_flows = ds['Qout'][:].values.round(2)
-    with nc.Dataset(os.path.join(workspace, 'nces.max.nc')) as ds:
-        max_flows = ds['Qout'][:].round(2)
-
-    mean_flow_df = pd.DataFrame(mean_flows, columns=comids, index=dates)
-    max_flow_df = pd.DataFrame(max_flows, columns=comids, index=dates)
-
-    # limit both dataframes to the first 10 days
-    mean_flow_df = mean_flow_df[mean_flow_df.index <= mean_flow_df.index[0] + pd.Timedelta(days=10)]
-    max_flow_df = max_flow_df[max_flow_df.index <= max_flow_df.index[0] + pd.Timedelta(days=10)]
+    mean_flows = stats['mean'][first_days].round(2)
+    max_flows = stats['max'][first_days].round(2)
 
     # creating pandas dataframe with return periods
     rp_path = glob.glob(os.path.join(returnperiods, f'returnperiods*.nc*'))[0]
@@ -76,84 +218,132 @@ def postprocess_vpu_forecast_directory(workspace: str,
             'return_50': rp_ncfile.variables['rp50'][:],
             'return_100': rp_ncfile.variables['rp100'][:]
         }, index=rp_ncfile.variables['rivid'][:])
+    # (return periods, rivid) in the same rivid order as the forecast. missing rivers are never exceeded
+    rp_flows = rp_df.reindex(comids).to_numpy().T
+
+    # thickness is 1 plus the number of thresholds the mean flow is greater than or equal to
+    thickness = np.digitize(mean_flows, THICKNESS_THRESHOLDS) + 1
+    thickness[np.isnan(mean_flows)] = 1
 
-    mean_thickness_df = pd.DataFrame(columns=comids, index=dates, dtype=int)
-    mean_thickness_df[:] = 1
-    mean_thickness_df[mean_flow_df >= 20] = 2
-    mean_thickness_df[mean_flow_df >= 250] = 3
-    mean_thickness_df[mean_flow_df >= 1500] = 4
-    mean_thickness_df[mean_flow_df >= 10000] = 5
-    mean_thickness_df[mean_flow_df >= 30000] = 6
-
-    mean_ret_per_df = pd.DataFrame(columns=comids, index=dates, dtype=int)
-    mean_ret_per_df[:] = 0
-    mean_ret_per_df[mean_flow_df.gt(rp_df['return_2'], axis=1)] = 2
-    mean_ret_per_df[mean_flow_df.gt(rp_df['return_5'], axis=1)] = 5
-    mean_ret_per_df[mean_flow_df.gt(rp_df['return_10'], axis=1)] = 10
-    mean_ret_per_df[mean_flow_df.gt(rp_df['return_25'], axis=1)] = 25
-    mean_ret_per_df[mean_flow_df.gt(rp_df['return_50'], axis=1)] = 50
-    mean_ret_per_df[mean_flow_df.gt(rp_df['return_100'], axis=1)] = 100
-
-    mean_flow_df = mean_flow_df.stack().to_frame().rename(columns={0: 'mean'})
-    max_flow_df = max_flow_df.stack().to_frame().rename(columns={0: 'max'})
-    mean_thickness_df = mean_thickness_df.stack().to_frame().rename(columns={0: 'thickness'})
-    mean_ret_per_df = mean_ret_per_df.stack().to_frame().rename(columns={0: 'ret_per'})
-
-    # merge all dataframes
-    for df in [max_flow_df, mean_thickness_df, mean_ret_per_df]:
-        mean_flow_df = mean_flow_df.merge(df, left_index=True, right_index=True)
-    mean_flow_df.index.names = ['timestamp', 'comid']
-    mean_flow_df = mean_flow_df.reset_index()
-    mean_flow_df['mean'] = mean_flow_df['mean'].round(1)
-    mean_flow_df['max'] = mean_flow_df['max'].round(1)
-    mean_flow_df.loc[mean_flow_df['mean'] < 0, 'mean'] = 0
-    mean_flow_df.loc[mean_flow_df['max'] < 0, 'max'] = 0
-    mean_flow_df['thickness'] = mean_flow_df['thickness'].astype(int)
-    mean_flow_df['ret_per'] = mean_flow_df['ret_per'].astype(int)
-    mean_flow_df.to_parquet(os.path.join(workspace, style_table_file_name))
+    # ret_per is the largest return period whose flow is exceeded by the mean flow
+    ret_per = np.zeros(mean_flows.shape, dtype=np.int64)
+    for return_period, flows in zip(RETURN_PERIODS, rp_flows):
+        ret_per[mean_flows > flows] = return_period
+
+    # rows are ordered by timestamp then comid. rows without a mean or max flow are dropped
+    keep = ~(np.isnan(mean_flows) | np.isnan(max_flows)).ravel()
+    pq.write_table(
+        pa.table({
+            'timestamp': np.repeat(dates.values, comids.size)[keep],
+            'comid': np.tile(comids, dates.size)[keep],
+            'mean': np.maximum(mean_flows.round(1), 0).ravel()[keep],
+            'max': np.maximum(max_flows.round(1), 0).ravel()[keep],
+            'thickness': thickness.ravel()[keep].astype(np.int64),
+            'ret_per': ret_per.ravel()[keep],
+        }),
+        os.path.join(workspace, style_table_file_name)
+    )
     return
 
 
+def postprocess_vpu_forecasts(vpuoutputs: str,
+                              returnperiods: str,
+                              percentiles: bool = False,
+                              percentiles_memory: int = 1024 ** 3, ) -> tuple:
+    """
+    Postprocess every date sub-folder of the forecast outputs for a single VPU
+
+    Args:
+        vpuoutputs: Path to the forecast output directory for a single VPU which contains subdirectories with date names
+        returnperiods: Path to directory containing return periods nc files for the same VPU
+        percentiles: Also save the ensemble percentiles to ensemble_percentiles.nc in each date folder
+        percentiles_memory: Approximate number of bytes of Qout to hold in memory when calculating percentiles
+
+    Returns:
+        tuple: The VPU name, the number of date folders, and the elapsed seconds
+    """
+    start = time.time()
+    date_folders = sorted([d for d in glob.glob(os.path.join(vpuoutputs, '*')) if os.path.isdir(d)])
+    if not len(date_folders):
+        logging.info(f'No date sub-folders found in {vpuoutputs}')
+
+    for date_folder in date_folders:
+        postprocess_vpu_forecast_directory(date_folder, returnperiods, percentiles, percentiles_memory)
+    return os.path.basename(vpuoutputs), len(date_folders), time.time() - start
+
+
+def _postprocess_vpu_forecasts(args: tuple) -> tuple:
+    try:
+        return postprocess_vpu_forecasts(*args)
+    except Exception as e:
+        # one failed VPU should not stop the rest of the pool
+        logging.exception(f'Failed to postprocess {args[0]}: {e}')
+        return os.path.basename(args[0]), 0, None
+
+
 # runs function on file execution
 if __name__ == "__main__":
     """
     Arguments:
     --vpuoutputs: Path to the output directory for a single VPU which contains subdirectories with date names
-    --returnperiods: Path to directory containing return periods nc files for a single vpu.
+    --outputsdir: Path to the parent directory of the output directories for every VPU. Use instead of --vpuoutputs
+    --returnperiods: Path to directory containing return periods nc files for a single vpu. With --outputsdir, the
+                     parent directory containing a subdirectory of return periods for each VPU
+    --workers: Number of VPUs to postprocess at the same time when using --outputsdir
+    --percentiles: Also calculate the 10, 25, 50, 75 and 90th percentiles of the ensemble members
+    --percentilesmemory: GB of Qout each worker holds in memory when calculating percentiles
     --log: Path to the log file
-    --ncesexec: Path to the nces executable or recognized cli command if installed in environment.
-                Should be 'nces' if installed in environment using conda
+    --ncesexec: Removed. Ensemble statistics are calculated in python and still saved to nces.avg.nc and nces.max.nc
     """
     parser = argparse.ArgumentParser()
-    parser.add_argument("--vpuoutputs", required=True,
-                        help="Path to the forecast output directory for a single VPU which contains subdirectories "
-                             "with date names", )
+    outputs_group = parser.add_mutually_exclusive_group(required=True)
+    outputs_group.add_argument("--vpuoutputs",
+                               help="Path to the forecast output directory for a single VPU which contains "
+                                    "subdirectories with date names", )
+    outputs_group.add_argument("--outputsdir",
+                               help="Path to the parent directory of the forecast output directories for every VPU", )
     parser.add_argument("--returnperiods", required=True,
-                        help="Path to directory containing return periods nc files for a single vpu.", )
+                        help="Path to directory containing return periods nc files for a single vpu. With "
+                             "--outputsdir, the parent directory of the return periods directories for every VPU", )
+    parser.add_argument("--workers", type=int, required=False, default=os.cpu_count(),
+                        help="Number of VPUs to postprocess at the same time when using --outputsdir", )
+    parser.add_argument("--percentiles", action='store_true', default=False,
+                        help="Also calculate the 10, 25, 50, 75 and 90th percentiles of the ensemble members", )
+    parser.add_argument("--percentilesmemory", type=float, required=False, default=1,
+                        help="GB of Qout each worker holds in memory when calculating percentiles", )
     parser.add_argument("--log", required=False,
                         help="Path to the log file", )
-    parser.add_argument("--ncesexec", required=False, default='nces',
-                        help="Path to the nces executable or recognized cli command if installed in environment. "
-                             "Should be 'nces' if installed in environment using conda", )
+    parser.add_argument("--ncesexec", required=False, default=None,
+                        help="Removed. Ensemble statistics are calculated in python and still saved to nces.avg.nc "
+                             "and nces.max.nc", )
 
     args = parser.parse_args()
-    vpuoutputs = args.vpuoutputs
-    nces = args.ncesexec
+    if args.ncesexec is not None:
+        parser.error('--ncesexec is no longer supported. NCO is not called, the ensemble statistics are calculated in '
+                     'python and saved to nces.avg.nc and nces.max.nc')
     returnperiods = args.returnperiods
+    percentiles_memory = int(args.percentilesmemory * 1024 ** 3)
 
     logging.basicConfig(level=logging.INFO,
                         format='%(asctime)s %(levelname)s %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S',
                         stream=sys.stdout, )
 
-    # output directory
-    date_folders = list(glob.glob(os.path.join(vpuoutputs, '*')))
-    date_folders = sorted([d for d in date_folders if os.path.isdir(d)])
-
-    if not len(date_folders):
-        logging.info(f'No date sub-folders found in {vpuoutputs}')
+    if args.vpuoutputs:
+        postprocess_vpu_forecasts(args.vpuoutputs, returnperiods, args.percentiles, percentiles_memory)
         exit(0)
 
-    # run the postprocessing function
-    for date_folder in date_folders:
-        postprocess_vpu_forecast_directory(date_folder, returnperiods, nces)
+    vpu_dirs = sorted([d for d in glob.glob(os.path.join(args.outputsdir, '*')) if os.path.isdir(d)])
+    jobs = [
+        (d, os.path.join(returnperiods, os.path.basename(d)), args.percentiles, percentiles_memory) for d in vpu_dirs
+    ]
+    logging.info(f'Postprocessing {len(jobs)} VPUs with {args.workers} workers')
+
+    start = time.time()
+    with Pool(min(args.workers, max(len(jobs), 1))) as p:
+        for vpu, n_dates, elapsed in p.imap_unordered(_postprocess_vpu_forecasts, jobs):
+            if elapsed is None:
+                logging.info(f'VPU {vpu}: FAILED')
+                continue
+            logging.info(f'VPU {vpu}: {n_dates} date folders in {elapsed:.1f} seconds')
+    logging.info(f'Postprocessed {len(jobs)} VPUs in {time.time() - start:.1f} seconds')
@@ -0,0 +1,148 @@
+import json
+import logging
+
+import dask
+import numpy as np
+import xarray as xr
+
+QUANTIZE_METHODS = ('none', 'bitround', 'int16', 'int32')
+
+# number of mantissa bits and the unsigned integer type with the same size as each float type
+_FLOAT_BITS = {
+    np.dtype('float32'): (23, np.uint32),
+    np.dtype('float64'): (52, np.uint64),
+}
+
+
+def bitround(values: np.ndarray, keepbits: int) -> np.ndarray:
+    """
+    Round floats to a number of significant mantissa bits, to the nearest value with ties to even
+
+    The dropped bits are zeros so the values compress much better while the relative error stays below
+    2 ** -(keepbits + 1). NaN and infinity are unchanged.
+
+    Args:
+        values: float32 or float64 array
+        keepbits: Number of mantissa bits to keep, 23 or more for float32 keeps every bit
+
+    Returns:
+        np.ndarray of rounded values with the same dtype
+    """
+    mantissa_bits, uint = _FLOAT_BITS[values.dtype]
+    if keepbits >= mantissa_bits:
+        return values
+    drop = mantissa_bits - keepbits
+    bits = np.ascontiguousarray(values).view(uint).copy()
+    # add half of the dropped range, plus 1 if the last kept bit is odd to round ties to even, then zero the rest
+    half = uint((1 << (drop - 1)) - 1)
+    last_kept = (bits >> uint(drop)) & uint(1)
+    rounded = ((bits + half + last_kept) & ~uint((1 << drop) - 1)).view(values.dtype)
+    return np.where(np.isfinite(values), rounded, values)
+
+
+def packing_parameters(minimum: float, maximum: float, dtype: str) -> dict:
+    """
+    CF scale_factor and add_offset which map a range of values onto a signed integer type
+
+    The most negative integer is kept as the fill value for missing values.
+
+    Args:
+        minimum: Smallest value to pack
+        maximum: Largest value to pack
+        dtype: int16 or int32
+
+    Returns:
+        dict of the xarray encoding dtype, scale_factor, add_offset and _FillValue
+    """
+    info = np.iinfo(dtype)
+    steps = int(info.max) - int(info.min) - 1
+    scale_factor = (maximum - minimum) / steps if maximum > minimum else 1.0
+    add_offset = minimum + (int(info.max) * scale_factor if maximum > minimum else 0.0)
+    return {
+        'dtype': dtype,
+        'scale_factor': float(scale_factor),
+        'add_offset': float(add_offset),
+        '_FillValue': int(info.min),
+    }
+
+
+def quantize(ds: xr.Dataset, variables: list, method: str = 'none', keepbits: int = 12) -> tuple:
+    """
+    Quantize variables of a dataset before it is written to netCDF or Zarr
+
+    bitround changes the values and keeps the float type. int16 and int32 pack the values as integers with a
+    scale_factor and add_offset in the encoding. For packing, the returned dataset holds the values as they will read
+    back from the file so the error can be measured with quantization_report before writing. Packing computes the
+    range of each variable here, which reads the data once before the write.
+
+    Args:
+        ds: The dataset to write
+        variables: Names of the variables to quantize
+        method: none, bitround, int16 or int32
+        keepbits: Mantissa bits kept by bitround
+
+    Returns:
+        tuple of the quantized dataset and a dict of encoding updates for each variable
+    """
+    assert method in QUANTIZE_METHODS, f'method must be one of {QUANTIZE_METHODS}'
+    encoding = {}
+    if method == 'none':
+        return ds, encoding
+    ds = ds.copy()
+    variables = [v for v in variables if v in ds.data_vars]
+    if method == 'bitround':
+        for var in variables:
+            ds[var] = xr.apply_ufunc(bitround, ds[var], kwargs={'keepbits': keepbits}, dask='parallelized',
+                                     output_dtypes=[ds[var].dtype], keep_attrs=True)
+        return ds, encoding
+
+    finite = {v: ds[v].where(np.isfinite(ds[v])) for v in variables}
+    minimums, maximums = dask.compute([finite[v].min() for v in variables], [finite[v].max() for v in variables])
+    for var, minimum, maximum in zip(variables, minimums, maximums):
+        params = packing_parameters(float(minimum), float(maximum), method)
+        encoding[var] = params
+        scale, offset = params['scale_factor'], params['add_offset']
+        attrs = ds[var].attrs
+        # kept as float64 so the values are exactly on the integer grid when they are packed
+        ds[var] = np.round((ds[var].astype('float64') - offset) / scale) * scale + offset
+        ds[var].attrs = attrs
+    return ds, encoding
+
+
+def quantization_report(original: xr.Dataset, quantized: xr.Dataset, variables: list, write=None) -> dict:
+    """
+    Maximum absolute and relative error of each quantized variable
+
+    Relative errors are measured where the original value is not 0.
+
+    Args:
+        original: The dataset before quantize
+        quantized: The dataset returned by quantize
+        variables: Names of the quantized variables
+        write: A delayed write of the quantized dataset, e.g. to_netcdf(compute=False). It is computed with the errors
+            so the write and the errors share 1 read of the source files
+
+    Returns:
+        dict of the max_abs_error and max_rel_error of each variable
+    """
+    variables = [v for v in variables if v in original.data_vars]
+    errors = []
+    for var in variables:
+        error = abs(quantized[var].astype('float64') - original[var].astype('float64'))
+        relative = (error / abs(original[var].astype('float64'))).where(original[var] != 0)
+        errors.append((error.max(), relative.max()))
+    errors, _ = dask.compute(errors, write)
+    return {
+        var: {'max_abs_error': float(abs_error), 'max_rel_error': float(rel_error)}
+        for var, (abs_error, rel_error) in zip(variables, errors)
+    }
+
+
+def log_report(report: dict, output: str, report_file: str = None) -> None:
+    """Log the quantization report of an output file and optionally append it as a json line to report_file"""
+    for var, errors in report.items():
+        logging.info(f'Quantized {var} in {output}: max abs error {errors["max_abs_error"]:.6g}, '
+                     f'max rel error {errors["max_rel_error"]:.6g}')
+    if report_file:
+        with open(report_file, 'a') as f:
+            f.write(json.dumps({'output': output, 'errors': report}) + '\n')
@@ -0,0 +1,312 @@
+import argparse
+import itertools
+import logging
+import math
+import os
+import shutil
+import sys
+from multiprocessing import Pool
+
+import zarr
+from dask.utils import parse_bytes
+from numcodecs import Blosc
+
+# chunk sizes along (time, rivid) of each layout, -1 is the full length of the dimension
+LAYOUT_CHUNKS = {
+    'map': (1, 1_000_000),
+    'timeseries': (-1, 200),
+}
+# only the array being rechunked is held in memory, compressed chunk buffers are assumed to take up to the same again
+MEMORY_FACTOR = 2
+# fewer workers are used rather than splitting the memory limit into intermediate chunks smaller than this
+MIN_INTERMEDIATE_CHUNK_BYTES = 10_000_000
+# more intermediate chunks than this per array cost more in file system overhead than the copy itself
+MAX_INTERMEDIATE_CHUNKS = 100_000
+
+intermediate_compressor = Blosc(cname='lz4', clevel=1, shuffle=Blosc.SHUFFLE)
+
+
+def target_chunks(array: zarr.Array, time_chunk: int, rivid_chunk: int) -> tuple:
+    """
+    Chunks of an array in the new layout. Only arrays with both a time and rivid dimension are rechunked
+
+    Args:
+        array: An array of the source store
+        time_chunk: Number of time steps in a chunk, -1 for every time step
+        rivid_chunk: Number of rivids in a chunk, -1 for every rivid
+
+    Returns:
+        tuple of the chunk size along each dimension
+    """
+    dims = array.attrs.get('_ARRAY_DIMENSIONS', [])
+    if 'time' not in dims or 'rivid' not in dims:
+        return array.chunks
+    sizes = {'time': time_chunk, 'rivid': rivid_chunk}
+    return tuple(
+        chunk if dim not in sizes else (size if sizes[dim] == -1 else min(size, sizes[dim]))
+        for dim, size, chunk in zip(dims, array.shape, array.chunks)
+    )
+
+
+def block_shape(shape: tuple, source_chunks: tuple, target_chunks: tuple, itemsize: int, max_mem: int,
+                grow_axes: tuple) -> tuple:
+    """
+    Largest block which starts and ends on the chunk boundaries of both arrays and fits in memory
+
+    The smallest such block holds the least common multiple of the 2 chunk sizes on each axis. It is then grown along
+    grow_axes, in order, until it would not fit in max_mem.
+
+    Args:
+        shape: Shape of the array
+        source_chunks: Chunks of the array read from
+        target_chunks: Chunks of the array written to
+        itemsize: Bytes per value
+        max_mem: Bytes of memory a block may use
+        grow_axes: Axes to grow the block along
+
+    Returns:
+        tuple of the block size along each axis
+    """
+    block = [min(size, math.lcm(a, b)) for size, a, b in zip(shape, source_chunks, target_chunks)]
+    if math.prod(block) * itemsize * MEMORY_FACTOR > max_mem:
+        raise ValueError(f'A block of {block} values needs more than the {max_mem} byte memory limit per worker. '
+                         f'Raise the limit, use fewer workers, or use chunk sizes which divide each other')
+    for axis in grow_axes:
+        unit = block[axis]
+        other = math.prod(block) // block[axis] * itemsize * MEMORY_FACTOR
+        block[axis] = min(shape[axis], max(1, max_mem // (other * unit)) * unit)
+        if block[axis] < shape[axis]:
+            break
+    return tuple(block)
+
+
+def _copy_block(task: dict) -> None:
+    """Copy 1 block between arrays of 2 stores"""
+    source = zarr.open_group(task['source'], mode='r')[task['name']]
+    target = zarr.open_group(task['target'], mode='r+')[task['name']]
+    target[task['selection']] = source[task['selection']]
+
+
+def copy_array(source_path: str, target_path: str, name: str, block: tuple, workers: int = 1) -> None:
+    """
+    Copy an array between stores 1 block at a time, with each block read and written by 1 worker
+
+    Args:
+        source_path: Path to the store read from
+        target_path: Path to the store written to, which already has the array created
+        name: Name of the array
+        block: Size of the blocks along each axis
+        workers: Number of processes copying blocks
+
+    Returns:
+        None
+    """
+    shape = zarr.open_group(source_path, mode='r')[name].shape
+    tasks = [
+        {
+            'source': source_path,
+            'target': target_path,
+            'name': name,
+            'selection': tuple(slice(start, min(start + size, length)) for start, size, length in
+                               zip(starts, block, shape)),
+        }
+        for starts in itertools.product(*[range(0, length, size) for length, size in zip(shape, block)])
+    ]
+    if workers == 1:
+        for task in tasks:
+            _copy_block(task)
+        return
+    with Pool(workers) as p:
+        for _ in p.imap_unordered(_copy_block, tasks):
+            pass
+    return
+
+
+def create_like(group: zarr.Group, array: zarr.Array, name: str, chunks: tuple, compressor=None,
+                filters=None) -> zarr.Array:
+    """Create an empty array with the shape, dtype, fill value, and attributes of another array"""
+    new = group.create_dataset(
+        name,
+        shape=array.shape,
+        chunks=chunks,
+        dtype=array.dtype,
+        compressor=compressor,
+        filters=filters,
+        fill_value=array.fill_value,
+        overwrite=True,
+    )
+    new.attrs.update(array.attrs.asdict())
+    return new
+
+
+def plan_arrays(source: zarr.Group, time_chunk: int, rivid_chunk: int, worker_mem: int) -> list:
+    """
+    Plan the chunks of the target and intermediate arrays and the blocks each pass copies
+
+    Args:
+        source: The store to rechunk
+        time_chunk: Number of time steps in a chunk of the target, -1 for every time step
+        rivid_chunk: Number of rivids in a chunk of the target, -1 for every rivid
+        worker_mem: Bytes of memory a block may use
+
+    Returns:
+        list of (name, array, target chunks, intermediate chunks or None if the array is only copied, blocks of each
+        pass)
+    """
+    plans = []
+    for name, array in source.arrays():
+        chunks = target_chunks(array, time_chunk, rivid_chunk)
+        itemsize = array.dtype.itemsize
+        if chunks == array.chunks:
+            block = block_shape(array.shape, chunks, chunks, itemsize, worker_mem, tuple(range(array.ndim)))
+            plans.append((name, array, chunks, None, (block, )))
+            continue
+        # grow blocks along the axes where the source chunks are larger first so they are read whole in pass 1 and
+        # the other axes first in pass 2 so each intermediate chunk is read once
+        grow_axes = tuple(sorted(range(array.ndim), key=lambda axis: array.chunks[axis] < chunks[axis]))
+        # the intermediate chunks are as large as both the pass 1 writes and pass 2 reads allow, like rechunker, so
+        # they are sized by the memory limit rather than the smaller of the source and target chunks
+        read_block = block_shape(array.shape, array.chunks, array.chunks, itemsize, worker_mem, grow_axes)
+        write_block = block_shape(array.shape, chunks, chunks, itemsize, worker_mem, grow_axes[::-1])
+        mid_chunks = tuple(min(a, b) for a, b in zip(read_block, write_block))
+        blocks = (
+            block_shape(array.shape, array.chunks, mid_chunks, itemsize, worker_mem, grow_axes),
+            block_shape(array.shape, mid_chunks, chunks, itemsize, worker_mem, grow_axes[::-1]),
+        )
+        plans.append((name, array, chunks, mid_chunks, blocks))
+    return plans
+
+
+def rechunk_store(source_path: str, target_path: str, layout: str, time_chunk: int = None, rivid_chunk: int = None,
+                  max_mem: str = '2GB', intermediate_path: str = None, workers: int = 1,
+                  keep_intermediate: bool = False) -> None:
+    """
+    Copy a retrospective Zarr store to a new store with the chunks of a different layout in bounded memory
+
+    Each array is copied in 2 passes through an intermediate store on disk. Its chunks are the smaller, on each axis,
+    of the largest block of source chunks and the largest block of target chunks that fit in the memory of 1 worker.
+    Each pass reads and writes blocks which cover whole chunks of both arrays, so no chunk is written twice and no
+    more than max_mem is held at once. Fewer workers are used if sharing max_mem between all of them would make
+    intermediate chunks smaller than MIN_INTERMEDIATE_CHUNK_BYTES. The layout is recorded in the store attributes.
+
+    Args:
+        source_path: Path to the store to rechunk
+        target_path: Path to the new store
+        layout: map (few time steps, many rivids per chunk) or timeseries (every time step, few rivids per chunk)
+        time_chunk: Number of time steps in a chunk, -1 for every time step. Defaults to LAYOUT_CHUNKS
+        rivid_chunk: Number of rivids in a chunk, -1 for every rivid. Defaults to LAYOUT_CHUNKS
+        max_mem: Memory limit of all workers together, e.g. 2GB
+        intermediate_path: Path to the intermediate store. Defaults to the target path with .intermediate appended
+        workers: Most processes copying blocks. Each gets an equal share of max_mem
+        keep_intermediate: Keep the intermediate store instead of deleting it after the target is complete
+
+    Returns:
+        None
+    """
+    assert layout in LAYOUT_CHUNKS, f'layout must be one of {list(LAYOUT_CHUNKS)}'
+    time_chunk = LAYOUT_CHUNKS[layout][0] if time_chunk is None else time_chunk
+    rivid_chunk = LAYOUT_CHUNKS[layout][1] if rivid_chunk is None else rivid_chunk
+    intermediate_path = intermediate_path or f'{target_path.rstrip(os.sep)}.intermediate'
+    total_mem = parse_bytes(max_mem)
+
+    source = zarr.open_group(source_path, mode='r')
+
+    # plan the blocks of every array first so a memory limit that is too small fails before anything is written
+    for n_workers in range(workers, 0, -1):
+        try:
+            plans = plan_arrays(source, time_chunk, rivid_chunk, total_mem // n_workers)
+        except ValueError:
+            if n_workers == 1:
+                raise
+            continue
+        if all(
+            math.prod(mid_chunks) * array.dtype.itemsize >= min(MIN_INTERMEDIATE_CHUNK_BYTES, array.nbytes)
+            for name, array, chunks, mid_chunks, blocks in plans if mid_chunks is not None
+        ):
+            break
+    if n_workers < workers:
+        logging.warning(f'Using {n_workers} of {workers} workers so each has enough of the {max_mem} memory limit for '
+                        f'intermediate chunks of at least {MIN_INTERMEDIATE_CHUNK_BYTES / 1e6:.0f} MB')
+    workers = n_workers
+
+    for name, array, chunks, mid_chunks, blocks in plans:
+        if mid_chunks is None:
+            continue
+        n_chunks = math.prod(math.ceil(size / chunk) for size, chunk in zip(array.shape, mid_chunks))
+        if n_chunks > MAX_INTERMEDIATE_CHUNKS:
+            logging.error(f'{name} would be written to {n_chunks} intermediate chunks of {mid_chunks}. Raise the '
+                          f'memory limit to make the intermediate chunks larger')
+
+    target = zarr.open_group(target_path, mode='w')
+    intermediate = zarr.open_group(intermediate_path, mode='w')
+    target.attrs.update({**source.attrs.asdict(), 'layout': layout})
+
+    for name, array, chunks, mid_chunks, blocks in plans:
+        create_like(target, array, name, chunks, array.compressor, array.filters)
+        if mid_chunks is None:
+            logging.info(f'Copying {name}')
+            copy_array(source_path, target_path, name, blocks[0], workers)
+            continue
+
+        create_like(intermediate, array, name, mid_chunks, intermediate_compressor)
+        logging.info(f'Rechunking {name} from {array.chunks} to {chunks} through {mid_chunks} '
+                     f'({math.prod(mid_chunks) * array.dtype.itemsize / 1e6:.2f} MB intermediate chunks)')
+        logging.info(f'Pass 1: blocks of {blocks[0]}')
+        copy_array(source_path, intermediate_path, name, blocks[0], workers)
+        logging.info(f'Pass 2: blocks of {blocks[1]}')
+        copy_array(intermediate_path, target_path, name, blocks[1], workers)
+
+    zarr.consolidate_metadata(target_path)
+    if not keep_intermediate:
+        shutil.rmtree(intermediate_path)
+    logging.info(f'Finished {target_path}')
+    return
+
+
+if __name__ == '__main__':
+    """
+    Make a copy of a retrospective Zarr store chunked for a different access pattern in bounded memory
+
+    Arguments:
+    --source: Path to the store to rechunk
+    --target: Path to the new store
+    --layout: map for reading all rivids at few times, timeseries for reading all times at few rivids
+    --timechunk: Number of time steps in a chunk, -1 for every time step. Defaults depend on the layout
+    --rividchunk: Number of rivids in a chunk, -1 for every rivid. Defaults depend on the layout
+    --maxmem: Memory limit, e.g. 2GB
+    --intermediate: Path to the intermediate store. Defaults to the target path with .intermediate appended
+    --workers: Most processes copying blocks. Fewer are used if the memory limit is too small to share between them
+    --keepintermediate: Keep the intermediate store
+
+    Usage:
+    python rechunk_retro_zarr.py --source /mnt/geoglows_v2_retrospective.zarr --target /mnt/geoglows_v2_maps.zarr
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', type=str, required=False, default='/mnt/geoglows_v2_retrospective.zarr',
+                        help='Path to the store to rechunk')
+    parser.add_argument('--target', type=str, required=False, default='/mnt/geoglows_v2_maps.zarr',
+                        help='Path to the new store')
+    parser.add_argument('--layout', type=str, required=False, default='map', choices=list(LAYOUT_CHUNKS),
+                        help='Access pattern to chunk the new store for')
+    parser.add_argument('--timechunk', type=int, required=False, default=None,
+                        help='Number of time steps in a chunk, -1 for every time step')
+    parser.add_argument('--rividchunk', type=int, required=False, default=None,
+                        help='Number of rivids in a chunk, -1 for every rivid')
+    parser.add_argument('--maxmem', type=str, required=False, default='2GB',
+                        help='Memory limit, e.g. 2GB')
+    parser.add_argument('--intermediate', type=str, required=False, default=None,
+                        help='Path to the intermediate store')
+    parser.add_argument('--workers', type=int, required=False, default=1,
+                        help='Most processes copying blocks')
+    parser.add_argument('--keepintermediate', action='store_true', default=False,
+                        help='Keep the intermediate store')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(message)s',
+        stream=sys.stdout,
+    )
+
+    rechunk_store(args.source, args.target, args.layout, args.timechunk, args.rividchunk, args.maxmem,
+                  args.intermediate, args.workers, args.keepintermediate)
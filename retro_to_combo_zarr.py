@@ -1,3 +1,4 @@
+import argparse
 import logging
 import os
 import sys
@@ -7,11 +8,8 @@ import xarray as xr
 from dask.diagnostics import ProgressBar
 from numcodecs import Blosc
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s %(message)s',
-    stream=sys.stdout,
-)
+from benchmark_codecs import read_codec_profile, zarr_encoding
+from quantize import QUANTIZE_METHODS, log_report, quantization_report, quantize
 
 global_attributes = {
     'author': 'Riley Hales, PhD',
@@ -20,59 +18,85 @@ global_attributes = {
     'source': 'GEOGloWS Hydrologic Model v2',
     'history': 'Created 2024-01-29',
     'references': 'https://geoglows.org/',
+    # every chunk holds all time steps of some rivids, rechunk_retro_zarr.py makes the map layout copy
+    'layout': 'timeseries',
 }
 
-# set up a progress bar
-progress = ProgressBar()
-progress.register()
-
-with dask.config.set(**{
-    'array.slicing.split_large_chunks': True,
-    'array.chunk-size': '5MB',
-}):
-    for decade in range(1940, 2030, 10):
-        logging.info(f'opening dataset {decade}')
-        # filter the dataset to only include the current year
-        output_file = f'/mnt/geoglows_v2_retrospective_{decade}.zarr'
-        if os.path.exists(output_file):
-            logging.info(f'Skipping {output_file}')
-            continue
-
-        with xr.open_mfdataset(f'/mnt/outputs/*/Qout_*_{str(decade)[:3]}*0101*.nc',
-                               concat_dim='rivid',
-                               combine='nested', ) as ds:
-            logging.info('dropping variables')
-            ds = ds.drop('crs').drop('Qout_err').drop('lat').drop('lon').drop('time_bnds')
-            ds.attrs = global_attributes
-            chunk_sizes = {
-                'time': ds.variables['time'].shape[0],
-                'rivid': "auto",
-            }
-            zarr_compressor = Blosc(cname='zstd', clevel=9, shuffle=Blosc.BITSHUFFLE)
-            zarr_enc = {
-                x: {'compressor': zarr_compressor} for x in ds.variables
-            }
-            logging.info('chunking')
-            ds = ds.chunk(chunk_sizes)
-            logging.info(f'Writing to {output_file}')
-            with dask.config.set(scheduler='threads'):
-                delayed_task = (
-                    ds
-                    .to_zarr(
-                        output_file,
-                        zarr_version=2,
-                        encoding=zarr_enc,
-                        compute=False,
-                    )
+
+def decade_to_zarr(outputs_dir: str, decade: int, output_file: str, codec_profile: dict = None) -> None:
+    """
+    Write the Qout files of every VPU for a decade to a single Zarr store
+
+    The values are not quantized so that combine_decades quantizes, and measures the error against, the model output.
+
+    Args:
+        outputs_dir: Directory containing subdirectories of Qout files for each VPU
+        decade: First year of the decade
+        output_file: Path to the Zarr store
+        codec_profile: A codec profile from benchmark_codecs.py. If None, every variable uses Blosc zstd 9 with
+            bitshuffle
+
+    Returns:
+        None
+    """
+    with xr.open_mfdataset(os.path.join(outputs_dir, '*', f'Qout_*_{str(decade)[:3]}*0101*.nc'),
+                           concat_dim='rivid',
+                           combine='nested', ) as ds:
+        logging.info('dropping variables')
+        ds = ds.drop('crs').drop('Qout_err').drop('lat').drop('lon').drop('time_bnds')
+        ds.attrs = global_attributes
+        chunk_sizes = {
+            'time': ds.variables['time'].shape[0],
+            'rivid': "auto",
+        }
+        zarr_compressor = Blosc(cname='zstd', clevel=9, shuffle=Blosc.BITSHUFFLE)
+        zarr_enc = zarr_encoding(codec_profile, list(ds.variables), {'compressor': zarr_compressor})
+        logging.info('chunking')
+        ds = ds.chunk(chunk_sizes)
+        logging.info(f'Writing to {output_file}')
+        with dask.config.set(scheduler='threads'):
+            delayed_task = (
+                ds
+                .to_zarr(
+                    output_file,
+                    zarr_version=2,
+                    encoding=zarr_enc,
+                    compute=False,
                 )
+            )
 
-                # compute the task
-                dask.compute(delayed_task)
-                logging.info('Done')
+            # compute the task
+            dask.compute(delayed_task)
+            logging.info('Done')
+    return
+
+
+def combine_decades(decade_files: str,
+                    output_file: str,
+                    codec_profile: dict = None,
+                    quantize_method: str = 'none',
+                    keepbits: int = 12,
+                    quantize_variables: list = ('Qout',),
+                    report_file: str = None, ) -> None:
+    """
+    Combine the Zarr stores of each decade into a single Zarr store with 1 chunk along time
+
+    This is the only step that quantizes, so the error report compares against the unquantized decade stores.
 
-    # combine the all-vpu-1-year-files into a single larger zarr file
-    logging.info('opening yearly zarr files')
-    with xr.open_mfdataset('/mnt/geoglows_v2_retrospective_*.zarr',
+    Args:
+        decade_files: Glob pattern of the Zarr stores of each decade
+        output_file: Path to the combined Zarr store
+        codec_profile: A codec profile from benchmark_codecs.py. If None, every variable uses Blosc zstd 9 with
+            bitshuffle
+        quantize_method: none, bitround, int16 or int32. See quantize.py
+        keepbits: Mantissa bits kept by bitround
+        quantize_variables: Names of the variables to quantize
+        report_file: Path to append the quantization error of the store to as json lines
+
+    Returns:
+        None
+    """
+    with xr.open_mfdataset(decade_files,
                            concat_dim='time',
                            combine='nested',
                            parallel=True,
@@ -83,23 +107,96 @@ with dask.config.set(**{
             'rivid': "auto",
         }
         zarr_compressor = Blosc(cname='zstd', clevel=9, shuffle=Blosc.BITSHUFFLE)
-        zarr_enc = {
-            x: {'compressor': zarr_compressor} for x in ds.variables
-        }
+        zarr_enc = zarr_encoding(codec_profile, list(ds.variables), {'compressor': zarr_compressor})
         logging.info('chunking')
         ds = ds.chunk(chunk_sizes)
-        logging.info('Writing to /mnt/geoglows_v2_retrospective.zarr')
+        quantized, quantize_encoding = quantize(ds, quantize_variables, quantize_method, keepbits)
+        for var, params in quantize_encoding.items():
+            zarr_enc.setdefault(var, {}).update(params)
+        logging.info(f'Writing to {output_file}')
         with dask.config.set(scheduler='threads'):
             delayed_task = (
-                ds
+                quantized
                 .to_zarr(
-                    '/mnt/geoglows_v2_retrospective.zarr',
+                    output_file,
                     zarr_version=2,
                     encoding=zarr_enc,
                     compute=False,
                 )
             )
 
-            # compute the task
-            dask.compute(delayed_task)
+            # compute the task, together with the quantization errors so the write and the errors share 1 read of the
+            # decade stores. Packing to int16 or int32 reads them once more before this in quantize to find the range
+            if quantize_method == 'none':
+                dask.compute(delayed_task)
+            else:
+                report = quantization_report(ds, quantized, quantize_variables, delayed_task)
+                log_report(report, output_file, report_file)
             logging.info('Done')
+    return
+
+
+if __name__ == '__main__':
+    """
+    Write the retrospective Qout files of every VPU to 1 Zarr store per decade then combine them into a single store
+
+    Arguments:
+    --outputsdir: Directory containing subdirectories of Qout files for each VPU
+    --zarrdir: Directory to save the Zarr stores
+    --codecprofile: Codec profile from benchmark_codecs.py. Defaults to Blosc zstd 9 with bitshuffle
+    --quantize: none, bitround, int16, or int32. Applied once, when the decades are combined
+    --keepbits: Mantissa bits kept by --quantize bitround
+    --quantizevars: Variables to quantize
+    --quantizereport: Path to append the quantization error of each store to as json lines
+
+    Usage:
+    python retro_to_combo_zarr.py --outputsdir /mnt/outputs --zarrdir /mnt --codecprofile codecs.json
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--outputsdir', type=str, required=False, default='/mnt/outputs',
+                        help='Directory containing subdirectories of Qout files for each VPU')
+    parser.add_argument('--zarrdir', type=str, required=False, default='/mnt',
+                        help='Directory to save the Zarr stores')
+    parser.add_argument('--codecprofile', type=str, required=False, default=None,
+                        help='Codec profile from benchmark_codecs.py')
+    parser.add_argument('--quantize', type=str, required=False, default='none', choices=QUANTIZE_METHODS,
+                        help='Round to significant bits or pack as integers before compressing')
+    parser.add_argument('--keepbits', type=int, required=False, default=12,
+                        help='Mantissa bits kept by --quantize bitround')
+    parser.add_argument('--quantizevars', type=str, nargs='+', required=False, default=['Qout'],
+                        help='Variables to quantize')
+    parser.add_argument('--quantizereport', type=str, required=False, default=None,
+                        help='Path to append the quantization error of each store to as json lines')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(message)s',
+        stream=sys.stdout,
+    )
+
+    profile = read_codec_profile(args.codecprofile)
+
+    # set up a progress bar
+    progress = ProgressBar()
+    progress.register()
+
+    with dask.config.set(**{
+        'array.slicing.split_large_chunks': True,
+        'array.chunk-size': '5MB',
+    }):
+        for decade in range(1940, 2030, 10):
+            logging.info(f'opening dataset {decade}')
+            # filter the dataset to only include the current year
+            output_file = os.path.join(args.zarrdir, f'geoglows_v2_retrospective_{decade}.zarr')
+            if os.path.exists(output_file):
+                logging.info(f'Skipping {output_file}')
+                continue
+            decade_to_zarr(args.outputsdir, decade, output_file, profile)
+
+        # combine the all-vpu-1-year-files into a single larger zarr file
+        logging.info('opening yearly zarr files')
+        # digits only so other stores in zarrdir, like the output of rechunk_retro_zarr.py, are not read as decades
+        combine_decades(os.path.join(args.zarrdir, 'geoglows_v2_retrospective_[0-9]*.zarr'),
+                        os.path.join(args.zarrdir, 'geoglows_v2_retrospective.zarr'),
+                        profile, args.quantize, args.keepbits, args.quantizevars, args.quantizereport)
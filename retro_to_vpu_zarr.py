@@ -1,3 +1,4 @@
+import argparse
 import glob
 import logging
 import os
@@ -6,27 +7,43 @@ from numcodecs import Blosc
 
 import xarray as xr
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s %(message)s',
-    stream=sys.stdout,
-)
+from benchmark_codecs import read_codec_profile, zarr_encoding
+from quantize import QUANTIZE_METHODS, log_report, quantization_report, quantize
 
-vpu_dirs = [d for d in sorted(glob.glob('/Volumes/EB406_T7_2/geoglows2/v2_retrospective_outputs/*')) if os.path.isdir(d)]
+global_attributes = {
+    'author': 'Riley Hales, PhD',
+    'title': f'GEOGloWS v2 Retrospective Discharge',
+    'institution': 'Brigham Young University',
+    'source': 'GEOGloWS v2',
+    'history': 'Created 2023-10-13',
+    'references': 'https://geoglows.ecmwf.int/',
+    'layout': 'timeseries',
+}
 
-for vpu_dir in vpu_dirs:
-    vpu_number = os.path.basename(vpu_dir)
-    logging.info(f'Processing VPU {vpu_number}')
 
-    global_attributes = {
-        'author': 'Riley Hales, PhD',
-        'title': f'GEOGloWS v2 Retrospective Discharge',
-        'institution': 'Brigham Young University',
-        'source': 'GEOGloWS v2',
-        'history': 'Created 2023-10-13',
-        'references': 'https://geoglows.ecmwf.int/',
-    }
+def vpu_to_zarr(vpu_dir: str,
+                output_file: str,
+                codec_profile: dict = None,
+                quantize_method: str = 'none',
+                keepbits: int = 12,
+                quantize_variables: list = ('Qout',),
+                report_file: str = None, ) -> None:
+    """
+    Write the decadal Qout files of a VPU to a Zarr store with 1 chunk along time
 
+    Args:
+        vpu_dir: Directory of the decadal Qout .nc4 files of a VPU
+        output_file: Path to the Zarr store
+        codec_profile: A codec profile from benchmark_codecs.py. If None, every variable uses Blosc zstd 9 with
+            bitshuffle
+        quantize_method: none, bitround, int16 or int32. See quantize.py
+        keepbits: Mantissa bits kept by bitround
+        quantize_variables: Names of the variables to quantize
+        report_file: Path to append the quantization error of the store to as json lines
+
+    Returns:
+        None
+    """
     with xr.open_mfdataset(glob.glob(os.path.join(vpu_dir, 'Qout*.nc4'))) as ds:
         ds = ds.drop('crs').drop('Qout_err').drop('lat').drop('lon').drop('time_bnds')
         ds.attrs = global_attributes
@@ -36,23 +53,80 @@ for vpu_dir in vpu_dirs:
             'rivid': "auto",
         }
         zarr_compressor = Blosc(cname='zstd', clevel=9, shuffle=Blosc.BITSHUFFLE)
-        zarr_enc = {
-            x: {'compressor': zarr_compressor} for x in ds.variables
-        }
+        zarr_enc = zarr_encoding(codec_profile, list(ds.variables), {'compressor': zarr_compressor})
         ds = ds.chunk(chunk_sizes)
-        output_dir = f'/Volumes/DrHalesT7/retroouputs/'
-        os.makedirs(output_dir, exist_ok=True)
-        combined_output_file_name = os.path.join(output_dir, f'qout_geoglows_v2.zarr')
-
-        if os.path.exists(combined_output_file_name):
-            logging.info(f'Skipping {combined_output_file_name}')
-
-        (
-            ds
+        quantized, quantize_encoding = quantize(ds, quantize_variables, quantize_method, keepbits)
+        for var, params in quantize_encoding.items():
+            zarr_enc.setdefault(var, {}).update(params)
+        write = (
+            quantized
             .to_zarr(
-                combined_output_file_name,
+                output_file,
                 zarr_version=2,
                 encoding=zarr_enc,
+                compute=False,
             )
         )
+        if quantize_method == 'none':
+            write.compute()
+        else:
+            log_report(quantization_report(ds, quantized, quantize_variables, write), output_file, report_file)
+    return
+
+
+if __name__ == '__main__':
+    """
+    Write the decadal Qout files of each VPU to its own Zarr store
+
+    Arguments:
+    --outputsdir: Directory containing subdirectories of decadal Qout files for each VPU
+    --zarrdir: Directory to save the Zarr store of each VPU
+    --codecprofile: Codec profile from benchmark_codecs.py. Defaults to Blosc zstd 9 with bitshuffle
+    --quantize: none, bitround, int16, or int32
+    --keepbits: Mantissa bits kept by --quantize bitround
+    --quantizevars: Variables to quantize
+    --quantizereport: Path to append the quantization error of each store to as json lines
+
+    Usage:
+    python retro_to_vpu_zarr.py --outputsdir /mnt/outputs --zarrdir /mnt/retro --codecprofile codecs.json
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--outputsdir', type=str, required=False,
+                        default='/Volumes/EB406_T7_2/geoglows2/v2_retrospective_outputs',
+                        help='Directory containing subdirectories of decadal Qout files for each VPU')
+    parser.add_argument('--zarrdir', type=str, required=False,
+                        default='/Volumes/DrHalesT7/retroouputs/',
+                        help='Directory to save the Zarr store of each VPU')
+    parser.add_argument('--codecprofile', type=str, required=False, default=None,
+                        help='Codec profile from benchmark_codecs.py')
+    parser.add_argument('--quantize', type=str, required=False, default='none', choices=QUANTIZE_METHODS,
+                        help='Round to significant bits or pack as integers before compressing')
+    parser.add_argument('--keepbits', type=int, required=False, default=12,
+                        help='Mantissa bits kept by --quantize bitround')
+    parser.add_argument('--quantizevars', type=str, nargs='+', required=False, default=['Qout'],
+                        help='Variables to quantize')
+    parser.add_argument('--quantizereport', type=str, required=False, default=None,
+                        help='Path to append the quantization error of each store to as json lines')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(message)s',
+        stream=sys.stdout,
+    )
+
+    profile = read_codec_profile(args.codecprofile)
+    os.makedirs(args.zarrdir, exist_ok=True)
+
+    vpu_dirs = [d for d in sorted(glob.glob(os.path.join(args.outputsdir, '*'))) if os.path.isdir(d)]
+    for vpu_dir in vpu_dirs:
+        vpu_number = os.path.basename(vpu_dir)
+        logging.info(f'Processing VPU {vpu_number}')
+        output_file_name = os.path.join(args.zarrdir, f'qout_geoglows_v2_{vpu_number}.zarr')
+
+        if os.path.exists(output_file_name):
+            logging.info(f'Skipping {output_file_name}')
+            continue
 
+        vpu_to_zarr(vpu_dir, output_file_name, profile, args.quantize, args.keepbits, args.quantizevars,
+                    args.quantizereport)
@@ -1,35 +1,462 @@
 import argparse
 import datetime
 import glob
+import json
 import os
+import sqlite3
+import statistics
 import subprocess
-from multiprocessing import Pool
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from check_rapid_progress import time_dimension_length
+
+# memory of a RAPID process before it reads the river network
+BASE_MEMORY_KB = 50 * 1024
+
+telemetry_lock = threading.Lock()
 
 
 def timestamp():
     return datetime.datetime.utcnow().strftime('%Y-%m-%d %X')
 
 
+def read_namelist(namelist: str) -> dict:
+    """
+    Read the options of a RAPID namelist file
+
+    Args:
+        namelist: Path to the namelist file
+
+    Returns:
+        dict of option names to values. Quotes are removed from strings and numbers are converted to int or float
+    """
+    options = {}
+    with open(namelist) as f:
+        for line in f:
+            if '=' not in line:
+                continue
+            key, value = (x.strip() for x in line.split('=', 1))
+            value = value.strip("'")
+            for parse in (int, float):
+                try:
+                    value = parse(value)
+                    break
+                except ValueError:
+                    pass
+            options[key] = value
+    return options
+
+
+def namelist_work(namelist_dir: str, namelists: list = None) -> float:
+    """
+    Estimate the work in a directory of namelists as the number of reaches times the number of routing time steps
+
+    Args:
+        namelist_dir: Path to a directory of namelist files for a single watershed
+        namelists: Only count these namelist files instead of every namelist in the directory
+
+    Returns:
+        float: reach count x routing time step count summed over every namelist
+    """
+    work = 0
+    for namelist in namelists if namelists is not None else glob.glob(os.path.join(namelist_dir, '*namelist*')):
+        options = read_namelist(namelist)
+        work += options.get('IS_riv_bas', 0) * options.get('ZS_TauM', 0) / (options.get('ZS_dtR') or 1)
+    return work
+
+
+def namelist_is_complete(namelist: str) -> bool:
+    """
+    Check if the outputs of a namelist were completely written by a previous run
+
+    The Qout file must have every time step, ZS_TauM / ZS_dtM, and the Qfinal file must exist and have a time step if
+    the namelist writes one.
+
+    Args:
+        namelist: Path to the namelist file
+
+    Returns:
+        bool: True if the Qout and Qfinal files are complete
+    """
+    options = read_namelist(namelist)
+    qout_file = options.get('Qout_file', '')
+    if not qout_file or not os.path.exists(qout_file):
+        return False
+    expected_steps = round(options.get('ZS_TauM', 0) / (options.get('ZS_dtM') or 1))
+    if time_dimension_length(qout_file) < expected_steps:
+        return False
+    if options.get('BS_opt_Qfinal') == '.true.':
+        qfinal_file = options.get('Qfinal_file', '')
+        return bool(qfinal_file) and os.path.exists(qfinal_file) and time_dimension_length(qfinal_file) > 0
+    return True
+
+
+def record_run(history_db: str, watershed_id: str, wall_time: float, max_rss_kb: int, work: float) -> None:
+    """
+    Save the wall time and peak memory of running a watershed to the history database
+
+    Args:
+        history_db: Path to the sqlite database
+        watershed_id: Name of the namelist directory
+        wall_time: Seconds to run every namelist of the watershed
+        max_rss_kb: Peak resident memory of the largest single RAPID process, i.e. of 1 MPI rank, in kilobytes
+        work: The namelist_work of the watershed
+
+    Returns:
+        None
+    """
+    with sqlite3.connect(history_db, timeout=60) as con:
+        con.execute('CREATE TABLE IF NOT EXISTS runs '
+                    '(watershed_id TEXT, finished TEXT, wall_time REAL, max_rss_kb INTEGER, work REAL)')
+        con.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?)',
+                    (watershed_id, timestamp(), wall_time, max_rss_kb, work))
+    con.close()
+    return
+
+
+def read_history(history_db: str, last_n: int = 5) -> dict:
+    """
+    Read the median wall time and peak memory of the last runs of each watershed
+
+    Args:
+        history_db: Path to the sqlite database
+        last_n: Number of most recent runs of each watershed to use
+
+    Returns:
+        dict of watershed id to a dict with the median wall_time, max_rss_kb, work and seconds_per_work
+    """
+    if not os.path.exists(history_db):
+        return {}
+    with sqlite3.connect(history_db, timeout=60) as con:
+        try:
+            rows = con.execute('SELECT watershed_id, wall_time, max_rss_kb, work FROM runs '
+                               'ORDER BY finished DESC').fetchall()
+        except sqlite3.OperationalError:
+            rows = []
+    con.close()
+
+    runs = {}
+    for watershed_id, wall_time, max_rss_kb, work in rows:
+        runs.setdefault(watershed_id, [])
+        if len(runs[watershed_id]) < last_n:
+            runs[watershed_id].append((wall_time, max_rss_kb, work))
+    return {
+        watershed_id: {
+            'wall_time': statistics.median(r[0] for r in watershed_runs),
+            'max_rss_kb': statistics.median(r[1] for r in watershed_runs),
+            'work': statistics.median(r[2] for r in watershed_runs),
+            'seconds_per_work': statistics.median(r[0] / r[2] for r in watershed_runs if r[2])
+            if any(r[2] for r in watershed_runs) else None,
+        }
+        for watershed_id, watershed_runs in runs.items()
+    }
+
+
+def estimate_wall_times(namelists_dirs: list, history: dict) -> dict:
+    """
+    Estimate the wall time of each namelist directory from its run history
+
+    Every watershed is estimated as its namelist_work times a number of seconds per unit of work. Runs may have only
+    done part of the work, e.g. when resumed, so the seconds per work of a watershed's own runs are used rather than
+    their wall time. Watersheds without history use the median seconds per work of the watersheds with history. If
+    there is no history at all there is no rate to convert work to seconds, so every estimate is None.
+
+    Args:
+        namelists_dirs: Paths to the directories of namelists for each watershed
+        history: Output of read_history
+
+    Returns:
+        dict of namelist directory to estimated wall time in seconds, or None without any history
+    """
+    seconds_per_work = [h['seconds_per_work'] for h in history.values() if h['seconds_per_work']]
+    if not seconds_per_work:
+        return {d: None for d in namelists_dirs}
+    seconds_per_work = statistics.median(seconds_per_work)
+    estimates = {}
+    for d in namelists_dirs:
+        watershed_history = history.get(os.path.basename(d), {})
+        estimates[d] = namelist_work(d) * (watershed_history.get('seconds_per_work') or seconds_per_work)
+    return estimates
+
+
+def estimate_memory_kb(namelist_dir: str, history: dict, memory_factor: float = 50, ranks: int = 1) -> float:
+    """
+    Estimate the peak memory of running RAPID for a watershed
+
+    Uses the peak memory of past runs if there are any. The history only has the peak of the largest single process,
+    so it is multiplied by the number of ranks. Otherwise the memory is estimated as a fixed amount plus memory_factor
+    times the size of the rapid_connect file named in the first namelist, plus the fixed amount for each extra rank.
+
+    Args:
+        namelist_dir: Path to a directory of namelist files for a single watershed
+        history: Output of read_history
+        memory_factor: Bytes of memory per byte of rapid_connect file
+        ranks: Number of MPI processes the watershed is run with
+
+    Returns:
+        float: estimated peak memory in kilobytes
+    """
+    watershed_id = os.path.basename(namelist_dir)
+    if watershed_id in history and history[watershed_id]['max_rss_kb']:
+        return history[watershed_id]['max_rss_kb'] * ranks
+    namelists = sorted(glob.glob(os.path.join(namelist_dir, '*namelist*')))
+    if not namelists:
+        return BASE_MEMORY_KB * ranks
+    rapid_connect_file = read_namelist(namelists[0]).get('rapid_connect_file', '')
+    connect_size = os.path.getsize(rapid_connect_file) if os.path.exists(rapid_connect_file) else 0
+    return BASE_MEMORY_KB * ranks + memory_factor * connect_size / 1024
+
+
+def reservation(head: dict, running: list, free_cpus: int, free_memory: float, now: float) -> tuple:
+    """
+    Find when a job which does not fit yet can start and what resources will be left over when it does
+
+    Running jobs are assumed to finish at their start time plus their estimate, or now if they are overdue. A job that
+    needs more than the whole budget can start once every running job has finished and leaves nothing over. If a
+    running job has no estimate the reservation time is unknown and nothing is left over.
+
+    Args:
+        head: The job to reserve resources for
+        running: List of (job, start time) of the running jobs
+        free_cpus: Cpus not used by the running jobs
+        free_memory: Memory in kilobytes not used by the running jobs
+        now: The current time
+
+    Returns:
+        tuple of the reservation time, or None if it is unknown, and the cpus and memory that will be free beyond what
+        head needs at that time
+    """
+    if any(job.get('estimate') is None for job, _ in running):
+        return None, 0, 0
+    cpus, memory = free_cpus, free_memory
+    shadow_time = now
+    for job, started in sorted(running, key=lambda r: r[1] + r[0]['estimate']):
+        shadow_time = max(now, started + job['estimate'])
+        cpus += job['ranks']
+        memory += job['memory_kb']
+        if head['ranks'] <= cpus and head['memory_kb'] <= memory:
+            return shadow_time, cpus - head['ranks'], memory - head['memory_kb']
+    return shadow_time, 0, 0
+
+
+def run_jobs_with_resource_limits(jobs: list, run_job: callable, on_done: callable, cpus: int,
+                                  memory_kb: float) -> None:
+    """
+    Run jobs concurrently without exceeding a number of cpus or a memory budget
+
+    Jobs are started in list order. When the next job does not fit in the free resources, its resources are reserved
+    from the time the running jobs are estimated to free them. Later jobs that fit are started instead only if they
+    are estimated to finish before that time or fit in what the reserved job leaves over, so free cores are used
+    without delaying the reserved job. Jobs without an estimate are never started early and, while running, keep any
+    job from starting early since the reservation time is unknown. A job that needs more than the whole budget is
+    started once nothing else is running.
+
+    Args:
+        jobs: List of dicts with 'ranks', 'memory_kb' and 'estimate' (seconds or None) keys plus the arguments for
+            run_job
+        run_job: Function called with each job dict in a worker thread
+        on_done: Function called in this thread with the result of each job
+        cpus: Number of cpus to share between the jobs
+        memory_kb: Memory budget in kilobytes to share between the jobs
+
+    Returns:
+        None
+    """
+    pending = list(jobs)
+    running = {}
+    free_cpus = cpus
+    free_memory = memory_kb
+    with ThreadPoolExecutor(max_workers=cpus) as executor:
+        while pending or running:
+            now = time.time()
+            blocked = False
+            for job in list(pending):
+                fits = job['ranks'] <= free_cpus and job['memory_kb'] <= free_memory
+                if not blocked:
+                    start = fits or not running
+                    if not start:
+                        blocked = True
+                        shadow_time, extra_cpus, extra_memory = reservation(
+                            job, list(running.values()), free_cpus, free_memory, now)
+                        continue
+                elif not fits:
+                    continue
+                elif (shadow_time is not None and job.get('estimate') is not None
+                      and now + job['estimate'] <= shadow_time):
+                    start = True
+                elif job['ranks'] <= extra_cpus and job['memory_kb'] <= extra_memory:
+                    # still running when the reserved job starts so it uses the resources left over from it
+                    extra_cpus -= job['ranks']
+                    extra_memory -= job['memory_kb']
+                    start = True
+                else:
+                    continue
+                pending.remove(job)
+                running[executor.submit(run_job, job)] = (job, now)
+                free_cpus -= job['ranks']
+                free_memory -= job['memory_kb']
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job, _ = running.pop(future)
+                free_cpus += job['ranks']
+                free_memory += job['memory_kb']
+                try:
+                    on_done(future.result())
+                except Exception as e:
+                    print(f'Failed to run {job["namelist_dir"]}: {e}')
+    return
+
+
+def write_telemetry(telemetry_file: str, record: dict) -> None:
+    """
+    Append a record of a RAPID run as a line of JSON
+
+    Args:
+        telemetry_file: Path to the JSON lines file
+        record: Measurements of a single RAPID run
+
+    Returns:
+        None
+    """
+    with telemetry_lock, open(telemetry_file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    return
+
+
+def telemetry_report(telemetry_file: str) -> None:
+    """
+    Print the throughput of each watershed and RAPID executable in a telemetry file
+
+    Throughput is the number of reaches times routing time steps computed per wall second.
+
+    Args:
+        telemetry_file: Path to the JSON lines file written by write_telemetry
+
+    Returns:
+        None
+    """
+    groups = {}
+    with open(telemetry_file) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                groups.setdefault((record['watershed_id'], record['rapid_exec']), []).append(record)
+
+    print(f'{"watershed":<12} {"runs":>5} {"failed":>6} {"wall h":>8} {"cpu h":>8} {"rank rss GB":>11} '
+          f'{"reach-steps/s":>14}  rapid')
+    for (watershed_id, rapid_exec), records in sorted(groups.items()):
+        succeeded = [r for r in records if r['exit_code'] == 0 and r['wall_time'] > 0]
+        throughput = [
+            r['reaches'] * r['simulated_seconds'] / r['routing_time_step'] / r['wall_time']
+            for r in succeeded if r['reaches'] and r['routing_time_step']
+        ]
+        print(f'{watershed_id:<12} {len(records):>5} {len(records) - len(succeeded):>6} '
+              f'{sum(r["wall_time"] for r in records) / 3600:>8.2f} '
+              f'{sum(r["user_time"] + r["sys_time"] for r in records) / 3600:>8.2f} '
+              f'{max(r["max_rss_kb_per_rank"] for r in records) / 1024 ** 2:>11.2f} '
+              f'{statistics.median(throughput) if throughput else 0:>14.0f}  {rapid_exec}')
+    return
+
+
 def run_rapid_for_namelist_directory(namelist_dir: str,
                                      path_rapid_exec: str = '/home/rapid/src/rapid',
-                                     logdir: str = '/mnt/logs') -> None:
+                                     logdir: str = '/mnt/logs',
+                                     mpi_ranks: int = 1,
+                                     mpiexec: str = 'mpiexec',
+                                     resume: bool = False,
+                                     telemetry_file: str = None,
+                                     engine: str = 'rapid', ) -> dict or None:
     watershed_id = os.path.basename(namelist_dir)
-    with open(os.path.join(logdir, f"{watershed_id}.log"), 'w') as f:
-        for namelist in sorted(glob.glob(os.path.join(namelist_dir, '*namelist*'))):
+    if engine == 'python':
+        # muskingum.py takes the same arguments as RAPID and runs in its own process to be measured the same way
+        path_rapid_exec = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'muskingum.py')
+        command = [sys.executable, path_rapid_exec]
+        solver_options = []
+    elif mpi_ranks > 1:
+        # preonly is only exact with the serial direct solver so parallel runs use RAPID's default iterative solver
+        command = [mpiexec, '-n', str(mpi_ranks), path_rapid_exec]
+        solver_options = []
+    else:
+        command = [path_rapid_exec]
+        solver_options = ['--ksp_type', 'preonly']
+    start = time.time()
+    max_rss_kb = 0
+    failed = False
+    namelists = sorted(glob.glob(os.path.join(namelist_dir, '*namelist*')))
+    if resume:
+        # each namelist starts from the Qfinal of the one before so the chain restarts at the first incomplete one
+        completed = 0
+        while completed < len(namelists) and namelist_is_complete(namelists[completed]):
+            completed += 1
+        namelists = namelists[completed:]
+    with open(os.path.join(logdir, f"{watershed_id}.log"), 'a') as f:
+        if resume:
+            f.write(f'{timestamp()}: Resuming after {completed} completed namelists\n')
+        for namelist in namelists:
+            options = read_namelist(namelist)
+            record = {
+                'time': timestamp(),
+                'watershed_id': watershed_id,
+                'namelist': namelist,
+                'rapid_exec': path_rapid_exec,
+                'mpi_ranks': mpi_ranks,
+                'reaches': options.get('IS_riv_bas'),
+                'simulated_seconds': options.get('ZS_TauM'),
+                'routing_time_step': options.get('ZS_dtR'),
+                'exit_code': None,
+                'wall_time': 0,
+                'user_time': 0,
+                'sys_time': 0,
+                # wait4 on mpiexec reports the peak of the largest single process it waited for, i.e. 1 rank, and
+                # not the total of every rank. user_time and sys_time do add up every process it waited for
+                'max_rss_kb_per_rank': 0,
+            }
+            namelist_start = time.time()
             try:
-                f.write(f'{timestamp()}: Running RAPID for {namelist}')
-                subprocess.call(
-                    [path_rapid_exec, '--namelist', namelist, '--ksp_type', 'preonly'],
+                f.write(f'{timestamp()}: Running RAPID for {namelist}\n')
+                f.flush()
+                process = subprocess.Popen(
+                    [*command, '--namelist', namelist, *solver_options],
                     stdout=f,
                     stderr=f,
                 )
-                f.write(f'{timestamp()}: Finished RAPID for {namelist}')
+                # wait4 returns the resource usage of this child only
+                _, status, rusage = os.wait4(process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(status)
+                max_rss_kb = max(max_rss_kb, rusage.ru_maxrss)
+                record.update({
+                    'exit_code': process.returncode,
+                    'user_time': rusage.ru_utime,
+                    'sys_time': rusage.ru_stime,
+                    'max_rss_kb_per_rank': rusage.ru_maxrss,
+                })
+                if process.returncode == 0:
+                    f.write(f'{timestamp()}: Finished RAPID for {namelist}\n')
+                else:
+                    failed = True
+                    f.write(f'{timestamp()}: RAPID exited with code {process.returncode} for {namelist}\n')
             except Exception as e:
                 print(e)
-                f.write(e)
-                f.write(f'Failed to run RAPID for {namelist}')
+                f.write(f'{e}\n')
+                f.write(f'Failed to run RAPID for {namelist}\n')
+                record['error'] = str(e)
+                failed = True
+            record['wall_time'] = time.time() - namelist_start
+            if telemetry_file:
+                write_telemetry(telemetry_file, record)
 
-    return
+    # failed runs stop early so their wall time would be a misleading history record
+    if not namelists or failed:
+        return None
+    return {
+        'watershed_id': watershed_id,
+        'wall_time': time.time() - start,
+        'max_rss_kb': max_rss_kb,
+        'work': namelist_work(namelist_dir, namelists),
+    }
 
 
 if __name__ == '__main__':
@@ -59,36 +486,93 @@ if __name__ == '__main__':
     parser.add_argument('--rapidexec', type=str, required=False,
                         default='/home/rapid/src/rapid',
                         help='Path to rapid executable', )
-    parser.add_argument('--sortdirs', type=bool, action='store_true',
+    parser.add_argument('--sortdirs', action=argparse.BooleanOptionalAction,
                         default=True,
-                        help='Order computations by large to small watershed size', )
+                        help='Start the watersheds with the longest expected run time first', )
+    parser.add_argument('--historydb', type=str, required=False,
+                        default=None,
+                        help='Path to the sqlite database of past run times. Defaults to rapid_history.sqlite in '
+                             'the log directory', )
+    parser.add_argument('--cpus', type=int, required=False,
+                        default=os.cpu_count(),
+                        help='Number of cpus to share between RAPID processes', )
+    parser.add_argument('--memory', type=float, required=False,
+                        default=os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * 0.9 / 1024 ** 3,
+                        help='GB of memory to share between RAPID processes. Defaults to 90%% of the system memory', )
+    parser.add_argument('--memoryfactor', type=float, required=False,
+                        default=50,
+                        help='Bytes of memory per byte of rapid_connect file for watersheds without run history', )
+    parser.add_argument('--mpilargest', type=int, required=False,
+                        default=0,
+                        help='Number of watersheds with the longest expected run time to run with mpiexec', )
+    parser.add_argument('--mpiranks', type=int, required=False,
+                        default=4,
+                        help='Number of MPI processes for each watershed run with mpiexec', )
+    parser.add_argument('--mpiexec', type=str, required=False,
+                        default='mpiexec',
+                        help='Path to the mpiexec executable', )
+    parser.add_argument('--telemetry', type=str, required=False,
+                        default=None,
+                        help='Path to the JSON lines file of measurements of each RAPID run. Defaults to '
+                             'rapid_telemetry.jsonl in the log directory', )
+    parser.add_argument('--report', action='store_true',
+                        default=False,
+                        help='Print the throughput of each watershed from the telemetry file and exit', )
+    parser.add_argument('--resume', action='store_true',
+                        default=False,
+                        help='Skip namelists whose Qout and Qfinal files are complete and continue the chain of '
+                             'namelists from the first incomplete one', )
+    parser.add_argument('--engine', type=str, required=False,
+                        default='rapid', choices=['rapid', 'python'],
+                        help='Route with the RAPID executable or with muskingum.py, which needs no RAPID or MPI', )
 
     args = parser.parse_args()
     path_to_rapid_exec = args.rapidexec
     namelists_dirs = args.namelistsdir
     logs_dir = args.logdir
     sort_dirs = args.sortdirs
+    history_db = args.historydb or os.path.join(logs_dir, 'rapid_history.sqlite')
+    telemetry_file = args.telemetry or os.path.join(logs_dir, 'rapid_telemetry.jsonl')
+
+    if args.report:
+        telemetry_report(telemetry_file)
+        exit(0)
 
     namelists_dirs = [d for d in glob.glob(os.path.join(namelists_dirs, '*')) if os.path.isdir(d)]
-    sorted_order = (
-        605, 714, 109, 302, 609, 122, 402, 303, 304, 502, 214, 406, 105, 111, 804, 106, 409, 503, 404, 706, 103, 412,
-        703, 508, 715, 501, 513, 217, 123, 407, 607, 704, 126, 210, 408, 221, 603, 701, 220, 413, 218, 216, 613, 205,
-        414, 112, 213, 102, 709, 419, 116, 801, 411, 203, 418, 415, 510, 110, 711, 612, 606, 209, 707, 608, 611, 119,
-        113, 211, 422, 201, 301, 120, 505, 117, 121, 708, 610, 506, 101, 401, 509, 421, 206, 511, 410, 713, 115, 215,
-        125, 118, 108, 423, 716, 202, 504, 416, 114, 512, 604, 405, 712, 124, 710, 602, 403, 219, 507, 212, 104, 702,
-        208, 803, 107, 417, 601, 614, 204, 802, 718, 717, 420, 305, 207, 705, 514,
-    )
+    history = read_history(history_db)
+    estimates = estimate_wall_times(namelists_dirs, history)
+    # without any history the work still orders the watersheds but there are no seconds to backfill with
+    sizes = {d: namelist_work(d) if estimates[d] is None else estimates[d] for d in namelists_dirs}
     if sort_dirs:
-        namelists_dirs = sorted(namelists_dirs, key=lambda x: sorted_order.index(int(os.path.basename(x))))
+        # longest processing time first so the long watersheds do not finish last
+        namelists_dirs = sorted(namelists_dirs, key=lambda x: sizes[x], reverse=True)
+
+    mpilargest = args.mpilargest if args.engine == 'rapid' else 0
+    mpi_dirs = set(sorted(namelists_dirs, key=lambda x: sizes[x], reverse=True)[:mpilargest])
+    jobs = []
+    for d in namelists_dirs:
+        ranks = min(args.mpiranks, args.cpus) if d in mpi_dirs else 1
+        jobs.append({
+            'namelist_dir': d,
+            'ranks': ranks,
+            'memory_kb': estimate_memory_kb(d, history, args.memoryfactor, ranks),
+            'estimate': estimates[d],
+        })
 
-    cpu_count = min([os.cpu_count(), len(namelists_dirs)])
     print(f'Found {len(namelists_dirs)} input directories')
     print(f'Have {os.cpu_count()} cpus')
-    print(f'Using {cpu_count} cpus')
-
-    with Pool(cpu_count) as p:
-        # p.starmap(run_rapid_for_namelist_directory, [(d, path_to_rapid_exec, logs_dir) for d in namelists_dirs])
-        for d in namelists_dirs:
-            p.apply_async(run_rapid_for_namelist_directory, args=(d, path_to_rapid_exec, logs_dir,))
-        p.close()
-        p.join()
+    print(f'Using {args.cpus} cpus and {round(args.memory, 1)} GB of memory')
+    for job in jobs:
+        print(f'{os.path.basename(job["namelist_dir"])}: {job["ranks"]} ranks, '
+              f'{round(job["memory_kb"] / 1024 ** 2, 2)} GB estimated')
+
+    run_jobs_with_resource_limits(
+        jobs,
+        run_job=lambda job: run_rapid_for_namelist_directory(
+            job['namelist_dir'], path_to_rapid_exec, logs_dir, job['ranks'], args.mpiexec, args.resume,
+            telemetry_file, args.engine
+        ),
+        on_done=lambda record: record_run(history_db, **record) if record else None,
+        cpus=args.cpus,
+        memory_kb=args.memory * 1024 ** 2,
+    )
@@ -0,0 +1,171 @@
+import argparse
+import glob
+import logging
+import os
+import shutil
+import sys
+
+import natsort
+import netCDF4
+import numpy as np
+
+
+def segment_qout_files(outputdir: str) -> list:
+    """
+    List the Qout files of a VPU in time order, excluding the spin-up outputs of each segment
+
+    Args:
+        outputdir: Path to the directory of Qout files for a single VPU
+
+    Returns:
+        list of paths to Qout files
+    """
+    return natsort.natsorted(glob.glob(os.path.join(outputdir, 'Qout*.nc')))
+
+
+def check_time_continuity(qout_files: list) -> list:
+    """
+    Check that the Qout files of a VPU cover a continuous period with a constant time step and no gaps or overlaps,
+    e.g. where a segment did not finish or spin-up outputs were written to the wrong directory
+
+    Args:
+        qout_files: Paths to the Qout files of a VPU in time order
+
+    Returns:
+        list of messages describing each problem found, empty if the files are continuous
+    """
+    problems = []
+    time_step = None
+    previous_end = None
+    previous_file = None
+    for qout_file in qout_files:
+        with netCDF4.Dataset(qout_file) as ds:
+            times = ds['time'][:].astype('int64')
+        if not times.size:
+            problems.append(f'{os.path.basename(qout_file)} has no time steps')
+            continue
+        steps = np.unique(np.diff(times))
+        if time_step is None and steps.size:
+            time_step = int(steps[0])
+        if steps.size > 1 or (steps.size and steps[0] != time_step):
+            problems.append(f'{os.path.basename(qout_file)} has time steps of {steps.tolist()} seconds')
+        if previous_end is not None and time_step is not None and times[0] != previous_end + time_step:
+            problems.append(f'{os.path.basename(qout_file)} starts {int(times[0] - previous_end)} seconds after the '
+                            f'end of {os.path.basename(previous_file)}, expected {time_step}')
+        previous_end = times[-1]
+        previous_file = qout_file
+    return problems
+
+
+def compare_to_reference(qout_file: str, reference_file: str, block_size: int = 1_000) -> dict:
+    """
+    Compare the discharge in a Qout file of a segmented run to the same file from a serial run
+
+    Args:
+        qout_file: Path to the Qout file from the segmented run
+        reference_file: Path to the Qout file from the serial run
+        block_size: Number of time steps to read at once
+
+    Returns:
+        dict with the maximum absolute and relative differences
+    """
+    max_abs = 0.0
+    max_rel = 0.0
+    with netCDF4.Dataset(qout_file) as ds, netCDF4.Dataset(reference_file) as ref:
+        if not np.array_equal(ds['rivid'][:], ref['rivid'][:]) or ds['Qout'].shape != ref['Qout'].shape:
+            raise ValueError(f'{qout_file} and {reference_file} do not have the same rivids and time steps')
+        for start in range(0, ds['Qout'].shape[0], block_size):
+            q = ds['Qout'][start:start + block_size].filled(np.nan).astype('float64')
+            q_ref = ref['Qout'][start:start + block_size].filled(np.nan).astype('float64')
+            diff = np.abs(q - q_ref)
+            max_abs = max(max_abs, float(np.nanmax(diff, initial=0)))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rel = np.where(np.abs(q_ref) > 0, diff / np.abs(q_ref), 0)
+            max_rel = max(max_rel, float(np.nanmax(rel, initial=0)))
+    return {'max_abs': max_abs, 'max_rel': max_rel}
+
+
+def stitch_vpu_segments(outputdir: str, referencedir: str = None, keep_spinup: bool = False,
+                        tolerance: float = None) -> bool:
+    """
+    Check the outputs of a VPU run in segments of time, optionally compare them to a serial run, and delete the
+    spin-up outputs. Each segment writes its Qout files to the same directory as a serial run so once the spin-up
+    outputs are removed the directory is used the same as a serial run.
+
+    Args:
+        outputdir: Path to the directory of Qout files for a single VPU
+        referencedir: Path to the directory of Qout files of the same VPU from a serial run
+        keep_spinup: Keep the spin-up outputs instead of deleting them
+        tolerance: Maximum relative difference to the serial run which is accepted
+
+    Returns:
+        True if the outputs are continuous and within the tolerance of the serial run, otherwise False
+    """
+    vpu = os.path.basename(outputdir)
+    qout_files = segment_qout_files(outputdir)
+    if not qout_files:
+        logging.warning(f'{vpu}: no Qout files found')
+        return False
+
+    problems = check_time_continuity(qout_files)
+    for problem in problems:
+        logging.error(f'{vpu}: {problem}')
+    ok = not problems
+
+    if referencedir is not None:
+        for qout_file in qout_files:
+            reference_file = os.path.join(referencedir, os.path.basename(qout_file))
+            if not os.path.exists(reference_file):
+                logging.warning(f'{vpu}: no reference file for {os.path.basename(qout_file)}')
+                continue
+            diff = compare_to_reference(qout_file, reference_file)
+            logging.info(f'{vpu}: {os.path.basename(qout_file)} max abs diff {diff["max_abs"]:.6g} '
+                         f'max rel diff {diff["max_rel"]:.6g}')
+            if tolerance is not None and diff['max_rel'] > tolerance:
+                logging.error(f'{vpu}: {os.path.basename(qout_file)} exceeds the tolerance of {tolerance}')
+                ok = False
+
+    spinup_dir = os.path.join(outputdir, 'spinup')
+    if ok and not keep_spinup and os.path.isdir(spinup_dir):
+        logging.info(f'{vpu}: removing spin-up outputs')
+        shutil.rmtree(spinup_dir)
+    return ok
+
+
+if __name__ == '__main__':
+    """
+    Check and clean up the outputs of retrospective simulations run in segments of time with
+    generate_namelist.py --segments
+
+    Arguments:
+    --outputsdir: Path to the directory containing subdirectories of Qout files for each VPU
+    --referencedir: Optional path to a directory with the same structure from a serial run to compare against
+    --tolerance: Maximum relative difference to the reference run which is accepted
+    --keepspinup: Keep the spin-up outputs of each segment
+
+    Usage:
+    python stitch_time_segments.py --outputsdir /path/to/outputs --referencedir /path/to/serial/outputs
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--outputsdir', type=str, required=True,
+                        help='Path to the directory containing subdirectories of Qout files for each VPU')
+    parser.add_argument('--referencedir', type=str, required=False, default=None,
+                        help='Path to a directory of outputs from a serial run to compare against')
+    parser.add_argument('--tolerance', type=float, required=False, default=None,
+                        help='Maximum relative difference to the reference run which is accepted')
+    parser.add_argument('--keepspinup', action='store_true', default=False,
+                        help='Keep the spin-up outputs of each segment')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        stream=sys.stdout)
+
+    results = []
+    for vpu_outputs in sorted(d for d in glob.glob(os.path.join(args.outputsdir, '*')) if os.path.isdir(d)):
+        reference = os.path.join(args.referencedir, os.path.basename(vpu_outputs)) if args.referencedir else None
+        results.append(stitch_vpu_segments(vpu_outputs, reference, args.keepspinup, args.tolerance))
+
+    logging.info(f'{sum(results)} / {len(results)} VPUs stitched')
+    if not all(results):
+        sys.exit(1)